@@ -0,0 +1,273 @@
+"""
+End-to-end benchmark of the report pipeline on synthetic workbooks.
+
+Every stage is timed per facility: ingestion (per-sheet xlsx2df, the single
+pass from_xlsx, process_uploaded_file and the lazy load of each section's
+sheets alone), each section analyse() with a stubbed LLM, quantitative, the
+chart functions, chart export and the PDF.
+Results are written as JSON so runs can be compared between commits.
+
+With --llm mock the LLM calls go through send_prompt to the local mock
+backend instead (LLM_MOCK_* variables set its latency and throughput), and
+the whole qualitative chain is timed under realistic LLM timing.
+
+    python benchmarks/run.py --facilities 5 --repeat 3
+    python benchmarks/run.py --months 36 --line-items 600 --baseline benchmarks/results/<run>.json
+    LLM_MOCK_LATENCY=2 python benchmarks/run.py --llm mock
+"""
+
+import os
+
+# Time the real work: no chart image, LLM or history caching in the way
+os.environ.setdefault("FIGURE_CACHE", "0")
+os.environ.setdefault("LLM_CACHE", "0")
+os.environ.setdefault("HISTORY", "0")
+
+import argparse  # noqa: E402
+import io  # noqa: E402
+import json  # noqa: E402
+import platform  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+from collections import defaultdict  # noqa: E402
+from datetime import datetime  # noqa: E402
+from pathlib import Path  # noqa: E402
+
+import numpy as np  # noqa: E402
+from loguru import logger  # noqa: E402
+
+BENCHMARKS = Path(__file__).resolve().parent
+ROOT = BENCHMARKS.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+from analysis import (  # noqa: E402
+    balance_sheet,
+    income_statement,
+    is_month_comparative,
+    labor,
+    revenue,
+    utils,
+)
+from analysis.mock_llm import MockLLM  # noqa: E402
+from analysis.router import get_router  # noqa: E402
+from chart import sankey_data, sankey_figure, total_expense_stack_line, total_revenue_stack_line  # noqa: E402
+from data import FinancialWorkbook, process_uploaded_file, xlsx2df  # noqa: E402
+from portfolio import Portfolio  # noqa: E402
+from render import Rasterizer  # noqa: E402
+from report import (  # noqa: E402
+    SECTIONS,
+    build_pdf,
+    section_sheets,
+    export_charts,
+    generate_pdf,
+    qualitative,
+    quantitative,
+    quantitative_flowables,
+)
+from synthetic import generate  # noqa: E402
+
+# Stands in for the LLM so only local work is timed, long enough to
+# exercise the markdown to PDF conversion
+CANNED_RESPONSE = "\n".join(
+    ["### Summary", "**Revenue** grew while labor costs rose faster than census."]
+    + [f"- Observation {i}: expenses moved against the prior period." for i in range(40)]
+)
+
+
+def stub_send_prompt(prompt, *args, stream=False, **kwargs):
+    return iter([CANNED_RESPONSE]) if stream else CANNED_RESPONSE
+
+
+class Upload(io.BytesIO):
+    """The parts of Streamlit's UploadedFile that process_uploaded_file uses"""
+
+    def __init__(self, path: Path):
+        super().__init__(path.read_bytes())
+        self.name = path.name
+
+
+class Timer:
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def __call__(self, stage: str, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.samples[stage].append(time.perf_counter() - start)
+        return result
+
+    def summary(self) -> dict:
+        return {
+            stage: {
+                "runs": len(samples),
+                "mean": float(np.mean(samples)),
+                "median": float(np.median(samples)),
+                "p95": float(np.percentile(samples, 95)),
+                "min": float(np.min(samples)),
+                "max": float(np.max(samples)),
+            }
+            for stage, samples in self.samples.items()
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_facility(timer: Timer, path: Path, sheet_map: dict, work_dir: Path, rasterizer: Rasterizer, llm: str = "stub"):
+    for sheet_name, (rows, columns) in sheet_map.items():
+        timer(f"ingest.xlsx2df.{sheet_name}", xlsx2df, rows, columns, sheet_name, path)
+    workbook = timer("ingest.from_xlsx", FinancialWorkbook.from_xlsx, path, sheet_map)
+
+    upload_dir = work_dir / path.stem
+    (upload_dir / "raw").mkdir(parents=True, exist_ok=True)
+    (upload_dir / "processed").mkdir(exist_ok=True)
+    timer("ingest.process_uploaded_file", process_uploaded_file, Upload(path), upload_dir, sheet_map=sheet_map)
+
+    # What a report of one section parses, compared to ingest.from_xlsx
+    for name in SECTIONS:
+        timer(f"ingest.section.{name}", FinancialWorkbook(xlsx_path=path, sheet_map=sheet_map).load, *section_sheets(name))
+
+    for name, section in SECTIONS.items():
+        if section.analyse is not None:
+            timer(f"analyse.{name}", section.analyse, workbook)
+    if llm == "mock":
+        # Sections concurrently, then the master prompt, as in the app
+        timer("qualitative", qualitative, workbook)
+
+    quant = timer("quantitative", quantitative, workbook)
+    dollar_var_top, percent_var_top, _, sankey_fig_pdf, fig_stack_line, fig_expense_stack_line = quant
+
+    df = workbook["Income Statement T-12"]
+    flow = timer("chart.sankey_data", sankey_data, df)
+    timer("chart.sankey_figure", sankey_figure, flow)
+    timer("chart.total_revenue_stack_line", total_revenue_stack_line, df)
+    timer("chart.total_expense_stack_line", total_expense_stack_line, df)
+
+    img_format, images = timer(
+        "export_charts",
+        export_charts,
+        sankey_fig_pdf,
+        fig_stack_line,
+        fig_expense_stack_line,
+        rasterizer=rasterizer,
+    )
+    elements = quantitative_flowables(dollar_var_top, percent_var_top, img_format, images)
+    timer("build_pdf", build_pdf, CANNED_RESPONSE, elements)
+    timer("generate_pdf", generate_pdf, CANNED_RESPONSE, dollar_var_top, percent_var_top, sankey_fig_pdf, fig_stack_line, fig_expense_stack_line)
+
+    return workbook
+
+
+def run(facilities: int, months: int, line_items: int, repeat: int, seed: int, llm: str = "stub") -> dict:
+    if llm == "mock":
+        mock = MockLLM.from_env()
+        utils.set_client(mock)
+    else:
+        for module in (balance_sheet, income_statement, is_month_comparative, labor, revenue, utils):
+            module.send_prompt = stub_send_prompt
+
+    timer = Timer()
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        paths, sheet_map = timer(
+            "synthetic.generate", generate, tmp / "raw", facilities, months, line_items, seed
+        )
+
+        # Start kaleido and the export pool before anything is timed
+        rasterizer = Rasterizer(workers=0, cache=None)
+        warm_up = FinancialWorkbook.from_xlsx(paths[0], sheet_map)
+        quant = quantitative(warm_up)
+        export_charts(*quant[3:], rasterizer=rasterizer)
+        generate_pdf(CANNED_RESPONSE, *quant[:2], *quant[3:])
+
+        workbooks = {}
+        for _ in range(repeat):
+            for path in paths:
+                workbooks[path.stem] = run_facility(timer, path, sheet_map, tmp / "uploads", rasterizer, llm)
+
+        for _ in range(repeat):
+            portfolio = Portfolio(workbooks)
+            timer("portfolio.workbook", portfolio.workbook)
+            timer("portfolio.rankings", portfolio.rankings)
+
+        rasterizer.shutdown()
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "facilities": facilities,
+            "months": months,
+            "line_items": line_items,
+            "repeat": repeat,
+            "seed": seed,
+            "llm": llm,
+        },
+        "llm": (
+            {
+                "calls": mock.calls,
+                "peak_in_flight": mock.peak_in_flight,
+                "latency": mock.latency,
+                "tokens_per_second": mock.tokens_per_second,
+                "models": get_router().stats.summary(),
+            }
+            if llm == "mock"
+            else None
+        ),
+        "stages": timer.summary(),
+    }
+
+
+def print_results(results: dict, baseline: dict = None):
+    print(f"{'stage':<48} {'runs':>5} {'median':>9} {'p95':>9}" + (f" {'baseline':>9} {'change':>8}" if baseline else ""))
+    for stage, stats in results["stages"].items():
+        line = f"{stage:<48} {stats['runs']:>5} {stats['median'] * 1000:>7.1f}ms {stats['p95'] * 1000:>7.1f}ms"
+        if baseline:
+            before = baseline["stages"].get(stage)
+            if before:
+                change = stats["median"] / before["median"] - 1
+                line += f" {before['median'] * 1000:>7.1f}ms {change:>+8.1%}"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the report pipeline on synthetic workbooks")
+    parser.add_argument("--facilities", type=int, default=3)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--line-items", type=int, default=None, help="T-12 line-item rows, default the template's")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--llm", choices=("stub", "mock"), default="stub", help="Instant canned answers, or the mock backend's timing"
+    )
+    parser.add_argument("--output", type=Path, default=None, help="JSON results, default benchmarks/results/")
+    parser.add_argument("--baseline", type=Path, default=None, help="Earlier JSON results to compare with")
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    results = run(args.facilities, args.months, args.line_items, args.repeat, args.seed, args.llm)
+
+    output = args.output or BENCHMARKS / "results" / f"{results['timestamp'].replace(':', '')}-{results['commit'] or 'local'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+    print_results(results, baseline)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
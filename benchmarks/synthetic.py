@@ -0,0 +1,182 @@
+"""
+Synthetic facility workbooks in the exact layout src/data.py expects.
+
+The sample statements workbook is used as a template: titles, header rows,
+labels and blank cells are kept, numbers are scaled with per-facility noise,
+the monthly sheets get `months` month columns and the two detailed sheets
+are padded with extra expense lines. Returns the files written and the
+sheet map to read them with.
+
+    python benchmarks/synthetic.py --facilities 20 --months 24 --line-items 400
+"""
+
+import argparse
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from data import sheets, xlsx_path  # noqa: E402
+
+# Sheets with one column per month followed by the YTD total
+MONTHLY_SHEETS = ("Census & Revenue Trend", "Income Statement T-12")
+# Sheets padded with extra expense lines, inserted before this label
+PADDED_SHEETS = ("Income Statement T-12", "IS Month Comparative Detailed")
+PAD_BEFORE = "Real Estate Taxes"
+
+# Rows 7-9 of the monthly sheets: "Month Ending", the date, "Actual"
+DATE_ROW = 7
+
+
+def read_template(template=xlsx_path, sheet_map: dict = sheets) -> dict:
+    """Cell values of every configured sheet, as lists of rows"""
+    workbook = load_workbook(template, read_only=True, data_only=True)
+    try:
+        return {
+            sheet_name: [list(row) for row in workbook[sheet_name].iter_rows(values_only=True)]
+            for sheet_name in sheet_map
+        }
+    finally:
+        workbook.close()
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def month_ends(as_of: datetime, months: int) -> list:
+    """The last `months` month end dates up to `as_of`, oldest first"""
+    return list(pd.date_range(end=as_of, periods=months, freq="ME").to_pydatetime())
+
+
+def resize_months(rows: list, first_row: int, months: int, as_of: datetime) -> list:
+    """Rebuild the month columns (B onwards) of a monthly sheet, then its YTD column"""
+    dates = month_ends(as_of, months)
+    resized = []
+    for i, row in enumerate(rows):
+        label, template_months, ytd = row[0], row[1:13], row[13] if len(row) > 13 else None
+        if i < first_row - 1 or not any(is_number(value) for value in template_months):
+            # Header and text rows repeat column B's cell across the new months
+            cells = [template_months[0] if template_months else None] * months
+            if i == DATE_ROW:
+                cells = [date.strftime("%m/%d/%Y") for date in dates]
+            resized.append([label, *cells, ytd])
+            continue
+
+        # Cycle the template months so the newest column stays the newest
+        cells = [template_months[(12 - months + j) % 12] for j in range(months)]
+        ytd = sum(
+            value for value, date in zip(cells, dates) if date.year == as_of.year and is_number(value)
+        )
+        resized.append([label, *cells, ytd])
+    return resized
+
+
+def pad_line_items(rows: list, extra: int) -> tuple:
+    """Insert `extra` expense lines before PAD_BEFORE, returning the rows and the insert position"""
+    labels = [str(row[0]).strip() if row and row[0] is not None else "" for row in rows]
+    position = labels.index(PAD_BEFORE) if PAD_BEFORE in labels else len(rows) - 1
+
+    # Copy the numbers of the closest detail line above
+    source = next(
+        row for row in reversed(rows[:position]) if sum(is_number(value) for value in row[1:]) > 1
+    )
+    padding = [[f"    Synthetic Expense {k + 1}", *source[1:]] for k in range(extra)]
+    return rows[:position] + padding + rows[position:], position
+
+
+def scale_numbers(rows: list, rng: np.random.Generator, spread: float = 0.15) -> list:
+    """Scale every number by a per-row factor and a little per-cell noise"""
+    scaled = []
+    for row in rows:
+        factor = rng.lognormal(0, spread)
+        new_row = []
+        for value in row:
+            if is_number(value):
+                value = value * factor * rng.lognormal(0, spread / 3)
+                value = round(value) if isinstance(value, int) or float(value).is_integer() else round(value, 2)
+            new_row.append(value)
+        scaled.append(new_row)
+    return scaled
+
+
+def layout(months: int = 12, extra_line_items: int = 0, sheet_map: dict = sheets) -> dict:
+    """Sheet map for workbooks generated with these parameters"""
+    layout = {}
+    for sheet_name, ((first, last), (first_column, last_column)) in sheet_map.items():
+        if sheet_name in PADDED_SHEETS:
+            last += extra_line_items
+        if sheet_name in MONTHLY_SHEETS:
+            last_column = get_column_letter(column_index_from_string(first_column) + months + 1)
+        layout[sheet_name] = [[first, last], [first_column, last_column]]
+    return layout
+
+
+def generate(
+    out_dir: Path,
+    facilities: int = 1,
+    months: int = 12,
+    line_items: int = None,
+    seed: int = 0,
+    template=xlsx_path,
+    sheet_map: dict = sheets,
+):
+    """
+    Write `facilities` workbooks to `out_dir`. `line_items` is the number
+    of line-item rows of the T-12 range, at least the template's; the
+    detailed comparative sheet gets the same number of extra lines.
+
+    Returns the written paths and the sheet map to read them with.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    template_rows = read_template(template, sheet_map)
+    (first, last), _ = sheet_map["Income Statement T-12"]
+    extra = max(0, (line_items or 0) - (last - first + 1))
+    as_of = datetime.strptime(template_rows["Income Statement T-12"][DATE_ROW][12], "%m/%d/%Y")
+
+    # The layout only depends on the parameters, shape every sheet once
+    shaped = {}
+    for sheet_name, rows in template_rows.items():
+        if sheet_name in PADDED_SHEETS and extra:
+            rows, _ = pad_line_items(rows, extra)
+        if sheet_name in MONTHLY_SHEETS:
+            rows = resize_months(rows, sheet_map[sheet_name][0][0], months, as_of)
+        shaped[sheet_name] = rows
+
+    paths = []
+    for i in range(facilities):
+        workbook = Workbook(write_only=True)
+        for sheet_name, rows in shaped.items():
+            worksheet = workbook.create_sheet(sheet_name)
+            for row in scale_numbers(rows, rng):
+                worksheet.append(row)
+
+        path = out_dir / f"{as_of:%Y %m} Synthetic Facility {i + 1:03} Financial Statements.xlsx"
+        workbook.save(path)
+        paths.append(path)
+
+    return paths, layout(months, extra, sheet_map)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("out_dir", type=Path)
+    parser.add_argument("--facilities", type=int, default=1)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--line-items", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths, sheet_map = generate(args.out_dir, args.facilities, args.months, args.line_items, args.seed)
+    print(f"{len(paths)} workbooks written to {args.out_dir}")
+    for sheet_name, ranges in sheet_map.items():
+        print(f"  {sheet_name}: {ranges}")
@@ -1,33 +1,33 @@
-import os
-import pandas as pd
 from loguru import logger
 
 try:
-    from utils import PATH, send_prompt, df_to_csv_text
+    from utils import PATH, send_prompt, load_sheet
+    from compact import compact_text
     from prompt import Prompt
 except (ModuleNotFoundError, ImportError):
-    from .utils import PATH, send_prompt, df_to_csv_text
+    from .utils import PATH, send_prompt, load_sheet
+    from .compact import compact_text
     from .prompt import Prompt
 
-file_name = "Balance Sheet.csv"
+sheet_name = "Balance Sheet"
 
 # TODO: Revise and improve this prompt
 # Current output is very undesirable
 
 
-def analyse(file_dir=PATH.data_processed):
-    file_path = file_dir / file_name
+def analyse(source=PATH.data_processed):
+    data = load_sheet(source, sheet_name)
     prompt = Prompt.balance_sheet
 
-    if not os.path.exists(file_path):
-        logger.error(f"File {file_path.name} does not exist")
+    if data is None:
+        logger.error(f"Sheet {sheet_name} does not exist")
         return
 
     # Balance sheet is small enough for the LLM to directly analyse
-    with open(file_path) as f:
-        balance_sheet = f.read().strip()
-        prompt = prompt.format(balance_sheet=balance_sheet)
-        return send_prompt(prompt)
+    balance_sheet = compact_text(data, "balance_sheet").strip()
+
+    prompt = prompt.format(balance_sheet=balance_sheet)
+    return send_prompt(prompt, route="balance_sheet")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,135 @@
+import math
+import os
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+try:
+    import tiktoken
+except ImportError:  # Optional, token counts fall back to an estimate
+    tiktoken = None
+
+
+class Compaction:
+    # Significant figures kept for every value in a prompt
+    sig_figs = int(os.getenv("PROMPT_SIG_FIGS", 4))
+    # Show money columns in thousands, e.g. 446104.12 -> 446.1
+    thousands = os.getenv("PROMPT_THOUSANDS", "0") == "1"
+    # Token budget for the data embedded in each section prompt
+    default_budget = int(os.getenv("PROMPT_TOKEN_BUDGET", 3000))
+    budgets = {
+        "balance_sheet": 2000,
+        "income_statement": 1500,
+        "is_month_comparative": 1000,
+        "labor": 2000,
+        "revenue": 2000,
+    }
+
+
+# Long header fragments repeated across the comparative sheets
+HEADER_ABBREVIATIONS = {
+    "Month Ending ": "ME ",
+    "Year To Date ": "YTD ",
+    "Year Ending ": "YE ",
+    " Actual": "",
+    "Period Difference": "Diff",
+    "Period Variance": "Var",
+    "$ Change": "Diff",
+    "% Variance": "Var",
+}
+
+# Columns holding ratios or ranks rather than money, never scaled to thousands
+UNSCALED_MARKERS = ("Var", "%", "PPD", "Rank")
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Token count with the GPT-4o tokenizer, or ~4 characters per token without tiktoken"""
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # Not installed, or the encoding cannot be downloaded
+            reason = "is not installed" if tiktoken is None else f"failed to load ({e})"
+            logger.warning(f"tiktoken {reason}, token budgets are enforced on an estimate")
+            _encoding = False
+
+    if _encoding is False:
+        return math.ceil(len(text) / 4)
+    return len(_encoding.encode(text))
+
+
+def abbreviate(header: str) -> str:
+    for long, short in HEADER_ABBREVIATIONS.items():
+        header = header.replace(long, short)
+    return header.strip()
+
+
+def format_values(values, sig_figs: int):
+    """Format a float array to `sig_figs` significant figures, blanks for NaN"""
+    formatted = np.full(values.shape, "", dtype=object)
+    mask = ~np.isnan(values)
+    formatted[mask] = [
+        np.format_float_positional(
+            value, precision=sig_figs, unique=False, fractional=False, trim="-"
+        )
+        for value in values[mask]
+    ]
+    return formatted
+
+
+def compact_frame(df, sig_figs: int = None, thousands: bool = None):
+    """
+    Shrink a numeric sheet for a prompt: drop empty rows and columns,
+    abbreviate headers and round to significant figures (optionally in
+    thousands). Returns a frame of strings indexed by line item.
+    """
+    sig_figs = Compaction.sig_figs if sig_figs is None else sig_figs
+    thousands = Compaction.thousands if thousands is None else thousands
+
+    df = df.dropna(how="all").dropna(axis=1, how="all")
+    columns = [abbreviate(str(column)) for column in df.columns]
+    values = df.to_numpy(dtype="float64", na_value=np.nan, copy=True)
+
+    if thousands:
+        money = [not any(marker in column for marker in UNSCALED_MARKERS) for column in columns]
+        values[:, money] = values[:, money] / 1000
+        columns = [f"{c} ($K)" if m else c for c, m in zip(columns, money)]
+
+    compact = pd.DataFrame(format_values(values, sig_figs), index=df.index, columns=columns)
+    return compact.rename_axis("Line Item")
+
+
+def compact_text(df, section: str, budget: int = None, **kwargs) -> str:
+    """
+    CSV text of a compacted sheet for the `section` prompt. Rows past the
+    section's token budget are cut off, with a note saying so.
+    """
+    budget = budget or Compaction.budgets.get(section, Compaction.default_budget)
+    compact = compact_frame(df, **kwargs)
+
+    text = compact.to_csv()
+    tokens = count_tokens(text)
+    if tokens > budget:
+        # Keep the longest leading block of rows that fits, note included
+        def fits(n):
+            omitted = f"... {len(compact) - n} more rows omitted\n"
+            return count_tokens(compact.iloc[:n].to_csv() + omitted) <= budget
+
+        low, high = 0, len(compact)
+        while low < high:
+            mid = (low + high + 1) // 2
+            low, high = (mid, high) if fits(mid) else (low, mid - 1)
+
+        text = compact.iloc[:low].to_csv() + f"... {len(compact) - low} more rows omitted\n"
+        logger.warning(
+            f"{section} data is {tokens} tokens, over its {budget} budget; "
+            f"kept {low}/{len(compact)} rows"
+        )
+        tokens = count_tokens(text)
+
+    logger.debug(f"{section} data: {tokens} tokens")
+    return text
@@ -1,28 +1,26 @@
-import os
 import pandas as pd
 from loguru import logger
 
 try:
-    from utils import PATH, send_prompt, df_to_csv_text
+    from utils import PATH, send_prompt, load_sheet
+    from compact import compact_text
     from prompt import Prompt
 except (ModuleNotFoundError, ImportError):
-    from .utils import PATH, send_prompt, df_to_csv_text
+    from .utils import PATH, send_prompt, load_sheet
+    from .compact import compact_text
     from .prompt import Prompt
 
-file_name = "Income Statement T-12.csv"
+sheet_name = "Income Statement T-12"
 
 
-def analyse(file_dir=PATH.data_processed):
-    file_path = file_dir / file_name
+def analyse(source=PATH.data_processed):
+    data = load_sheet(source, sheet_name)
     prompt = Prompt.income_statement
 
-    if not os.path.exists(file_path):
-        logger.error(f"File {file_path.name} does not exist")
+    if data is None:
+        logger.error(f"Sheet {sheet_name} does not exist")
         return
 
-    # Read the income statement into a DataFrame
-    data = pd.read_csv(file_path, index_col=0)
-
     # Keep only row with the word "Total"
     data = data[data.index.str.contains("total", case=False)]
 
@@ -64,10 +62,10 @@ def analyse(file_dir=PATH.data_processed):
             agg_data.loc[group] = matching_rows.sum()
 
     # print(agg_data)
-    income_statement = df_to_csv_text(agg_data)
+    income_statement = compact_text(agg_data, "income_statement")
 
     prompt = prompt.format(income_statement=income_statement)
-    return send_prompt(prompt)
+    return send_prompt(prompt, route="income_statement")
 
 
 if __name__ == "__main__":
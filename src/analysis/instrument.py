@@ -0,0 +1,150 @@
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import psutil
+from loguru import logger
+
+try:
+    import resource
+except ImportError:  # Windows, the peak comes from psutil instead
+    resource = None
+
+_process = psutil.Process()
+_trace = contextvars.ContextVar("trace", default=None)
+_span = contextvars.ContextVar("span", default=None)
+
+# Fields every span record has, anything else is an attribute
+SPAN_FIELDS = ("name", "parent", "start", "wall", "cpu", "rss", "peak_rss", "peak_growth", "thread")
+
+
+def peak_rss() -> int:
+    """High-water mark of the process resident set size, in bytes"""
+    info = _process.memory_info()
+    if hasattr(info, "peak_wset"):
+        return info.peak_wset
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+    return info.rss
+
+
+class Trace:
+    """Spans recorded while producing one report, exportable as a JSON trace"""
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.wall = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, record: dict):
+        with self._lock:
+            self.spans.append(record)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda record: record["start"])
+        return {
+            "name": self.name,
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "wall": self.wall,
+            **self.attrs,
+            "spans": spans,
+        }
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(self.to_dict(), indent=2, default=str))
+        os.replace(tmp_path, path)
+
+
+@contextmanager
+def tracing(name: str, **attrs):
+    """Collect every span opened in this context (and in_context threads) into a Trace"""
+    trace = Trace(name, **attrs)
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+        trace.wall = time.perf_counter() - trace.origin
+        if trace.spans:
+            logger.info(f"{name}: {trace.wall:.2f}s, {len(trace.spans)} spans")
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Time a stage: wall time, CPU time of the calling thread, resident set
+    size at the end and the process peak RSS, with how much the stage
+    raised it. The record is logged and added to the active trace, and can
+    be annotated (token usage, ...) while the span is open.
+    """
+    parent = _span.get()
+    trace = _trace.get()
+    record = {"name": name, "parent": parent["name"] if parent else None, **attrs}
+    token = _span.set(record)
+
+    peak_before = peak_rss()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        end = time.perf_counter()
+        peak = peak_rss()
+        record.update(
+            start=round(wall - (trace.origin if trace else wall), 6),
+            wall=round(end - wall, 6),
+            cpu=round(time.thread_time() - cpu, 6),
+            rss=_process.memory_info().rss,
+            peak_rss=peak,
+            peak_growth=peak - peak_before,
+            thread=threading.current_thread().name,
+        )
+        _span.reset(token)
+
+        if trace is not None:
+            trace.add(record)
+        extra = "".join(f", {key}={value}" for key, value in record.items() if key not in SPAN_FIELDS)
+        logger.bind(span=record).debug(
+            f"{name}: {record['wall']:.3f}s wall, {record['cpu']:.3f}s cpu, "
+            f"{record['rss'] / 2**20:.0f}MiB rss{extra}"
+        )
+
+
+def annotate(**attrs):
+    """Add attributes to the innermost open span, summing repeated counts such as tokens"""
+    record = _span.get()
+    if record is None:
+        return
+
+    for key, value in attrs.items():
+        if isinstance(value, (int, float)) and isinstance(record.get(key), (int, float)):
+            record[key] += value
+        else:
+            record[key] = value
+
+
+def in_context(fn):
+    """
+    `fn` bound to a copy of the current context. Pool threads start from an
+    empty context, submit this instead so their spans join the active trace.
+    """
+    return functools.partial(contextvars.copy_context().run, fn)
@@ -1,41 +1,36 @@
-import os
-import pandas as pd
 from loguru import logger
 
 try:
-    from utils import PATH, send_prompt, df_to_csv_text
+    from utils import PATH, send_prompt, load_sheet
+    from compact import compact_text
     from prompt import Prompt
 except (ModuleNotFoundError, ImportError):
-    from .utils import PATH, send_prompt, df_to_csv_text
+    from .utils import PATH, send_prompt, load_sheet
+    from .compact import compact_text
     from .prompt import Prompt
 
-file_name = "IS Month Comparative Detailed.csv"
+sheet_name = "IS Month Comparative Detailed"
 
 
-def analyse(file_dir=PATH.data_processed):
-    # file_path = file_dir / file_name
+def analyse(source=PATH.data_processed):
     prompt = Prompt.is_month_comparative
 
-    dollar_var_top, percent_var_top = get_data(file_dir)
+    dollar_var_top, percent_var_top = get_data(source)
 
     prompt = prompt.format(
-        percent_var_top=percent_var_top, dollar_var_top=dollar_var_top
+        percent_var_top=compact_text(percent_var_top, "is_month_comparative"),
+        dollar_var_top=compact_text(dollar_var_top, "is_month_comparative"),
     )
-    return send_prompt(prompt)
+    return send_prompt(prompt, route="is_month_comparative")
 
 
-def get_data(file_dir=PATH.data_processed):
-    file_path = file_dir / file_name
+def get_data(source=PATH.data_processed):
+    data = load_sheet(source, sheet_name)
 
-    logger.debug(file_path)
-
-    if not os.path.exists(file_path):
-        logger.error(f"File {file_path.name} does not exist")
+    if data is None:
+        logger.error(f"Sheet {sheet_name} does not exist")
         return
 
-    # Read the income statement into a DataFrame
-    data = pd.read_csv(file_path, index_col=0)
-
     # print(data.index.tolist())  # Log the row names
     data = data.loc["Nursing Expenses":"Total Real Estate Taxes"]
     data = data[~data.index.str.contains("total", case=False)]
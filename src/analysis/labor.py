@@ -1,28 +1,25 @@
-import os
-import pandas as pd
 from loguru import logger
 
 try:
-    from utils import PATH, send_prompt, df_to_csv_text
+    from utils import PATH, send_prompt, load_sheet
+    from compact import compact_text
     from prompt import Prompt
 except (ModuleNotFoundError, ImportError):
-    from .utils import PATH, send_prompt, df_to_csv_text
+    from .utils import PATH, send_prompt, load_sheet
+    from .compact import compact_text
     from .prompt import Prompt
 
-file_name = "Labor.csv"
+sheet_name = "Labor"
 
 
-def analyse(file_dir=PATH.data_processed):
-    file_path = file_dir / file_name
+def analyse(source=PATH.data_processed):
+    data = load_sheet(source, sheet_name)
     prompt = Prompt.labor
 
-    if not os.path.exists(file_path):
-        logger.error(f"File {file_path.name} does not exist")
+    if data is None:
+        logger.error(f"Sheet {sheet_name} does not exist")
         return
 
-    # Read the income statement into a DataFrame
-    data = pd.read_csv(file_path, index_col=0)
-
     # Keep only row with the word "Total"
     data = data[data.index.str.contains("total", case=False)]
 
@@ -46,10 +43,10 @@ def analyse(file_dir=PATH.data_processed):
     data = data[data.index.isin(important_roles)]
 
     # print(agg_data)
-    labor = df_to_csv_text(data)
+    labor = compact_text(data, "labor")
 
     prompt = prompt.format(labor=labor)
-    return send_prompt(prompt)
+    return send_prompt(prompt, route="labor")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+import hashlib
+import json
+from pathlib import Path
+
+try:
+    from prompt import prompt_version
+    from store import BlobCache
+except (ModuleNotFoundError, ImportError):
+    from .prompt import prompt_version
+    from .store import BlobCache
+
+
+class ResponseCache(BlobCache):
+    """
+    Disk-backed cache of LLM responses shared by every process on the host,
+    evicted least recently used first once the cache grows past
+    `max_bytes`, or when older than `max_age` seconds.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 100 * 2**20, max_age: float = 30 * 86400):
+        super().__init__(path, "responses", max_bytes, max_age)
+
+    @staticmethod
+    def key(model: str, temperature: float, prompt: str) -> str:
+        """Cache key for a completion, tied to the current prompt templates"""
+        payload = json.dumps([model, temperature, prompt, prompt_version()])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def default_cache():
+    """The shared response cache, or None when disabled with LLM_CACHE=0"""
+    return ResponseCache.from_env("LLM_CACHE", "llm_responses.sqlite", max_bytes=100 * 2**20, max_age=30 * 86400)
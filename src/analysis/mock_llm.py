@@ -0,0 +1,312 @@
+"""
+Local stand-in for the chat-completions API, for offline runs and load tests.
+
+`MockLLM` has the `chat.completions.create` surface of the OpenAI client and
+returns the same response types, so `send_prompt` (retries, streaming, the
+response cache, token accounting) runs unchanged on top of it. Answers are
+deterministic per prompt; latency, token throughput, errors and rate limits
+are drawn from a seeded distribution. Select it with LLM_BACKEND=mock.
+
+The same fake can be served over HTTP, to include connection pooling and
+serialization in a benchmark, and pointed at with OPENAI_BASE_URL:
+
+    python src/analysis/mock_llm.py --port 8800
+    OPENAI_BASE_URL=http://127.0.0.1:8800/v1 OPENAI_API_KEY=mock streamlit run src/main.py
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+from loguru import logger
+from openai import APITimeoutError, InternalServerError, RateLimitError
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+# Filler the default answers are drawn from, so they read like the real ones
+# (markdown headings, bold figures, bullet points) for the PDF conversion
+VOCABULARY = (
+    "revenue census occupancy expenses labor agency nursing dietary payer mix "
+    "Medicare Medicaid private insurance variance budget prior period increased "
+    "decreased driven by partially offset margin operating income staffing hours "
+    "per patient day trend month quarter year to date"
+).split()
+
+
+class MockSettings:
+    # Seconds before the first token: lognormal with this median and spread
+    latency = float(os.getenv("LLM_MOCK_LATENCY", 1.0))
+    latency_sigma = float(os.getenv("LLM_MOCK_LATENCY_SIGMA", 0.5))
+    # JSON object of {model: median latency}, for models slower or faster than that
+    model_latency = os.getenv("LLM_MOCK_MODEL_LATENCY")
+    # Generation speed once the answer starts
+    tokens_per_second = float(os.getenv("LLM_MOCK_TOKENS_PER_SECOND", 60))
+    # Words in a default answer
+    answer_tokens = int(os.getenv("LLM_MOCK_ANSWER_TOKENS", 300))
+    # Share of calls failing with a 500 or a 429
+    error_rate = float(os.getenv("LLM_MOCK_ERROR_RATE", 0))
+    rate_limit_rate = float(os.getenv("LLM_MOCK_RATE_LIMIT_RATE", 0))
+    # Calls in flight beyond this are rejected with a 429, 0 for no limit
+    max_in_flight = int(os.getenv("LLM_MOCK_MAX_IN_FLIGHT", 0))
+    # Retry-After sent with every 429
+    retry_after = float(os.getenv("LLM_MOCK_RETRY_AFTER", 1.0))
+    # JSON object of {prompt substring: answer}, checked before the default
+    answers = os.getenv("LLM_MOCK_ANSWERS")
+    seed = int(os.getenv("LLM_MOCK_SEED", 0))
+
+
+def count_tokens(text: str) -> int:
+    """Rough token count, about four characters per token"""
+    return max(1, len(text) // 4)
+
+
+def default_answer(prompt: str, tokens: int) -> str:
+    """Markdown answer of about `tokens` words, always the same for a prompt"""
+    rng = random.Random(hashlib.sha256(prompt.encode()).digest())
+    lines = ["### Summary"]
+    words = 0
+    while words < tokens:
+        sentence = " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(8, 16)))
+        figure = f"**${rng.randint(1, 999):,},{rng.randint(0, 999):03}**"
+        lines.append(f"- {sentence.capitalize()} by {figure}.")
+        words += sentence.count(" ") + 3
+    return "\n".join(lines)
+
+
+class MockLLM:
+    """
+    In-process fake of the OpenAI client. Every call draws its latency and
+    failures from a generator seeded with the prompt and how many times it
+    was sent, so a run is reproducible however threads interleave.
+    """
+
+    def __init__(
+        self,
+        latency: float = MockSettings.latency,
+        latency_sigma: float = MockSettings.latency_sigma,
+        model_latency: dict = None,
+        tokens_per_second: float = MockSettings.tokens_per_second,
+        answer_tokens: int = MockSettings.answer_tokens,
+        error_rate: float = MockSettings.error_rate,
+        rate_limit_rate: float = MockSettings.rate_limit_rate,
+        max_in_flight: int = MockSettings.max_in_flight,
+        retry_after: float = MockSettings.retry_after,
+        answers: dict = None,
+        seed: int = MockSettings.seed,
+    ):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.model_latency = model_latency or {}
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.answers = answers or {}
+        self.seed = seed
+
+        self.calls = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._sent = {}
+        self._lock = threading.Lock()
+
+        # Mirrors client.chat.completions.create
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @classmethod
+    def from_env(cls):
+        answers = None
+        if MockSettings.answers:
+            answers = json.loads(Path(MockSettings.answers).read_text())
+        model_latency = json.loads(MockSettings.model_latency) if MockSettings.model_latency else None
+        return cls(answers=answers, model_latency=model_latency)
+
+    def answer(self, prompt: str) -> str:
+        for needle, answer in self.answers.items():
+            if needle in prompt:
+                return answer
+        return default_answer(prompt, self.answer_tokens)
+
+    def _draw(self, prompt: str) -> random.Random:
+        digest = hashlib.sha256(prompt.encode()).hexdigest()
+        with self._lock:
+            attempt = self._sent.get(digest, 0)
+            self._sent[digest] = attempt + 1
+            self.calls += 1
+        return random.Random(f"{self.seed}:{digest}:{attempt}")
+
+    def _error(self, status: int, message: str, headers: dict = None):
+        request = httpx.Request("POST", "http://mock-llm/v1/chat/completions")
+        response = httpx.Response(status, headers=headers, request=request)
+        error = RateLimitError if status == 429 else InternalServerError
+        return error(message, response=response, body=None)
+
+    def _enter(self):
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                raise self._error(
+                    429, "Too many requests in flight", {"retry-after-ms": str(int(self.retry_after * 1000))}
+                )
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def _exit(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def create(self, model: str, messages: list, stream: bool = False, timeout: float = None, stream_options: dict = None, **kwargs):
+        prompt = "\n".join(message["content"] for message in messages)
+        rng = self._draw(prompt)
+
+        # Rejections come back straight away, like a real 429
+        if rng.random() < self.rate_limit_rate:
+            raise self._error(429, "Rate limit reached", {"retry-after-ms": str(int(self.retry_after * 1000))})
+
+        latency = self.model_latency.get(model, self.latency) * rng.lognormvariate(0, self.latency_sigma)
+        fails = rng.random() < self.error_rate
+        answer = self.answer(prompt)
+        usage = CompletionUsage(
+            prompt_tokens=count_tokens(prompt),
+            completion_tokens=count_tokens(answer),
+            total_tokens=count_tokens(prompt) + count_tokens(answer),
+        )
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+
+        self._enter()
+        try:
+            if timeout is not None and latency > timeout:
+                time.sleep(timeout)
+                raise APITimeoutError(request=httpx.Request("POST", "http://mock-llm/v1/chat/completions"))
+            time.sleep(latency)
+            if fails:
+                raise self._error(500, "The server had an error while processing your request")
+        except BaseException:
+            self._exit()
+            raise
+
+        if stream:
+            include_usage = bool(stream_options and stream_options.get("include_usage"))
+            return self._stream(completion_id, model, answer, usage if include_usage else None)
+
+        try:
+            # Whole answer at once, after generating every token
+            time.sleep(usage.completion_tokens / self.tokens_per_second)
+        finally:
+            self._exit()
+        return ChatCompletion(
+            id=completion_id,
+            object="chat.completion",
+            created=int(time.time()),
+            model=model,
+            choices=[
+                {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": answer}}
+            ],
+            usage=usage,
+        )
+
+    def _stream(self, completion_id: str, model: str, answer: str, usage: CompletionUsage = None):
+        def chunk(delta: dict, finish_reason=None, usage=None, choices=True):
+            return ChatCompletionChunk(
+                id=completion_id,
+                object="chat.completion.chunk",
+                created=int(time.time()),
+                model=model,
+                choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}] if choices else [],
+                usage=usage,
+            )
+
+        try:
+            yield chunk({"role": "assistant", "content": ""})
+            # A few words per chunk, paced at the configured throughput
+            words = answer.split(" ")
+            for start in range(0, len(words), 4):
+                piece = " ".join(words[start : start + 4]) + (" " if start + 4 < len(words) else "")
+                time.sleep(count_tokens(piece) / self.tokens_per_second)
+                yield chunk({"content": piece})
+            yield chunk({}, finish_reason="stop")
+            if usage is not None:
+                yield chunk({}, usage=usage, choices=False)
+        finally:
+            self._exit()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """POST /v1/chat/completions backed by the server's MockLLM, JSON or server-sent events"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        stream = body.pop("stream", False)
+        try:
+            result = self.server.llm.create(stream=stream, **body)
+        except (RateLimitError, InternalServerError) as e:
+            self._send_json(e.status_code, {"error": {"message": e.message, "type": "mock_error"}}, e.response.headers)
+            return
+
+        if not stream:
+            self._send_json(200, result.model_dump(exclude_none=True))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for chunk in result:
+            self.wfile.write(f"data: {chunk.model_dump_json(exclude_none=True)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def _send_json(self, status: int, payload: dict, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        for name in ("retry-after", "retry-after-ms"):
+            if headers and name in headers:
+                self.send_header(name, headers[name])
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f"mock llm: {format % args}")
+
+
+def serve(host: str = "127.0.0.1", port: int = 8800, llm: MockLLM = None) -> ThreadingHTTPServer:
+    """Start the HTTP mock on a background thread, `port` 0 picks a free one"""
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.llm = llm or MockLLM.from_env()
+    threading.Thread(target=server.serve_forever, daemon=True, name="mock-llm").start()
+    logger.info(f"Mock LLM listening on http://{host}:{server.server_address[1]}/v1")
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the mock chat-completions API over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,3 +1,6 @@
+import hashlib
+
+
 class Prompt:
     balance_sheet = """ 
         {balance_sheet}
@@ -36,3 +39,13 @@ class Prompt:
     master = """
         Using the analyses above, compile a comprehensive financial narrative for the retirement home. Explain the story behind the numbers, including causes of variances, trends, and potential risks or opportunities. Provide actionable insights and recommendations based on accurate and verified data. Ensure the narrative is concise and adheres to the client’s preferred paragraph style. Pay extra attention to the Variance Analysis. Output in Markdown format, and try to use at least amount of headers as possible.
     """
+
+
+def prompt_version() -> str:
+    """Hash of every prompt template, so caches can tell when prompts change"""
+    templates = sorted(
+        (name, value)
+        for name, value in vars(Prompt).items()
+        if not name.startswith("_") and isinstance(value, str)
+    )
+    return hashlib.md5(repr(templates).encode()).hexdigest()[:12]
@@ -0,0 +1,204 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import NamedTuple
+
+import numpy as np
+from loguru import logger
+
+
+class Model(NamedTuple):
+    # Provider of the OpenAI-compatible endpoint serving it, see PROVIDERS
+    provider: str
+    # Model id sent to the provider
+    model: str
+    # Seconds per call before giving up on it
+    timeout: float = 120
+
+
+class Route(NamedTuple):
+    # Registered model names, preferred first, the rest are fallbacks
+    models: tuple
+    # Seconds a call may take before falling back, while fallbacks remain.
+    # Models whose recent p95 latency exceeds it are tried last.
+    budget: float = None
+
+
+# OpenAI-compatible endpoints, by name. "base_url" and "api_key_env" are
+# read for anything but "openai" (the default client) and "mock"
+PROVIDERS = {
+    "openai": {},
+    "mock": {},
+}
+
+MODELS = {
+    "gpt-4o": Model("openai", "gpt-4o", timeout=120),
+    "gpt-4o-mini": Model("openai", "gpt-4o-mini", timeout=60),
+}
+
+# Prompt type (the Prompt attribute names) to route. The section analyses
+# only summarise one sheet each, a fast model does; the master narrative
+# is what the reader sees and keeps the strong model
+SECTION_ROUTE = Route(("gpt-4o-mini", "gpt-4o"), budget=45)
+ROUTES = {
+    "balance_sheet": SECTION_ROUTE,
+    "income_statement": SECTION_ROUTE,
+    "revenue": SECTION_ROUTE,
+    "labor": SECTION_ROUTE,
+    "is_month_comparative": SECTION_ROUTE,
+    "master": Route(("gpt-4o", "gpt-4o-mini")),
+    "default": Route(("gpt-4o", "gpt-4o-mini")),
+}
+
+
+class LatencyStats:
+    """
+    Latencies of the last `window` successful calls per model within
+    `max_age` seconds, and the failures in a row since the last success.
+    Old samples age out, so a model demoted for being slow or failing gets
+    tried first again once its bad spell is over.
+    """
+
+    def __init__(self, window: int = 200, max_age: float = 600, cooldown: float = 60):
+        self.window = window
+        self.max_age = max_age
+        self.cooldown = cooldown
+        self.latencies = {}
+        self.calls = {}
+        self.errors = {}
+        self.failing = {}
+        self.last_failure = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, ok: bool = True):
+        now = time.monotonic()
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if ok:
+                self.latencies.setdefault(name, deque(maxlen=self.window)).append((now, seconds))
+                self.failing[name] = 0
+            else:
+                self.errors[name] = self.errors.get(name, 0) + 1
+                self.failing[name] = self.failing.get(name, 0) + 1
+                self.last_failure[name] = now
+
+    def failures(self, name: str) -> int:
+        """Failures in a row, 0 once `cooldown` seconds passed since the last"""
+        with self._lock:
+            if time.monotonic() - self.last_failure.get(name, -np.inf) > self.cooldown:
+                return 0
+            return self.failing.get(name, 0)
+
+    def percentile(self, name: str, q: float, min_samples: int = 1):
+        """q-th percentile of recent latencies of `name`, None with fewer than `min_samples`"""
+        since = time.monotonic() - self.max_age
+        with self._lock:
+            samples = [seconds for at, seconds in self.latencies.get(name, ()) if at >= since]
+        if len(samples) < max(1, min_samples):
+            return None
+        return float(np.percentile(samples, q))
+
+    def summary(self) -> dict:
+        """p50/p90/p95/p99 recent latency, calls and errors per model"""
+        with self._lock:
+            names = list(self.calls)
+        summary = {}
+        for name in names:
+            summary[name] = {
+                "calls": self.calls.get(name, 0),
+                "errors": self.errors.get(name, 0),
+                **{f"p{q}": self.percentile(name, q) for q in (50, 90, 95, 99)},
+            }
+        return summary
+
+
+class Router:
+    """
+    Model registry and routing rules. `candidates` gives the models to try
+    for a prompt type, in order: the route's own order, except that models
+    recently slower than the route's budget or failing repeatedly go last.
+    """
+
+    def __init__(
+        self,
+        models: dict = MODELS,
+        routes: dict = ROUTES,
+        providers: dict = PROVIDERS,
+        min_samples: int = 5,
+        max_failures: int = 3,
+    ):
+        self.models = dict(models)
+        self.routes = dict(routes)
+        self.providers = dict(providers)
+        self.min_samples = min_samples
+        self.max_failures = max_failures
+        self.stats = LatencyStats()
+
+    @classmethod
+    def from_config(cls, path):
+        """
+        Registry and routes extended or overridden from a JSON file:
+        {"providers": {name: {"base_url", "api_key_env"}},
+         "models": {name: {"provider", "model", "timeout"}},
+         "routes": {prompt type: {"models": [...], "budget": seconds}}}
+        """
+        config = json.loads(open(path).read())
+        return cls(
+            models={**MODELS, **{name: Model(**model) for name, model in config.get("models", {}).items()}},
+            routes={
+                **ROUTES,
+                **{
+                    name: Route(tuple(route["models"]), route.get("budget"))
+                    for name, route in config.get("routes", {}).items()
+                },
+            },
+            providers={**PROVIDERS, **config.get("providers", {})},
+        )
+
+    def route(self, prompt_type: str = None) -> Route:
+        return self.routes.get(prompt_type) or self.routes["default"]
+
+    def degraded(self, name: str, budget: float = None) -> bool:
+        if self.stats.failures(name) >= self.max_failures:
+            return True
+        p95 = self.stats.percentile(name, 95, self.min_samples)
+        return budget is not None and p95 is not None and p95 > budget
+
+    def candidates(self, prompt_type: str = None) -> list:
+        """(name, Model, timeout) to try in order for a prompt type"""
+        route = self.route(prompt_type)
+        names = [name for name in route.models if name in self.models]
+        if len(names) < len(route.models):
+            logger.warning(f"Route {prompt_type} names unregistered models, skipped")
+
+        healthy = [name for name in names if not self.degraded(name, route.budget)]
+        ordered = healthy + [name for name in names if name not in healthy]
+
+        candidates = []
+        for i, name in enumerate(ordered):
+            model = self.models[name]
+            timeout = model.timeout
+            # Only wait the budget when something else can still answer
+            if route.budget is not None and i < len(ordered) - 1:
+                timeout = min(timeout, route.budget)
+            candidates.append((name, model, timeout))
+        return candidates
+
+    def record(self, name: str, started: float, ok: bool = True):
+        self.stats.record(name, time.perf_counter() - started, ok)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> Router:
+    """Shared router, configured from the JSON file at LLM_ROUTES if set"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            path = os.getenv("LLM_ROUTES")
+            _router = Router.from_config(path) if path else Router()
+    return _router
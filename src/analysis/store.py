@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from loguru import logger
+
+ROOT = Path(__file__).resolve().parent.parent.parent
+
+
+class SQLiteStore:
+    """
+    A SQLite database shared by every process on the host. WAL mode lets
+    readers and one writer work concurrently, and one short-lived
+    connection per operation keeps a store safe to use from any thread.
+    `schema` statements run once on opening.
+    """
+
+    def __init__(self, path: Path, schema=(), row_factory=None):
+        self.path = Path(path)
+        self.row_factory = row_factory
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in schema:
+                conn.execute(statement)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = self.row_factory
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+class BlobCache(SQLiteStore):
+    """
+    Text or bytes by key in `table`, evicted least recently used first once
+    the values grow past `max_bytes`, and when older than `max_age` seconds
+    if set. Hit and miss counters are kept alongside.
+    """
+
+    COLUMNS = ["key", "value", "size", "created", "last_used"]
+
+    def __init__(self, path: Path, table: str, max_bytes: int, max_age: float = None):
+        self.table = table
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        super().__init__(path)
+        with self._connect() as conn:
+            columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            if columns and columns != self.COLUMNS:
+                # Written by an older layout, a cache can start afresh
+                logger.info(f"Cache table {table} in {self.path} has an old layout, dropping it")
+                conn.execute(f"DROP TABLE {table}")
+            conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {table} (
+                    key TEXT PRIMARY KEY,
+                    value NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    @classmethod
+    def from_env(cls, prefix: str, file_name: str, max_bytes: int, max_age: float = None):
+        """
+        The cache configured by <prefix>_PATH, <prefix>_MAX_BYTES and
+        <prefix>_MAX_AGE, in .cache/`file_name` by default, or None when
+        disabled with <prefix>=0
+        """
+        if os.getenv(prefix, "1") == "0":
+            return None
+
+        if os.getenv(f"{prefix}_MAX_AGE"):
+            max_age = float(os.getenv(f"{prefix}_MAX_AGE"))
+        return cls(
+            os.getenv(f"{prefix}_PATH", ROOT / ".cache" / file_name),
+            max_bytes=int(os.getenv(f"{prefix}_MAX_BYTES", max_bytes)),
+            max_age=max_age,
+        )
+
+    def _count(self, conn, name: str):
+        conn.execute(
+            "INSERT INTO stats VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key: str):
+        """Cached value for `key`, or None on a miss or an expired entry"""
+        now = time.time()
+        oldest = -float("inf") if self.max_age is None else now - self.max_age
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT value FROM {self.table} WHERE key = ? AND created >= ?", (key, oldest)
+            ).fetchone()
+
+            if row is None:
+                self._count(conn, "misses")
+                return None
+
+            conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (now, key))
+            self._count(conn, "hits")
+            return row[0]
+
+    def put(self, key: str, value):
+        now = time.time()
+        size = len(value.encode()) if isinstance(value, str) else len(value)
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?)", (key, value, size, now, now)
+            )
+        self.evict()
+
+    def evict(self) -> int:
+        """Drop expired entries, then least recently used ones over the size cap"""
+        with self._connect() as conn:
+            removed = 0
+            if self.max_age is not None:
+                removed = conn.execute(
+                    f"DELETE FROM {self.table} WHERE created < ?", (time.time() - self.max_age,)
+                ).rowcount
+
+            total = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+            if total > self.max_bytes:
+                stale = []
+                for key, size in conn.execute(f"SELECT key, size FROM {self.table} ORDER BY last_used"):
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((key,))
+                    total -= size
+                conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", stale)
+                removed += len(stale)
+
+        if removed:
+            logger.debug(f"Evicted {removed} entries from {self.table}")
+        return removed
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            stats = dict(conn.execute("SELECT name, value FROM stats"))
+            entries, size = conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}"
+            ).fetchone()
+
+        return {
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM {self.table}")
+            conn.execute("DELETE FROM stats")
@@ -1,8 +1,39 @@
 import os
+import threading
+import time
+import httpx
+import pandas as pd
+import pyarrow.feather as feather
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from openai import OpenAI
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    DefaultHttpxClient,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
 from io import StringIO
 from loguru import logger
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+
+try:
+    from llm_cache import ResponseCache, default_cache
+    from instrument import annotate
+    from mock_llm import MockLLM
+    from router import get_router
+except (ModuleNotFoundError, ImportError):
+    from .llm_cache import ResponseCache, default_cache
+    from .instrument import annotate
+    from .mock_llm import MockLLM
+    from .router import get_router
 
 
 class PATH:
@@ -13,21 +44,324 @@ class PATH:
     data_processed = root / "data" / "processed"
 
 
-# TODO: Add multi model interface support
-def send_prompt(prompt, model: str = "gpt-4o", temperature=0.3):
-    if model in ["gpt-4o", "gpt-4o-mini"]:
-        api_key = os.getenv("OPENAI_API_KEY")
-        client = OpenAI(api_key=api_key)
+BACKENDS = ("openai", "mock")
+
+
+class LLM:
+    # "openai" to call each model's provider, or "mock" to send every call
+    # to the local stand-in of analysis/mock_llm.py
+    backend = os.getenv("LLM_BACKEND", "openai")
+    # Per-call timeout in seconds and attempts per prompt, including the first
+    timeout = float(os.getenv("LLM_TIMEOUT", 120))
+    max_attempts = int(os.getenv("LLM_MAX_ATTEMPTS", 5))
+    # Connections kept open to the API, shared by every thread
+    max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", 20))
+
+
+# Errors worth retrying: rate limits, timeouts, dropped connections and 5xx
+RETRYABLE_ERRORS = (
+    RateLimitError,
+    APITimeoutError,
+    APIConnectionError,
+    InternalServerError,
+)
+
+_clients = {}
+_client_lock = threading.Lock()
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def _new_client(provider: str):
+    if provider == "mock":
+        return MockLLM.from_env()
+
+    # Any other provider is an OpenAI-compatible endpoint
+    settings = get_router().providers.get(provider)
+    if settings is None:
+        raise ValueError(f"Unknown LLM provider {provider}")
+    return OpenAI(
+        api_key=os.getenv(settings.get("api_key_env", "OPENAI_API_KEY")),
+        base_url=settings.get("base_url"),
+        timeout=LLM.timeout,
+        max_retries=0,  # Retries are handled by send_prompt
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=LLM.max_connections,
+                max_keepalive_connections=LLM.max_connections,
+            )
+        ),
+    )
+
+
+def get_client(provider: str = "openai") -> OpenAI:
+    """
+    Module-level client per provider, so every call reuses one pooled HTTP
+    connection pool instead of paying connection and TLS setup per prompt.
+    With LLM_BACKEND=mock every provider is the in-process MockLLM instead.
+    """
+    if LLM.backend != "openai":
+        if LLM.backend not in BACKENDS and LLM.backend not in _clients:
+            raise ValueError(f"Unknown LLM_BACKEND {LLM.backend}, expected one of {BACKENDS}")
+        provider = LLM.backend
+
+    with _client_lock:
+        if _clients.get(provider) is None:
+            _clients[provider] = _new_client(provider)
+        return _clients[provider]
+
+
+def set_client(client, backend: str = "mock"):
+    """
+    Send every call to `client`, e.g. a MockLLM configured in code.
+    Anything with the `chat.completions.create` method of OpenAI works;
+    `backend` names it in the response cache keys. `set_client(None,
+    "openai")` goes back to the real providers.
+    """
+    with _client_lock:
+        _clients[backend] = client
+        LLM.backend = backend
+
+
+def cache_model(model: str, provider: str = "openai") -> str:
+    """Model name in cache keys, qualified unless the answers come from the OpenAI API"""
+    if LLM.backend != "openai":
+        return f"{LLM.backend}:{model}"
+    if provider != "openai":
+        return f"{provider}:{model}"
+    base_url = os.getenv("OPENAI_BASE_URL")
+    return f"{base_url}:{model}" if base_url else model
+
+
+def get_response_cache():
+    """Shared on-disk response cache, None when disabled with LLM_CACHE=0"""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = default_cache() or False
+    return _response_cache or None
+
+
+def retry_after(error) -> float:
+    """Seconds the server asked us to wait, from Retry-After(-ms) headers"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return 0
+
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return 0
+
+
+_backoff = wait_exponential_jitter(initial=1, max=60)
+
+
+def wait_for_retry(retry_state) -> float:
+    """Exponential backoff with jitter, but never sooner than Retry-After"""
+    error = retry_state.outcome.exception()
+    return max(retry_after(error), _backoff(retry_state))
+
+
+def log_retry(retry_state):
+    error = retry_state.outcome.exception()
+    logger.warning(
+        f"LLM call failed ({type(error).__name__}), "
+        f"retry {retry_state.attempt_number}/{LLM.max_attempts - 1} "
+        f"in {retry_state.next_action.sleep:.1f}s"
+    )
+
+
+def _retrying(condition):
+    return retry(
+        retry=condition,
+        wait=wait_for_retry,
+        stop=stop_after_attempt(LLM.max_attempts),
+        before_sleep=log_retry,
+        reraise=True,
+    )
 
-        response = client.chat.completions.create(
-            model=model,
+
+def _complete(provider: str = "openai", **kwargs):
+    return get_client(provider).chat.completions.create(**kwargs)
+
+
+_create_completion = _retrying(retry_if_exception_type(RETRYABLE_ERRORS))(_complete)
+# While another model can answer, a timeout falls back instead of waiting again
+_create_completion_or_fall_back = _retrying(
+    retry_if_exception_type(RETRYABLE_ERRORS) & retry_if_not_exception_type(APITimeoutError)
+)(_complete)
+
+
+def record_usage(usage):
+    """Attach a completion's token usage to the open instrumentation span"""
+    if usage is not None:
+        annotate(
+            llm_calls=1,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+        )
+
+
+def _stream_completion(stream, cache, key, done):
+    """Yield content deltas as they arrive, caching the full text and timing the call at the end"""
+    chunks = []
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+            # Usage comes in a final chunk without choices
+            record_usage(getattr(chunk, "usage", None))
+    except Exception:
+        done(False)
+        raise
+    done(True)
+
+    if cache is not None and chunks:
+        cache.put(key, "".join(chunks))
+
+
+def send_prompt(
+    prompt,
+    model: str = None,
+    temperature=0.3,
+    timeout: float = None,
+    refresh: bool = False,
+    stream: bool = False,
+    route: str = None,
+):
+    """
+    Send a single-message chat prompt. `route` is the prompt type (a Prompt
+    attribute name) whose models are tried in turn, falling back to the
+    next one when a model times out or keeps failing; `model` forces one
+    registered model instead. See analysis/router.py.
+
+    Responses are served from and saved to the shared response cache;
+    `refresh` skips the lookup to force a fresh completion (which then
+    replaces the cached one). Only the preferred model's answer is served,
+    so a fallback's stands in for it no longer than the outage. With
+    `stream` the response comes back as a generator of text chunks instead
+    of a string, so callers can show it while it is produced.
+    """
+    router = get_router()
+    if model is not None:
+        if model not in router.models:
+            logger.error(f"Model {model} not found or supported")
+            return None
+        candidates = [(model, router.models[model], router.models[model].timeout)]
+        preferred = model
+    else:
+        candidates = router.candidates(route)
+        if not candidates:
+            # Rather than a None answer that ends up in the report
+            raise ValueError(f"Route {route or 'default'} names no registered model")
+        # The route's first choice, even while demoted for being slow
+        preferred = next(name for name in router.route(route).models if name in router.models)
+
+    cache = get_response_cache()
+    # Mock answers never mix with real ones in the shared cache
+    keys = {
+        name: ResponseCache.key(cache_model(spec.model, spec.provider), temperature, prompt)
+        for name, spec, _ in candidates
+    }
+    if cache is not None and not refresh:
+        # Only the preferred model's answer: one a fallback gave while it
+        # was down must not outlive the outage. Fallback answers are cached
+        # under their own model, for routes and calls that prefer it
+        cached = cache.get(keys[preferred])
+        if cached is not None:
+            annotate(cache_hits=1)
+            return iter([cached]) if stream else cached
+
+    for i, (name, spec, model_timeout) in enumerate(candidates):
+        last = i == len(candidates) - 1
+        create = _create_completion if last else _create_completion_or_fall_back
+        kwargs = dict(
+            provider=spec.provider,
+            model=spec.model,
             temperature=temperature,
             messages=[{"role": "user", "content": prompt}],
+            # The model's or route's limit, never past the global LLM_TIMEOUT
+            timeout=timeout or min(model_timeout, LLM.timeout),
         )
 
-        return response.choices[0].message.content
-    else:
-        logger.error(f"Model {model} not found or supported")
+        started = time.perf_counter()
+        try:
+            if stream:
+                response = create(stream=True, stream_options={"include_usage": True}, **kwargs)
+            else:
+                response = create(**kwargs)
+        except RETRYABLE_ERRORS as e:
+            router.record(name, started, ok=False)
+            if last:
+                raise
+            logger.warning(f"{name} failed ({type(e).__name__}), falling back to {candidates[i + 1][0]}")
+            annotate(fallbacks=1)
+            continue
+
+        annotate(model=name)
+        if stream:
+            return _stream_completion(
+                response, cache, keys[name], lambda ok: router.record(name, started, ok)
+            )
+
+        router.record(name, started)
+        record_usage(response.usage)
+
+        content = response.choices[0].message.content
+        if cache is not None and content is not None:
+            cache.put(keys[name], content)
+        return content
+
+
+def sheet_path(file_dir, sheet_name: str):
+    """
+    Locate a processed sheet, preferring the Arrow store over a CSV export
+    """
+    for suffix in (".arrow", ".csv"):
+        file_path = Path(file_dir) / f"{sheet_name}{suffix}"
+        if file_path.exists():
+            return file_path
+
+
+def read_sheet(file_path):
+    """
+    Read a processed sheet with the line items as index and float values.
+    Arrow files are memory-mapped, so the values are not copied or parsed.
+    """
+    file_path = Path(file_path)
+    if file_path.suffix != ".arrow":
+        return pd.read_csv(file_path, index_col=0)
+
+    table = feather.read_table(file_path, memory_map=True)
+    line_items = table.column(0).to_numpy(zero_copy_only=False)
+
+    df = table.remove_column(0).to_pandas(split_blocks=True)
+    df.index = pd.Index(line_items, dtype=object)
+    return df
+
+
+def load_sheet(source, sheet_name: str):
+    """
+    Fetch a processed sheet from an in-memory FinancialWorkbook, or from
+    disk when `source` is a processed directory. Returns None if missing.
+    """
+    if isinstance(source, (str, Path)):
+        file_path = sheet_path(source, sheet_name)
+        return None if file_path is None else read_sheet(file_path)
+
+    return source.get(sheet_name)
 
 
 def df_to_csv_text(df):
@@ -0,0 +1,253 @@
+"""
+Generate reports for a batch of facility workbooks without the app:
+
+    python src/batch.py data/raw --out reports
+    python src/batch.py "statements/2024 09 *.xlsx" --workers 4 --llm-concurrency 8
+    python src/batch.py data/raw --sections variance_tables,labor
+
+Each facility goes through the app's report pipeline
+(report.generate_report), driven from a thread of this process: workbooks
+are parsed in a process pool, charts exported on one pool of warm kaleido
+workers, and the LLM calls of every facility share one bounded thread
+pool, so a facility waiting on the LLM holds neither a CPU worker nor more
+than its share of requests. Results go through the same upload cache as
+the app, so an interrupted run picks up where it stopped: finished
+facilities are skipped, processed sheets are reused and answered prompts
+come back from the LLM response cache.
+"""
+
+import argparse
+import glob
+import hashlib
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import pandas as pd
+from loguru import logger
+
+from cache import UploadCache
+from data import ROOT, FinancialWorkbook
+from history import record_history
+from render import Rasterizer, default_figure_cache
+from report import (
+    PDF_CHART_FORMAT,
+    REPORT_STAGES,
+    SECTIONS,
+    generate_report,
+    has_report_artifacts,
+    report_artifacts,
+    save_report_artifacts,
+    section_sheets,
+    select_sections,
+)
+
+STAGES = ("ingest", *REPORT_STAGES)
+
+def _init_worker(log_level: str):
+    logger.remove()
+    logger.add(sys.stderr, level=log_level)
+
+
+def ingest(xlsx_path: Path, folder: Path, sections=None) -> float:
+    """
+    Copy a workbook into its upload cache folder and parse the sheets
+    `sections` need that are not processed yet, returning the seconds taken
+    """
+    start = time.perf_counter()
+    raw_path = folder / "raw" / xlsx_path.name
+    if not raw_path.exists():
+        raw_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(xlsx_path, raw_path)
+
+    FinancialWorkbook.from_upload(folder).load(*section_sheets(sections))
+    return time.perf_counter() - start
+
+
+def write_atomic(path: Path, content: bytes):
+    # An interrupted run never leaves a truncated PDF behind
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+
+
+def collect(patterns) -> list:
+    """Workbooks matched by directories, globs or file paths, in order and without duplicates"""
+    paths = []
+    for pattern in patterns:
+        if Path(pattern).is_dir():
+            matches = sorted(Path(pattern).glob("*.xlsx"))
+        else:
+            matches = [Path(match) for match in sorted(glob.glob(pattern))]
+        # Skip the lock files Excel leaves next to open workbooks
+        paths.extend(path for path in matches if not path.name.startswith("~$"))
+
+    return list(dict.fromkeys(path.resolve() for path in paths))
+
+
+class Facility:
+    def __init__(self, xlsx_path: Path):
+        self.path = xlsx_path
+        self.hash = hashlib.md5(xlsx_path.read_bytes()).hexdigest()
+        self.status = "pending"
+        self.timings = {}
+        self.start = time.perf_counter()
+
+    def summary(self) -> dict:
+        row = {"facility": self.path.name, "status": self.status}
+        for stage in (*STAGES, "total"):
+            row[stage] = self.timings.get(stage, float("nan"))
+        return row
+
+
+def run(paths, out_dir: Path, workers: int, llm_concurrency: int, img_format: str = PDF_CHART_FORMAT, force: bool = False, log_level: str = "INFO", sections=None):
+    """
+    Generate one PDF per workbook into `out_dir`, of `sections` or the full
+    report, returning the per-facility summary. At most `llm_concurrency`
+    LLM calls are in flight at once, whatever the number of facilities.
+    """
+    sections = select_sections(sections)
+    cache = UploadCache(ROOT)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    facilities = [Facility(path) for path in paths]
+
+    # Make room before the run, keeping whatever this batch may reuse
+    cache.collect_garbage(protected={facility.hash for facility in facilities})
+
+    cpu_pool = ProcessPoolExecutor(
+        max_workers=workers,
+        # Spawn rather than fork, the LLM client keeps threads and sockets
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(log_level,),
+    )
+    llm_pool = ThreadPoolExecutor(max_workers=llm_concurrency)
+    rasterizer = Rasterizer(workers=workers, cache=default_figure_cache())
+    # Facilities mostly wait on the pools, enough of them in flight keeps both busy
+    facility_pool = ThreadPoolExecutor(max_workers=workers + llm_concurrency)
+
+    def report(facility, out_path):
+        timings = {}
+
+        def progress(stage, status, seconds=None):
+            if status == "done":
+                timings[stage] = seconds
+
+        folder = cache.folder(facility.hash)
+        # Before ingesting: an upload of an older layout is cleared by the lookup
+        new = cache.lookup(facility.hash) is None
+        timings["ingest"] = cpu_pool.submit(ingest, facility.path, folder, sections).result()
+
+        workbook = FinancialWorkbook.from_upload(folder)
+        if new:
+            cache.add(facility.hash, facility.path.name)
+            record_history(workbook, facility.path.name, facility.hash)
+
+        report = generate_report(
+            workbook,
+            progress=progress,
+            rasterizer=rasterizer,
+            sections=sections,
+            img_format=img_format,
+            llm_pool=llm_pool,
+        )
+        save_report_artifacts(cache, facility.hash, report, sections)
+        write_atomic(out_path, report[-1])
+        return timings
+
+    pending = {}
+    try:
+        seen = {}
+        for facility in facilities:
+            if facility.hash in seen:
+                logger.warning(f"{facility.path.name} has the same content as {seen[facility.hash]}, skipping")
+                facility.status = "duplicate"
+                continue
+            seen[facility.hash] = facility.path.name
+
+            out_path = out_dir / f"{facility.path.stem}.pdf"
+            if not force and cache.lookup(facility.hash) is not None and has_report_artifacts(cache, facility.hash, sections):
+                (pdf_bytes,) = cache.load_artifacts(facility.hash, report_artifacts(sections)[-1])
+                write_atomic(out_path, pdf_bytes)
+                facility.status = "cached"
+                facility.timings["total"] = time.perf_counter() - facility.start
+                continue
+
+            pending[facility_pool.submit(report, facility, out_path)] = facility
+
+        for future in as_completed(pending):
+            facility = pending[future]
+            try:
+                facility.timings = future.result()
+            except Exception:
+                logger.exception(f"{facility.path.name}: report failed")
+                facility.status = "failed"
+                continue
+
+            facility.timings["total"] = time.perf_counter() - facility.start
+            facility.status = "done"
+            logger.info(f"{facility.path.name}: report written in {facility.timings['total']:.1f}s")
+
+    except KeyboardInterrupt:
+        logger.warning("Interrupted, finished reports are kept; rerun to resume")
+        for pool in (facility_pool, llm_pool, cpu_pool):
+            pool.shutdown(wait=False, cancel_futures=True)
+        rasterizer.shutdown()
+        raise
+
+    facility_pool.shutdown()
+    llm_pool.shutdown()
+    cpu_pool.shutdown()
+    rasterizer.shutdown()
+    return [facility.summary() for facility in facilities]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a PDF report per facility workbook")
+    parser.add_argument("inputs", nargs="+", help="Directories, globs or .xlsx files")
+    parser.add_argument("--out", type=Path, default=ROOT / "reports", help="Directory for the PDFs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes for ingestion and for chart export")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="LLM requests in flight at once, across facilities")
+    parser.add_argument("--chart-format", default=PDF_CHART_FORMAT, choices=("png", "svg"))
+    parser.add_argument("--force", action="store_true", help="Regenerate reports that already exist")
+    parser.add_argument(
+        "--sections",
+        help=f"Comma-separated report sections, all by default: {','.join(SECTIONS)}",
+    )
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    paths = collect(args.inputs)
+    if not paths:
+        parser.error("no .xlsx files matched")
+    try:
+        sections = select_sections(args.sections)
+    except ValueError as e:
+        parser.error(str(e))
+
+    start = time.perf_counter()
+    summary = run(
+        paths,
+        args.out,
+        workers=max(1, args.workers),
+        llm_concurrency=max(1, args.llm_concurrency),
+        img_format=args.chart_format,
+        force=args.force,
+        log_level=args.log_level,
+        sections=sections,
+    )
+
+    print(pd.DataFrame(summary).to_string(index=False, float_format="%.2f", na_rep="-"))
+    print(f"{len(summary)} workbooks in {time.perf_counter() - start:.1f}s, reports in {args.out}")
+    return 0 if all(row["status"] in ("done", "cached", "duplicate") for row in summary) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,393 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+
+import plotly.io as pio
+from loguru import logger
+
+from analysis.prompt import prompt_version
+from data import ROOT, sheets
+
+try:
+    import fcntl
+except ImportError:  # Windows, the index is locked with msvcrt instead
+    fcntl = None
+    import msvcrt
+
+# Artifacts that embed LLM output, dropped when the prompts change
+QUALITATIVE_ARTIFACTS = ("qualitative.md", "report.pdf")
+
+
+class Retention:
+    # Total size of uploads/ kept, in bytes, and age in days of the last use
+    # after which an upload goes regardless; 0 disables either limit
+    max_bytes = int(os.getenv("UPLOADS_MAX_BYTES", 5 * 2**30))
+    max_age_days = float(os.getenv("UPLOADS_MAX_AGE_DAYS", 30))
+    # Uploads used this recently are never evicted, they may be mid-processing
+    grace = float(os.getenv("UPLOADS_GRACE", 3600))
+    # Seconds between background collections, 0 to only collect at startup
+    interval = float(os.getenv("UPLOADS_GC_INTERVAL", 3600))
+
+
+def folder_size(path: Path) -> int:
+    """Bytes of every file under `path`"""
+    size = 0
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                size += folder_size(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            continue
+    return size
+
+
+def lock_file(f):
+    """Block until this process holds the exclusive lock of an open file"""
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            # Gives up with OSError after 10 seconds of waiting
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def layout_version() -> str:
+    """Hash of the sheets layout, so cached processed sheets can be invalidated"""
+    return hashlib.md5(json.dumps(sheets, sort_keys=True).encode()).hexdigest()[:12]
+
+
+class UploadCache:
+    """
+    Content-addressed cache of uploads, keyed by the md5 of the workbook.
+
+    Each upload lives in `uploads/<hash>/` with `raw/`, `processed/` and
+    `artifacts/` (tables, charts, narrative and PDF). `uploads/index.json`
+    records the uploads stored and the layout/prompt versions they were
+    built with, so a repeat upload skips straight to the cached results.
+    Processed sheets are filled in as they are used, each recording its own
+    layout (see data.FinancialWorkbook.load).
+    """
+
+    def __init__(self, root_dir: Path):
+        self.root = Path(root_dir) / "uploads"
+        self.index_path = self.root / "index.json"
+        self.lock_path = self.root / "index.lock"
+
+    def folder(self, file_hash: str) -> Path:
+        return self.root / file_hash
+
+    def read_index(self) -> dict:
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def write_index(self, index: dict):
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Write then rename so concurrent readers never see a partial index
+        tmp_path = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    @contextmanager
+    def update_index(self):
+        """
+        The index for a read-modify-write, written back on a clean exit. The
+        app, job workers and batch processes all update it, a lock file
+        serializes them so no update is lost.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "w") as lock:
+            lock_file(lock)
+            try:
+                index = self.read_index()
+                yield index
+                self.write_index(index)
+            finally:
+                unlock_file(lock)
+
+    def _clear(self, file_hash: str):
+        shutil.rmtree(self.folder(file_hash) / "processed", ignore_errors=True)
+        shutil.rmtree(self.folder(file_hash) / "artifacts", ignore_errors=True)
+        (self.folder(file_hash) / "processed").mkdir(parents=True, exist_ok=True)
+
+    def lookup(self, file_hash: str):
+        """
+        Return the index entry if the upload has been processed with the
+        current layout, dropping artifacts built with outdated prompts.
+        """
+        with self.update_index() as index:
+            entry = index.get(file_hash)
+            if entry is None:
+                return None
+
+            if entry.get("layout") != layout_version():
+                logger.info(f"Sheets layout changed, invalidating {file_hash}")
+                index.pop(file_hash)
+                self._clear(file_hash)
+                return None
+
+            if entry.get("prompts") != prompt_version():
+                logger.info(f"Prompts changed, dropping qualitative artifacts of {file_hash}")
+                for name in QUALITATIVE_ARTIFACTS:
+                    # Reports of a selection of sections sit in subfolders
+                    for path in (self.folder(file_hash) / "artifacts").glob(f"**/{name}"):
+                        path.unlink(missing_ok=True)
+                entry["prompts"] = prompt_version()
+
+            entry["last_used"] = time.time()
+            return entry
+
+    def add(self, file_hash: str, file_name: str):
+        """Record an upload once stored, its sheets are processed as they are first used"""
+        now = time.time()
+        with self.update_index() as index:
+            index[file_hash] = {
+                "name": file_name,
+                "created": now,
+                "last_used": now,
+                "layout": layout_version(),
+                "prompts": prompt_version(),
+            }
+
+    def invalidate(self, file_hash: str = None):
+        """Forget one entry, or every entry when no hash is given"""
+        with self.update_index() as index:
+            for key in [file_hash] if file_hash else list(index):
+                index.pop(key, None)
+                self._clear(key)
+
+    def has_upload(self, file_hash: str) -> bool:
+        """Whether the uploaded workbook itself is stored, i.e. not collected since"""
+        raw_dir = self.folder(file_hash) / "raw"
+        return any(not path.name.startswith("~$") for path in raw_dir.glob("*.xls*"))
+
+    def touch(self, file_hash: str):
+        """Mark an upload as used now, keeping it at the back of the eviction order"""
+        with self.update_index() as index:
+            if file_hash in index:
+                index[file_hash]["last_used"] = time.time()
+
+    def collect_garbage(
+        self,
+        max_bytes: int = Retention.max_bytes,
+        max_age: float = Retention.max_age_days * 86400,
+        protected=(),
+        grace: float = Retention.grace,
+    ) -> dict:
+        """
+        Delete upload folders, with their processed sheets and artifacts,
+        last used more than `max_age` seconds ago, then least recently used
+        first until uploads/ fits in `max_bytes`. Folders in `protected`
+        (uploads with a job in flight) or used within `grace` seconds stay.
+        Folders missing from the index, e.g. an upload that failed to
+        process, age from their modification time.
+
+        Returns the folders evicted, the bytes reclaimed and the bytes kept.
+        """
+        if not self.root.exists():
+            return {"evicted": [], "reclaimed": 0, "kept": 0}
+
+        # Victims are picked and moved aside under the index lock, so no
+        # upload is looked up or touched between being picked and going, but
+        # deleted after it, so the app and workers are not kept waiting
+        with self.update_index() as index:
+            now = time.time()
+            folders = []
+            for path in self.root.iterdir():
+                # Skips the trash of other collections
+                if not path.is_dir() or path.name.startswith("."):
+                    continue
+                entry = index.get(path.name, {})
+                last_used = entry.get("last_used", path.stat().st_mtime)
+                folders.append((last_used, path.name, folder_size(path)))
+
+            # Oldest first, the order both limits evict in
+            folders.sort()
+            total = sum(size for _, _, size in folders)
+            protected = set(protected)
+
+            evicted, reclaimed = [], 0
+            trash = None
+            for last_used, file_hash, size in folders:
+                expired = max_age and now - last_used > max_age
+                oversized = max_bytes and total - reclaimed > max_bytes
+                if not (expired or oversized):
+                    continue
+                if file_hash in protected or now - last_used < grace:
+                    continue
+
+                if trash is None:
+                    trash = Path(tempfile.mkdtemp(prefix=".evicted-", dir=self.root))
+                # A rename, so a repeat upload of the hash starts afresh
+                os.replace(self.folder(file_hash), trash / file_hash)
+                index.pop(file_hash, None)
+                evicted.append(file_hash)
+                reclaimed += size
+
+        # This collection's trash, and any left by one that was interrupted
+        for path in self.root.glob(".evicted-*"):
+            shutil.rmtree(path, ignore_errors=True)
+
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} uploads, reclaimed {reclaimed / 2**20:.1f} MiB")
+
+        return {"evicted": evicted, "reclaimed": reclaimed, "kept": total - reclaimed}
+
+    def save_artifacts(self, file_hash: str, artifacts: dict):
+        """
+        Store report artifacts by file name, which may include subfolders.
+        The suffix picks the format: .md text, .pdf bytes, .json Plotly
+        figure, anything else pickled.
+        """
+        artifact_dir = self.folder(file_hash) / "artifacts"
+
+        for name, value in artifacts.items():
+            path = artifact_dir / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if path.suffix == ".md":
+                content = value.encode()
+            elif path.suffix == ".pdf":
+                content = value
+            elif path.suffix == ".json":
+                content = pio.to_json(value).encode()
+            else:
+                content = pickle.dumps(value)
+
+            # Write then rename, an interrupted save never leaves a partial artifact
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_bytes(content)
+            os.replace(tmp_path, path)
+
+    def has_artifacts(self, file_hash: str, *names) -> bool:
+        artifact_dir = self.folder(file_hash) / "artifacts"
+        return all((artifact_dir / name).exists() for name in names)
+
+    def load_artifacts(self, file_hash: str, *names):
+        """Load artifacts saved with save_artifacts, or None if any is missing"""
+        if not self.has_artifacts(file_hash, *names):
+            return None
+
+        artifact_dir = self.folder(file_hash) / "artifacts"
+        paths = [artifact_dir / name for name in names]
+
+        artifacts = []
+        for path in paths:
+            if path.suffix == ".md":
+                artifacts.append(path.read_text())
+            elif path.suffix == ".pdf":
+                artifacts.append(path.read_bytes())
+            elif path.suffix == ".json":
+                artifacts.append(pio.from_json(path.read_text()))
+            else:
+                artifacts.append(pickle.loads(path.read_bytes()))
+        return artifacts
+
+
+class Lease:
+    __slots__ = ("file_hash", "__weakref__")
+
+    def __init__(self, file_hash: str):
+        self.file_hash = file_hash
+
+
+class UploadLeases:
+    """
+    Uploads held by app sessions in this process. A lease lasts as long as
+    the object `hold` returns is referenced, so one kept in session state
+    protects its upload until the session ends, however idle it is. Called
+    for the hashes currently held, as UploadCollector's `protected`.
+    """
+
+    def __init__(self):
+        self._leases = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def hold(self, file_hash: str) -> Lease:
+        lease = Lease(file_hash)
+        with self._lock:
+            self._leases.add(lease)
+        return lease
+
+    def __call__(self) -> set:
+        with self._lock:
+            return {lease.file_hash for lease in self._leases}
+
+
+class UploadCollector:
+    """
+    Runs collect_garbage on an upload cache at startup and then every
+    `interval` seconds on a daemon thread. `protected` is called before each
+    collection for the hashes that must stay, e.g. those of in-flight jobs.
+    """
+
+    def __init__(self, cache: UploadCache, protected=None, interval: float = Retention.interval, **limits):
+        self.cache = cache
+        self.protected = protected or set
+        self.interval = interval
+        self.limits = limits
+        self.reclaimed = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def collect(self) -> dict:
+        try:
+            result = self.cache.collect_garbage(protected=self.protected(), **self.limits)
+        except Exception:
+            # A failed collection only delays the next one
+            logger.exception("Upload garbage collection failed")
+            return None
+        self.reclaimed += result["reclaimed"]
+        return result
+
+    def _run(self):
+        self.collect()
+        while self.interval and not self._stop.wait(self.interval):
+            self.collect()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="upload-gc", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    result = UploadCache(ROOT).collect_garbage()
+    print(
+        f"Evicted {len(result['evicted'])} uploads, reclaimed {result['reclaimed'] / 2**20:.1f} MiB, "
+        f"{result['kept'] / 2**20:.1f} MiB kept"
+    )
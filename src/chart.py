@@ -79,7 +79,21 @@ def total_expense_stack_line(df):
     
     return fig
 
-def sankey_diagram(df, font_size=10):
+def format_value(val):
+    val = int(val) if isinstance(val, (int, float)) else val
+    abs_val = abs(val)
+    if abs_val >= 1_000_000:
+        return f"${abs_val/1_000_000:.1f}M"
+    elif abs_val >= 1_000:
+        return f"${abs_val/1_000:.1f}K"
+    else:
+        return f"${abs_val:.0f}"
+
+def sankey_data(df):
+    """
+    Nodes and links of the revenue and expense flow, computed once and
+    shared by every Sankey figure built from them (display, PDF, ...).
+    """
     # Prepare Sankey data
     labels = (income_sources + ['Total Revenue'] + expenses + 
              ['Operating Income'])
@@ -101,16 +115,6 @@ def sankey_diagram(df, font_size=10):
         [-df.loc[exp].iloc[-1] for exp in expenses]  # Expense values (negative to show outflow)
     )
 
-    def format_value(val):
-        val = int(val) if isinstance(val, (int, float)) else val
-        abs_val = abs(val)
-        if abs_val >= 1_000_000:
-            return f"${abs_val/1_000_000:.1f}M"
-        elif abs_val >= 1_000:
-            return f"${abs_val/1_000:.1f}K"
-        else:
-            return f"${abs_val:.0f}"
-    
     values_ = values.copy()
     values_.insert(len(income_sources), df.loc['Total Revenue'].iloc[-1])
     values_.insert(-1, df.loc['Operating Income'].iloc[-1])
@@ -118,13 +122,23 @@ def sankey_diagram(df, font_size=10):
     for i in range(len(labels)):
         labels[i] = f"{labels[i]} ({format_value(values_[i])})"
 
+    return {
+        "labels": labels,
+        "source": source,
+        "target": target,
+        "values": [abs(v) for v in values],  # Use absolute values for link widths
+        "link_labels": [format_value(v) for v in values],
+    }
+
+def sankey_figure(data, font_size=10):
+    """Sankey figure of the flow computed by sankey_data"""
     # Create Sankey diagram with color differentiation
     fig = go.Figure(data=[go.Sankey(
         node=dict(
             pad=15,
             thickness=20,
             line=dict(color="black", width=0.5),
-            label=labels,
+            label=data["labels"],
             # Color income nodes green, expenses red, and Total Revenue blue
             color=["#009933"] * len(income_sources) + 
                   ["#3f3f3f"] + 
@@ -132,11 +146,11 @@ def sankey_diagram(df, font_size=10):
                   ["#3498db"],
         ),
         link=dict(
-            color=["#efefef"] * len(source),
-            source=source,
-            target=target,
-            value=[abs(v) for v in values],  # Use absolute values for link widths
-            label=[format_value(v) for v in values]
+            color=["#efefef"] * len(data["source"]),
+            source=data["source"],
+            target=data["target"],
+            value=data["values"],
+            label=data["link_labels"]
         ),
         textfont=dict(color="white", size=font_size)
     )])
@@ -146,4 +160,7 @@ def sankey_diagram(df, font_size=10):
         height=800  # Make the diagram taller for better visibility
     )
 
-    return fig
\ No newline at end of file
+    return fig
+
+def sankey_diagram(df, font_size=10):
+    return sankey_figure(sankey_data(df), font_size=font_size)
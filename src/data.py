@@ -1,15 +1,30 @@
+import hashlib
+import json
 import os
+import threading
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
 from datetime import datetime
 from pathlib import Path
 from loguru import logger
+from openpyxl import load_workbook
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+from openpyxl.utils import column_index_from_string
+from pandas.io.parsers import TextParser
+
+from analysis.instrument import span
 
 ROOT = Path(__file__).resolve().parent.parent
 
 data_dir = ROOT / "data"
 xlsx_path = data_dir / "raw" / "2024 09 Harrisburg Opco Financial Statements.xlsx"
 
+# Name of the line-item column in the processed store
+LINE_ITEM = "Line Item"
+# Key of the layout a sheet was sliced with, in its Arrow schema metadata
+LAYOUT_KEY = b"layout"
 
 sheets = {
     "Census & Revenue Trend": [[7, 12], ["A", "N"]],
@@ -26,32 +41,110 @@ sheets = {
 }
 
 
-def xlsx2df(rows: str, columns: str, sheet_name: str, xlsx_path=xlsx_path):
-    df = pd.read_excel(
-        xlsx_path,
-        sheet_name=sheet_name,
-        header=None,
-        skiprows=rows[0] - 1,  # From row 7 (0 - 6)
-        nrows=rows[1] - rows[0] + 1,  # To row 12 (7-12)
-        usecols=f"{columns[0]}:{columns[1]}",
-    )
+def _convert_cell(cell):
+    """Convert an openpyxl cell the same way pd.read_excel does"""
+    if cell.value is None:
+        return ""
+    elif cell.data_type == TYPE_ERROR:
+        return np.nan
+    elif cell.data_type == TYPE_NUMERIC:
+        value = int(cell.value)
+        return value if value == cell.value else float(cell.value)
+
+    return cell.value
+
+
+def _sheet_data(worksheet, max_row: int):
+    """Stream the first `max_row` rows, trimmed and padded like pd.read_excel"""
+    worksheet.reset_dimensions()
+
+    data = []
+    last_row_with_data = -1
+    for row_number, row in enumerate(worksheet.iter_rows(max_row=max_row)):
+        converted_row = [_convert_cell(cell) for cell in row]
+        # Trim trailing empty cells
+        while converted_row and converted_row[-1] == "":
+            converted_row.pop()
+        if converted_row:
+            last_row_with_data = row_number
+        data.append(converted_row)
 
-    df = df.astype(str)
+    # Trim trailing empty rows then extend rows to max width
+    data = data[: last_row_with_data + 1]
+    if data:
+        max_width = max(len(row) for row in data)
+        data = [row + [""] * (max_width - len(row)) for row in data]
 
-    df = df.map(lambda x: x.strip() if isinstance(x, str) else x)
+    return data
 
-    # Remove empty
-    df = df[~df.apply(lambda row: row.str.strip().eq("").all(), axis=1)]
 
-    # Remove repeated
-    df = df[~df.apply(lambda row: row.nunique() <= 1, axis=1)]
+def read_workbook(xlsx_path=xlsx_path, sheet_map: dict = sheets) -> dict:
+    """
+    Open the workbook once and slice every configured range from it.
+
+    Returns raw (uncleaned) frames keyed by sheet name, identical to what
+    pd.read_excel would give for each range.
+    """
+    workbook = load_workbook(xlsx_path, read_only=True, data_only=True, keep_links=False)
+
+    frames = {}
+    try:
+        for sheet_name, (rows, columns) in sheet_map.items():
+            with span("ingest.read", sheet=sheet_name):
+                data = _sheet_data(workbook[sheet_name], rows[1])
+                first, last = (column_index_from_string(column) for column in columns)
+
+                frames[sheet_name] = TextParser(
+                    data,
+                    header=None,
+                    skiprows=rows[0] - 1,  # From row 7 (0 - 6)
+                    nrows=rows[1] - rows[0] + 1,  # To row 12 (7-12)
+                    usecols=list(range(first - 1, last)),
+                    skip_blank_lines=False,
+                ).read()
+    finally:
+        workbook.close()
+
+    return frames
+
+
+def clean_frame(df):
+    """
+    Strip text cells and drop blank, repeated and near-empty rows.
+
+    Works column-wise on the native dtypes, so numbers stay numbers and
+    no per-cell or per-row Python callbacks are involved.
+    """
+    df = df.copy()
+
+    # Strip whitespace from text cells only, the .str methods leave NaN for the rest
+    for i in np.flatnonzero(df.dtypes.to_numpy() == object):
+        column = df.iloc[:, i]
+        if pd.api.types.infer_dtype(column, skipna=True) not in ("string", "mixed", "mixed-integer"):
+            continue
+        stripped = column.str.strip()
+        is_text = stripped.notna().to_numpy()
+        df.iloc[is_text, i] = stripped[is_text]
 
     df = df.replace("nan", np.nan)
 
+    # Remove empty and repeated, i.e. rows where every cell matches the first
+    first = df.iloc[:, 0]
+    same = df.eq(first, axis=0).to_numpy() | (
+        df.isna().to_numpy() & first.isna().to_numpy()[:, None]
+    )
+    df = df[~same.all(axis=1)]
+
     # TODO: Deal with threshold values
     return df.dropna(axis=0, thresh=2)
 
 
+def xlsx2df(rows: str, columns: str, sheet_name: str, xlsx_path=xlsx_path):
+    df = read_workbook(xlsx_path, {sheet_name: [rows, columns]})[sheet_name]
+
+    return clean_frame(df)
+
+
 def convert_date(date):
     try:
         date = datetime.strptime(date, "%m/%d/%Y")
@@ -78,97 +171,257 @@ def rename_columns(df, num_rows=2):
     return df
 
 
-def process_uploaded_file(uploaded_file, upload_dir: Path):
-    # logger.debug(f"Processing {uploaded_file} uploaded file")
+def format_sheet(sheet_name: str, df):
+    if sheet_name in ["Census & Revenue Trend", "Income Statement T-12"]:
+        # Remove "Month Ending"
+        df = df.iloc[1:]
 
-    xlsx_path = upload_dir / "raw" / uploaded_file.name
-    with open(xlsx_path, "wb") as f:
-        f.write(uploaded_file.getvalue())
+        # Change from mm/dd/yyyy to mmmm/yyyy
+        # logger.debug(sheet_name)
+        # logger.debug(df.columns)
+        # Also make the first line to column names
+        df.columns = df.iloc[0].astype(str)
+        # First row is still date
+        df.columns = [convert_date(column) for column in df.columns]
 
-    # Process each sheet
-    for sheet_name, (rows, columns) in sheets.items():
-        df = xlsx2df(rows, columns, sheet_name, xlsx_path=xlsx_path)
+        # Annotate last column to YTD
+        df.columns = df.columns[:-1].tolist() + [f"{df.columns[-1]} YTD"]
+        # logger.debug(df.head())
 
-        if sheet_name in ["Census & Revenue Trend", "Income Statement T-12"]:
-            # Remove "Month Ending"
-            df = df.iloc[1:]
+        # Remove "Actual" row and "Census" row because there only one
+        df = df.iloc[4:]
 
-            # Change from mm/dd/yyyy to mmmm/yyyy
-            # logger.debug(sheet_name)
-            # logger.debug(df.columns)
-            # Also make the first line to column names
-            df.columns = df.iloc[0].astype(str)
-            # First row is still date
-            df.columns = [convert_date(column) for column in df.columns]
+    elif sheet_name == "Balance Sheet":
+        df = rename_columns(df, num_rows=2)
+        # logger.debug(df.head())
 
-            # Annotate last column to YTD
-            df.columns = df.columns[:-1].tolist() + [f"{df.columns[-1]} YTD"]
-            # logger.debug(df.head())
+    elif sheet_name in [
+        "IS Month Comparative",
+        "IS Month Comparative Detailed",
+        "Revenue Detailed",
+        "Labor",
+    ]:
+        df = rename_columns(df, num_rows=3)
 
-            # Remove "Actual" row and "Census" row because there only one
-            df = df.iloc[4:]
+        # logger.debug(df.head())
 
-        elif sheet_name == "Balance Sheet":
-            df = rename_columns(df, num_rows=2)
-            # logger.debug(df.head())
+    else:
+        logger.warning(f"Sheet {sheet_name} not processed")
 
-        elif sheet_name in [
-            "IS Month Comparative",
-            "IS Month Comparative Detailed",
-            "Revenue Detailed",
-            "Labor",
-        ]:
-            df = rename_columns(df, num_rows=3)
+    return df
 
-            # logger.debug(df.head())
 
-        else:
-            logger.warning(f"Sheet {sheet_name} not processed")
+def dedup_columns(columns) -> list:
+    """Suffix repeated column names with .1, .2, ... the way pd.read_csv does"""
+    seen = set()
+    names = []
+    for name in map(str, columns):
+        candidate, i = name, 0
+        while candidate in seen:
+            i += 1
+            candidate = f"{name}.{i}"
+        seen.add(candidate)
+        names.append(candidate)
+    return names
+
+
+def to_typed(df):
+    """
+    Turn a formatted sheet into its typed form: the first column becomes a
+    string line-item index and every other column float64.
+    """
+    values = df.iloc[:, 1:].apply(pd.to_numeric, errors="coerce").astype("float64")
+    values.columns = dedup_columns(values.columns)
+    values.index = pd.Index(df.iloc[:, 0].astype(str).to_numpy(dtype=object))
+    return values
+
+
+def sheet_layout(sheet_spec) -> str:
+    """Hash of the rows and columns a sheet is sliced with, as in `sheets`"""
+    return hashlib.md5(json.dumps(sheet_spec).encode()).hexdigest()[:12]
+
+
+def stored_layout(file_path: Path):
+    """Layout a processed sheet was written with, None for CSV exports and older files"""
+    if Path(file_path).suffix != ".arrow":
+        return None
+    # Only the footer is read, not the values
+    with pa.memory_map(str(file_path)) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    layout = metadata.get(LAYOUT_KEY)
+    return None if layout is None else layout.decode()
+
+
+def save_sheet(df, processed_dir: Path, sheet_name: str, layout: str = None):
+    """
+    Write a typed sheet to the columnar store, recording the `layout` it
+    was sliced with if given.
+
+    NaN is kept as a value rather than a null, so the file can be
+    memory-mapped back without copying.
+    """
+    table = pa.Table.from_arrays(
+        [pa.array(df.index.to_numpy(dtype=object), pa.string())]
+        + [pa.array(df.iloc[:, i].to_numpy()) for i in range(df.shape[1])],
+        names=[LINE_ITEM] + list(df.columns),
+    )
+    if layout is not None:
+        table = table.replace_schema_metadata({LAYOUT_KEY: layout})
+    file_path = processed_dir / f"{sheet_name}.arrow"
+    # Write then rename, other processes may be memory-mapping the store
+    tmp_path = file_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    feather.write_feather(table, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, file_path)
+
+    return file_path
+
+
+class FinancialWorkbook:
+    """
+    The processed sheets of one upload, as typed frames. Sheets are parsed
+    on first use and kept in memory: read from the processed store when it
+    has them, otherwise sliced out of the raw workbook and written to the
+    store for next time. Analysis and chart code take this instead of
+    re-reading the processed directory.
+    """
+
+    def __init__(self, frames: dict = None, path: Path = None, xlsx_path: Path = None, sheet_map: dict = sheets):
+        self.frames = dict(frames or {})
+        # Processed directory backing this workbook, if it has been saved
+        self.path = None if path is None else Path(path)
+        # Raw workbook the sheets missing from the store are parsed from
+        self.xlsx_path = None if xlsx_path is None else Path(xlsx_path)
+        self.sheet_map = sheet_map
+        self.missing = set()
+        # Sections analyse concurrently, a sheet is still parsed only once
+        self._lock = threading.RLock()
+
+    def __getitem__(self, sheet_name: str):
+        frame = self.get(sheet_name)
+        if frame is None:
+            raise KeyError(sheet_name)
+        return frame
+
+    def __contains__(self, sheet_name: str):
+        return self.get(sheet_name) is not None
+
+    def get(self, sheet_name: str):
+        if sheet_name not in self.frames:
+            self.load(sheet_name)
+        return self.frames.get(sheet_name)
+
+    @property
+    def sheet_names(self) -> list:
+        """Sheets this workbook has or can load, parsed yet or not"""
+        from analysis.utils import sheet_path
+
+        names = list(self.frames)
+        if self.xlsx_path is not None:
+            names += list(self.sheet_map)
+        elif self.path is not None:
+            names += [name for name in self.sheet_map if sheet_path(self.path, name) is not None]
+        return [name for name in dict.fromkeys(names) if name not in self.missing]
+
+    def load(self, *sheet_names):
+        """
+        Parse `sheet_names`, or every sheet of the map, unless already in
+        memory. Those not in the processed store, or stored with another
+        layout than the map's, are read from the raw workbook in a single
+        pass over it.
+        """
+        from analysis.utils import read_sheet, sheet_path
+
+        with self._lock:
+            to_parse = []
+            for sheet_name in sheet_names or self.sheet_map:
+                if sheet_name in self.frames or sheet_name in self.missing:
+                    continue
+
+                file_path = None if self.path is None else sheet_path(self.path, sheet_name)
+                if file_path is not None and self._outdated(sheet_name, file_path):
+                    logger.info(f"Sheet {sheet_name} in {self.path} has an outdated layout, parsing it again")
+                    file_path = None
+                if file_path is not None:
+                    self.frames[sheet_name] = read_sheet(file_path)
+                elif self.xlsx_path is not None and sheet_name in self.sheet_map:
+                    to_parse.append(sheet_name)
+                else:
+                    if self.path is not None or self.xlsx_path is not None:
+                        logger.warning(f"Sheet {sheet_name} not found in {self.path or self.xlsx_path}")
+                    self.missing.add(sheet_name)
+
+            if to_parse:
+                self._parse(to_parse)
+
+        return self
+
+    def _outdated(self, sheet_name: str, file_path: Path) -> bool:
+        # Without the raw workbook a stored sheet is the best there is
+        if self.xlsx_path is None or sheet_name not in self.sheet_map:
+            return False
+        return stored_layout(file_path) != sheet_layout(self.sheet_map[sheet_name])
+
+    def _parse(self, sheet_names: list):
+        raw = read_workbook(self.xlsx_path, {sheet_name: self.sheet_map[sheet_name] for sheet_name in sheet_names})
+        frames = {}
+        for sheet_name, df in raw.items():
+            with span("ingest.clean", sheet=sheet_name):
+                frames[sheet_name] = to_typed(format_sheet(sheet_name, clean_frame(df)))
+
+        if self.path is not None:
+            with span("ingest.save", sheets=len(frames)):
+                for sheet_name, df in frames.items():
+                    save_sheet(df, self.path, sheet_name, sheet_layout(self.sheet_map[sheet_name]))
+        self.frames.update(frames)
+
+    @classmethod
+    def from_xlsx(cls, xlsx_path=xlsx_path, sheet_map: dict = sheets):
+        # Read every sheet in a single pass over the workbook
+        return cls(xlsx_path=xlsx_path, sheet_map=sheet_map).load()
+
+    @classmethod
+    def from_dir(cls, processed_dir: Path, sheet_map: dict = sheets, xlsx_path: Path = None):
+        """Sheets of a processed directory, read as they are used"""
+        return cls(path=processed_dir, xlsx_path=xlsx_path, sheet_map=sheet_map)
+
+    @classmethod
+    def from_upload(cls, folder: Path, sheet_map: dict = sheets):
+        """
+        Sheets of an upload folder: the processed store, filled in from the
+        workbook in raw/ as sheets are first used
+        """
+        folder = Path(folder)
+        (folder / "processed").mkdir(parents=True, exist_ok=True)
+        # Skip the lock files Excel leaves next to open workbooks
+        xlsx_paths = sorted(path for path in (folder / "raw").glob("*.xls*") if not path.name.startswith("~$"))
+        return cls.from_dir(folder / "processed", sheet_map, xlsx_paths[0] if xlsx_paths else None)
+
+    def save(self, processed_dir: Path, export_csv: bool = False):
+        self.load()
+        with span("ingest.save", sheets=len(self.frames)):
+            for sheet_name, df in self.frames.items():
+                layout = sheet_layout(self.sheet_map[sheet_name]) if sheet_name in self.sheet_map else None
+                save_sheet(df, processed_dir, sheet_name, layout)
+                if export_csv:
+                    df.to_csv(processed_dir / f"{sheet_name}.csv")
+
+        self.path = Path(processed_dir)
+        return self
+
+
+def process_uploaded_file(
+    uploaded_file, upload_dir: Path, export_csv: bool = False, sheet_map: dict = sheets
+):
+    # logger.debug(f"Processing {uploaded_file} uploaded file")
 
-        # Save to processed directory
-        df.to_csv(upload_dir / "processed" / f"{sheet_name}.csv", index=False)
+    xlsx_path = upload_dir / "raw" / uploaded_file.name
+    with open(xlsx_path, "wb") as f:
+        f.write(uploaded_file.getvalue())
 
-    return upload_dir
+    # Save to processed directory
+    workbook = FinancialWorkbook.from_xlsx(xlsx_path, sheet_map)
+    return workbook.save(upload_dir / "processed", export_csv=export_csv)
 
 
 if __name__ == "__main__":
-    for sheet_name, (rows, columns) in sheets.items():
-        df = xlsx2df(rows, columns, sheet_name)
-
-        if sheet_name in ["Census & Revenue Trend", "Income Statement T-12"]:
-            # Remove "Month Ending"
-            df = df.iloc[1:]
-
-            # Change from mm/dd/yyyy to mmmm/yyyy
-            # logger.debug(sheet_name)
-            # logger.debug(df.columns)
-            # Also make the first line to column names
-            df.columns = df.iloc[0].astype(str)
-            # First row is still date
-            df.columns = [convert_date(column) for column in df.columns]
-
-            # Annotate last column to YTD
-            df.columns = df.columns[:-1].tolist() + [f"{df.columns[-1]} YTD"]
-            # logger.debug(df.head())
-
-            # Remove "Actual" row and "Census" row because there only one
-            df = df.iloc[4:]
-
-        elif sheet_name == "Balance Sheet":
-            df = rename_columns(df, num_rows=2)
-            logger.debug(df.head())
-
-        elif sheet_name in [
-            "IS Month Comparative",
-            "IS Month Comparative Detailed",
-            "Revenue Detailed",
-            "Labor",
-        ]:
-            df = rename_columns(df, num_rows=3)
-
-            logger.debug(df.head())
-
-        else:
-            logger.warning(f"Sheet {sheet_name} not processed")
-
-        df.to_csv(data_dir / "processed" / f"{sheet_name}.csv", index=False)
+    FinancialWorkbook.from_xlsx().save(data_dir / "processed", export_csv=True)
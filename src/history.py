@@ -0,0 +1,252 @@
+import os
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from analysis.store import SQLiteStore
+from data import ROOT
+
+# Sheets with one column per month, kept month by month across uploads
+MONTHLY_SHEETS = ("Income Statement T-12", "Census & Revenue Trend")
+
+KEYS = ["sheet", "line_item", "occurrence", "month"]
+
+
+def parse_month(column: str):
+    """"October/2023" -> "2023-10", None for other columns such as the YTD total"""
+    try:
+        return datetime.strptime(column, "%B/%Y").strftime("%Y-%m")
+    except ValueError:
+        return None
+
+
+def month_label(month: str) -> str:
+    """"2023-10" -> "October/2023", the column name used in the sheets"""
+    return datetime.strptime(month, "%Y-%m").strftime("%B/%Y")
+
+
+def facility_name(file_name: str) -> str:
+    """Facility of a statements file, "2024 09 Harrisburg Opco Financial Statements.xlsx" -> "Harrisburg Opco" """
+    name = Path(file_name).stem
+    name = re.sub(r"^\d{4}[ _-]\d{1,2}[ _-]+", "", name)
+    name = re.sub(r"[ _-]*Financial Statements?$", "", name, flags=re.IGNORECASE)
+    return name.strip() or Path(file_name).stem
+
+
+def statement_month(file_name: str):
+    """Month of a statements file, "2024 09 Harrisburg ..." -> "2024-09", None without a date prefix"""
+    match = re.match(r"^(\d{4})[ _-](\d{1,2})[ _-]", Path(file_name).stem)
+    return None if match is None else f"{match[1]}-{int(match[2]):02}"
+
+
+def to_long(workbook, sheet_names=MONTHLY_SHEETS) -> pd.DataFrame:
+    """Monthly sheets of a workbook as one row per sheet, line item and month"""
+    frames = []
+    for sheet_name in sheet_names:
+        df = workbook.get(sheet_name)
+        if df is None:
+            continue
+
+        months = {column: parse_month(column) for column in df.columns}
+        df = df[[column for column, month in months.items() if month]]
+        values = df.to_numpy(dtype="float64")
+        rows, cols = values.shape
+
+        frames.append(
+            pd.DataFrame(
+                {
+                    "sheet": sheet_name,
+                    "line_item": np.repeat(df.index.to_numpy(dtype=object), cols),
+                    # Repeated labels, e.g. a section header and its row, stay apart
+                    "occurrence": np.repeat(df.groupby(level=0, sort=False).cumcount().to_numpy(), cols),
+                    "month": np.tile([months[column] for column in df.columns], rows),
+                    "value": values.ravel(),
+                    "position": np.repeat(np.arange(rows), cols),
+                }
+            )
+        )
+
+    if not frames:
+        return pd.DataFrame(columns=[*KEYS, "value", "position"])
+    return pd.concat(frames, ignore_index=True)
+
+
+class HistoryStore(SQLiteStore):
+    """
+    Month by month history of every facility's monthly sheets, keyed by
+    facility, sheet, line item and month. Each workbook repeats eleven
+    months already seen, so an upload only writes the months that are new
+    or whose values changed, and analyses read multi-year windows straight
+    from the store instead of re-parsing old workbooks.
+    """
+
+    def __init__(self, path: Path):
+        super().__init__(
+            path,
+            schema=(
+                """CREATE TABLE IF NOT EXISTS history (
+                    facility TEXT NOT NULL,
+                    sheet TEXT NOT NULL,
+                    line_item TEXT NOT NULL,
+                    occurrence INTEGER NOT NULL,
+                    month TEXT NOT NULL,
+                    value REAL,
+                    position INTEGER NOT NULL,
+                    source TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (facility, sheet, line_item, occurrence, month)
+                ) WITHOUT ROWID""",
+                "CREATE INDEX IF NOT EXISTS history_month ON history (facility, sheet, month)",
+            ),
+        )
+
+    def upsert(self, workbook, facility: str, source: str = None) -> dict:
+        """
+        Store the months of `workbook` that are new or changed for
+        `facility`. Returns how many values were new, changed and unchanged.
+        """
+        incoming = to_long(workbook)
+        if incoming.empty:
+            return {"new": 0, "changed": 0, "unchanged": 0}
+        months = sorted(incoming["month"].unique())
+
+        with self._connect() as conn:
+            existing = pd.read_sql_query(
+                f"""SELECT sheet, line_item, occurrence, month, value AS stored FROM history
+                WHERE facility = ? AND month IN ({", ".join("?" * len(months))})""",
+                conn,
+                params=[facility, *months],
+            )
+            merged = incoming.merge(existing, on=KEYS, how="left", indicator=True)
+
+            new = merged["_merge"] == "left_only"
+            same = (merged["value"] == merged["stored"]) | (merged["value"].isna() & merged["stored"].isna())
+            delta = merged[new | ~same]
+
+            now = time.time()
+            conn.executemany(
+                """INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (facility, sheet, line_item, occurrence, month) DO UPDATE SET
+                    value = excluded.value,
+                    position = excluded.position,
+                    source = excluded.source,
+                    updated = excluded.updated""",
+                (
+                    (facility, sheet, line_item, int(occurrence), month,
+                     None if np.isnan(value) else float(value), int(position), source, now)
+                    for sheet, line_item, occurrence, month, value, position in delta[
+                        [*KEYS, "value", "position"]
+                    ].itertuples(index=False)
+                ),
+            )
+
+        counts = {
+            "new": int(new.sum()),
+            "changed": int((~new & ~same).sum()),
+            "unchanged": int((~new & same).sum()),
+        }
+        logger.info(f"History of {facility}: {counts['new']} new, {counts['changed']} changed values")
+        return counts
+
+    def facilities(self) -> list:
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT facility FROM history ORDER BY facility")]
+
+    def months(self, facility: str, sheet: str = MONTHLY_SHEETS[0]) -> list:
+        with self._connect() as conn:
+            return [
+                row[0]
+                for row in conn.execute(
+                    "SELECT DISTINCT month FROM history WHERE facility = ? AND sheet = ? ORDER BY month",
+                    (facility, sheet),
+                )
+            ]
+
+    def query(self, sheet: str = MONTHLY_SHEETS[0], facilities=None, start: str = None, end: str = None) -> pd.DataFrame:
+        """Stored values in long form, for some or all facilities and months "YYYY-MM" from start to end"""
+        conditions, params = ["sheet = ?"], [sheet]
+        if facilities is not None:
+            conditions.append(f"facility IN ({', '.join('?' * len(facilities))})")
+            params.extend(facilities)
+        if start is not None:
+            conditions.append("month >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("month <= ?")
+            params.append(end)
+
+        with self._connect() as conn:
+            return pd.read_sql_query(
+                f"""SELECT facility, line_item, occurrence, month, value, position FROM history
+                WHERE {" AND ".join(conditions)}""",
+                conn,
+                params=params,
+            )
+
+    def window(self, facility: str, sheet: str = MONTHLY_SHEETS[0], start: str = None, end: str = None) -> pd.DataFrame:
+        """
+        One facility's sheet over any range of months, laid out like the
+        processed sheet: line items as index, one "October/2023" column per month.
+        """
+        rows = self.query(sheet, [facility], start, end).sort_values("month")
+        keys = ["line_item", "occurrence"]
+
+        df = rows.pivot(index=keys, columns="month", values="value")
+        # Row order of the most recent upload covering each line item
+        order = rows.groupby(keys, sort=False)["position"].last().reindex(df.index)
+        df = df.iloc[np.argsort(order.to_numpy(), kind="stable")]
+
+        df.columns = [month_label(month) for month in df.columns]
+        df.index = pd.Index(df.index.get_level_values("line_item"), dtype=object)
+        return df
+
+    def t12(self, facility: str, end: str = None, sheet: str = MONTHLY_SHEETS[0]) -> pd.DataFrame:
+        """
+        Trailing twelve months ending at `end` (default the latest) with the
+        calendar year-to-date column, in the layout of the uploaded T-12 sheet.
+        """
+        end = end or self.months(facility, sheet)[-1]
+        year, month = map(int, end.split("-"))
+        start = f"{year - 1}-{month + 1:02}" if month < 12 else f"{year}-01"
+
+        df = self.window(facility, sheet, start, end)
+        year_columns = [column for column in df.columns if column.endswith(f"/{year}")]
+        df[f"{month_label(end)} YTD"] = df[year_columns].sum(axis=1, min_count=1)
+        return df
+
+
+def default_history():
+    """The shared history store, or None when disabled with HISTORY=0"""
+    if os.getenv("HISTORY", "1") == "0":
+        return None
+
+    return HistoryStore(os.getenv("HISTORY_PATH", ROOT / "data" / "history.sqlite"))
+
+
+def record_history(workbook, file_name: str, file_hash: str = None):
+    """Add a freshly ingested workbook to the history store, if enabled"""
+    try:
+        history = default_history()
+        if history is None:
+            return None
+        return history.upsert(workbook, facility_name(file_name), source=file_hash)
+    except Exception:
+        # History is a by-product of ingestion, never fail an upload over it,
+        # be it the store or an unexpected month layout
+        logger.exception(f"Could not record {file_name} in the history store")
+        return None
+
+
+if __name__ == "__main__":
+    from data import FinancialWorkbook, xlsx_path
+
+    history = default_history()
+    history.upsert(FinancialWorkbook.from_xlsx(xlsx_path), facility_name(xlsx_path.name))
+    for facility in history.facilities():
+        print(facility, history.months(facility))
+        print(history.t12(facility).loc[["Total Revenue", "Operating Income"]])
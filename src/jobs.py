@@ -0,0 +1,314 @@
+"""
+Background report jobs, so generating a report does not tie up a Streamlit
+script run and survives a browser refresh.
+
+Jobs live in a SQLite queue shared by every process on the host. Worker
+processes claim them one at a time, record the progress of each stage and
+save the report in the upload cache, where the app (or any later session)
+picks it up by upload hash. A job may be limited to some report sections.
+Submitting an upload and selection that already has a queued, running or
+finished job returns that job instead of starting another.
+"""
+
+import json
+import multiprocessing as mp
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import psutil
+from loguru import logger
+
+from analysis.instrument import tracing
+from analysis.store import SQLiteStore
+from cache import UploadCache
+from data import ROOT, FinancialWorkbook
+from history import record_history
+from render import Rasterizer, default_figure_cache
+from report import REPORT_STAGES, generate_report, save_report_artifacts, section_sheets, selection_key
+
+STAGES = ("ingest", *REPORT_STAGES)
+
+ACTIVE = ("queued", "running")
+
+# Runs of a job cut short by a dead worker before it is given up on
+MAX_ATTEMPTS = 3
+
+
+class JobQueue(SQLiteStore):
+    """
+    SQLite-backed queue of report jobs, one row per job. At most one job per
+    upload hash and selection of sections is queued or running at any time,
+    enforced by the database so concurrent sessions cannot both start one.
+    `sections` holds the selection_key, "" for the full report.
+    """
+
+    def __init__(self, path: Path):
+        super().__init__(
+            path,
+            schema=(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    file_hash TEXT NOT NULL,
+                    file_name TEXT,
+                    sections TEXT NOT NULL DEFAULT '',
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    stages TEXT NOT NULL DEFAULT '{}',
+                    error TEXT,
+                    worker INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL
+                )""",
+            ),
+            row_factory=sqlite3.Row,
+        )
+        with self._connect() as conn:
+            if "sections" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                # Queue created before reports could be limited to some sections
+                conn.execute("ALTER TABLE jobs ADD COLUMN sections TEXT NOT NULL DEFAULT ''")
+                conn.execute("DROP INDEX IF EXISTS jobs_active")
+            conn.execute(
+                """CREATE UNIQUE INDEX IF NOT EXISTS jobs_active ON jobs (file_hash, sections)
+                WHERE status IN ('queued', 'running')"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_hash ON jobs (file_hash, created)")
+
+    @staticmethod
+    def _job(row) -> dict:
+        if row is None:
+            return None
+        job = dict(row)
+        job["stages"] = json.loads(job["stages"])
+        return job
+
+    def submit(self, file_hash: str, file_name: str = None, force: bool = False, sections=None) -> str:
+        """
+        Queue a report of `sections`, every one by default, for an upload,
+        returning the job id. An upload with a queued or running job of the
+        same sections, or a finished one (unless `force`), gets that job's
+        id back instead.
+        """
+        key = selection_key(sections)
+        with self._connect() as conn:
+            if not force:
+                row = conn.execute(
+                    """SELECT id FROM jobs WHERE file_hash = ? AND sections = ? AND status IN ('queued', 'running', 'done')
+                    ORDER BY status = 'done', created DESC LIMIT 1""",
+                    (file_hash, key),
+                ).fetchone()
+                if row is not None:
+                    return row["id"]
+
+            job_id = uuid.uuid4().hex[:12]
+            # Ignored if another job for the upload became active meanwhile
+            conn.execute(
+                """INSERT OR IGNORE INTO jobs (id, file_hash, file_name, sections, status, created)
+                VALUES (?, ?, ?, ?, 'queued', ?)""",
+                (job_id, file_hash, file_name, key, time.time()),
+            )
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE file_hash = ? AND sections = ? AND status IN ('queued', 'running')",
+                (file_hash, key),
+            ).fetchone()
+
+        if row["id"] == job_id:
+            logger.info(f"Job {job_id} queued for {file_name or file_hash}")
+        return row["id"]
+
+    def get(self, job_id: str) -> dict:
+        with self._connect() as conn:
+            return self._job(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def latest(self, file_hash: str, sections=None) -> dict:
+        """Most recent job of an upload and selection of sections, or None"""
+        with self._connect() as conn:
+            return self._job(
+                conn.execute(
+                    "SELECT * FROM jobs WHERE file_hash = ? AND sections = ? ORDER BY created DESC LIMIT 1",
+                    (file_hash, selection_key(sections)),
+                ).fetchone()
+            )
+
+    def active_hashes(self) -> set:
+        """Uploads with a queued or running job, whose files must stay in place"""
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute("SELECT file_hash FROM jobs WHERE status IN ('queued', 'running')")}
+
+    def claim(self, worker: int) -> dict:
+        """Mark the oldest queued job as running on `worker` and return it, None if there is none"""
+        with self._connect() as conn:
+            return self._job(
+                conn.execute(
+                    """UPDATE jobs SET status = 'running', worker = ?, started = ?, attempts = attempts + 1
+                    WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1)
+                    AND status = 'queued'
+                    RETURNING *""",
+                    (worker, time.time()),
+                ).fetchone()
+            )
+
+    def update(self, job_id: str, stage: str, status: str, seconds: float = None):
+        """Record the progress of one stage of a running job"""
+        progress = {"status": status}
+        if seconds is not None:
+            progress["seconds"] = round(seconds, 3)
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET stage = ?, stages = json_set(stages, '$.' || ?, json(?)) WHERE id = ?",
+                (stage, stage, json.dumps(progress), job_id),
+            )
+
+    def finish(self, job_id: str, error: str = None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+                ("failed" if error else "done", error, time.time(), job_id),
+            )
+
+    def recover(self) -> int:
+        """
+        Requeue running jobs whose worker process is gone, e.g. after a
+        server restart, failing those already cut short MAX_ATTEMPTS times
+        """
+        with self._connect() as conn:
+            orphans = [
+                row
+                for row in conn.execute("SELECT id, worker, attempts FROM jobs WHERE status = 'running'")
+                if row["worker"] is None or not psutil.pid_exists(row["worker"])
+            ]
+            for row in orphans:
+                if row["attempts"] >= MAX_ATTEMPTS:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ?",
+                        (f"Worker lost {row['attempts']} times", time.time(), row["id"]),
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'queued', worker = NULL, stages = '{}' WHERE id = ?",
+                        (row["id"],),
+                    )
+
+        if orphans:
+            logger.warning(f"Recovered {len(orphans)} jobs left running by a stopped worker")
+        return len(orphans)
+
+
+def run_job(queue: JobQueue, job: dict, cache: UploadCache, rasterizer: Rasterizer = None):
+    """
+    Generate the report of a claimed job into the upload cache, parsing the
+    sheets its sections need that are not processed yet
+    """
+    file_hash = job["file_hash"]
+    folder = cache.folder(file_hash)
+    sections = job["sections"]
+
+    def progress(stage, status, seconds=None):
+        queue.update(job["id"], stage, status, seconds)
+
+    with tracing("report", file_hash=file_hash, job=job["id"], sections=sections) as trace:
+        progress("ingest", "running")
+        start = time.perf_counter()
+        try:
+            # Not in the index if queued before the upload was processed, or
+            # processed with an older layout
+            new = cache.lookup(file_hash) is None
+            workbook = FinancialWorkbook.from_upload(folder)
+            if workbook.xlsx_path is None:
+                raise FileNotFoundError(f"No workbook in {folder / 'raw'}")
+            workbook.load(*section_sheets(sections))
+        except Exception:
+            progress("ingest", "failed", time.perf_counter() - start)
+            raise
+        if new:
+            cache.add(file_hash, workbook.xlsx_path.name)
+            record_history(workbook, workbook.xlsx_path.name, file_hash)
+        progress("ingest", "done", time.perf_counter() - start)
+
+        report = generate_report(workbook, progress=progress, rasterizer=rasterizer, sections=sections)
+        save_report_artifacts(cache, file_hash, report, sections)
+
+    trace.save(folder / "trace.json")
+
+
+def work(queue_path: Path, root_dir: Path, stop, poll: float = 0.5, log_level: str = None):
+    """Claim and run jobs until `stop` is set, the body of every worker"""
+    if log_level is not None:
+        logger.remove()
+        logger.add(sys.stderr, level=log_level)
+
+    queue = JobQueue(queue_path)
+    cache = UploadCache(root_dir)
+    # Workers export their own charts, a kaleido pool per worker would oversubscribe
+    rasterizer = Rasterizer(workers=0, cache=default_figure_cache())
+    worker = os.getpid()
+
+    while not stop.is_set():
+        job = queue.claim(worker)
+        if job is None:
+            stop.wait(poll)
+            continue
+
+        logger.info(f"Job {job['id']}: report for {job['file_name'] or job['file_hash']}")
+        try:
+            run_job(queue, job, cache, rasterizer)
+        except Exception as e:
+            logger.exception(f"Job {job['id']} failed")
+            queue.finish(job["id"], error=f"{type(e).__name__}: {e}")
+        else:
+            queue.finish(job["id"])
+            logger.info(f"Job {job['id']} done")
+
+
+class JobWorkers:
+    """
+    Pool of worker processes serving a JobQueue. With `processes=0` one
+    worker thread runs in this process instead, for tests or platforms
+    where spawning is impractical.
+    """
+
+    def __init__(self, queue: JobQueue, root_dir: Path = ROOT, processes: int = 2, log_level: str = "INFO"):
+        self.queue = queue
+        self.root_dir = Path(root_dir)
+        self.processes = processes
+        self.log_level = log_level
+        self.workers = []
+        self.stop_event = None
+
+    def start(self):
+        self.queue.recover()
+
+        if self.processes == 0:
+            self.stop_event = threading.Event()
+            args = (self.queue.path, self.root_dir, self.stop_event)
+            self.workers = [threading.Thread(target=work, args=args, name="job-worker", daemon=True)]
+        else:
+            # Spawn rather than fork, the LLM client keeps threads and sockets
+            context = mp.get_context("spawn")
+            self.stop_event = context.Event()
+            args = (self.queue.path, self.root_dir, self.stop_event, 0.5, self.log_level)
+            self.workers = [
+                context.Process(target=work, args=args, name=f"job-worker-{i}", daemon=True)
+                for i in range(self.processes)
+            ]
+
+        for worker in self.workers:
+            worker.start()
+        logger.info(f"Started {len(self.workers)} job workers")
+        return self
+
+    def stop(self, timeout: float = None):
+        """Let the workers finish their current job and exit"""
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(timeout)
+
+
+def default_queue() -> JobQueue:
+    return JobQueue(os.getenv("JOBS_PATH", ROOT / "data" / "jobs.sqlite"))
@@ -1,161 +1,254 @@
-import io
-import re
+import json
+import os
 from pathlib import Path
 
 import pandas as pd
-import plotly.graph_objects as go
-import plotly.io as pio
 import streamlit as st
 from loguru import logger
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.utils import ImageReader
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from PIL import Image
-from reportlab.pdfgen import canvas
-
-from analysis import (
-    balance_sheet,
-    income_statement,
-    is_month_comparative,
-    labor,
-    revenue,
-    utils,
-)
-from analysis.prompt import Prompt
-from data import process_uploaded_file
+
+from analysis.instrument import tracing
+from analysis.router import get_router
+from cache import UploadCache, UploadCollector, UploadLeases
+from render import get_rasterizer
+from data import FinancialWorkbook
+from history import record_history
+from jobs import ACTIVE, STAGES, JobQueue, JobWorkers, default_queue
 import utils as file_utils
-from utils import markdown2text, df2table
-from chart import sankey_diagram, total_revenue_stack_line, total_expense_stack_line
+from report import (
+    MAX_CONCURRENCY,
+    SECTIONS,
+    generate_report,
+    has_report_artifacts,
+    load_report_artifacts,
+    save_report_artifacts,
+    select_sections,
+    selection_key,
+)
 
 # Set page config
 st.set_page_config(
     page_title="Financial Report Generator", page_icon="📊", layout="wide"
 )
 
+# Generate reports in background job workers that survive a refresh and
+# share one report between sessions, shown once it is done, or with
+# REPORT_JOBS=0 inline in the script run, streaming the narrative onto the page
+REPORT_JOBS = os.getenv("REPORT_JOBS", "1") != "0"
+# Worker processes per server, 0 for a worker thread in the server itself
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+
 
-def qualitative(data_dir):
-    prompt = Prompt.master
-    data_dir = Path(data_dir) / "processed"
-
-    # Collecting analyses in a list for better readability
-    analyses = [
-        "Balance sheet analysis: " + balance_sheet.analyse(data_dir),
-        "Income Statement analysis: " + income_statement.analyse(data_dir),
-        "Variance analysis: " + is_month_comparative.analyse(data_dir),
-        "Labor Data analysis: " + labor.analyse(data_dir),
-        "Revenue Data analysis: " + revenue.analyse(data_dir),
-    ]
-
-    # Joining the analyses into a single prompt
-    prompt = "\n".join(analyses) + prompt
-
-    response = utils.send_prompt(prompt)
-
-    return response
-
-
-def quantitative(data_dir):
-    dollar_var_top, percent_var_top = is_month_comparative.get_data(data_dir)
+def show_quantitative(dollar_var_top, percent_var_top, sankey_fig_display, fig_stack_line, fig_expense_stack_line):
+    """Tables and charts of a report, skipping those left out of it"""
+    charts = {"sankey": sankey_fig_display, "revenue_stack_line": fig_stack_line, "expense_stack_line": fig_expense_stack_line}
+    for name, figure in charts.items():
+        if figure is not None:
+            st.subheader(SECTIONS[name].label)
+            st.plotly_chart(figure, use_container_width=True)
 
-    # Add Sankey diagram generation
-    df = pd.read_csv(data_dir / "Income Statement T-12.csv", index_col=0)
-
-    # Create Sankey diagram
-    fig_display = sankey_diagram(df, font_size=16)
-    fig_pdf = sankey_diagram(df, font_size=10)
-    fig_stack_line = total_revenue_stack_line(df)
-    fig_expense_stack_line = total_expense_stack_line(df)
-    return dollar_var_top, percent_var_top, fig_display, fig_pdf, fig_stack_line, fig_expense_stack_line
+    if dollar_var_top is not None:
+        st.subheader("Top 10 Categories with Highest Dollar Variance")
+        st.dataframe(dollar_var_top)
+
+        st.subheader("Top 10 Categories with Highest Percent Variance")
+        st.dataframe(percent_var_top)
+
+
+def render_report(workbook: FinancialWorkbook, max_workers: int = MAX_CONCURRENCY, sections=None):
+    """
+    Generate and show a report of `sections`, every one by default. Each
+    part appears on the page as soon as it is ready, the narrative streamed
+    while it is generated; see report.generate_report.
+
+    Returns the report in REPORT_ARTIFACTS order.
+    """
+    qualitative_section = st.container()
+    quantitative_section = st.container()
+
+    def show(part, value):
+        if part == "quantitative":
+            dollar_var_top, percent_var_top, sankey_fig_display, _, fig_stack_line, fig_expense_stack_line = value
+            with quantitative_section:
+                show_quantitative(dollar_var_top, percent_var_top, sankey_fig_display, fig_stack_line, fig_expense_stack_line)
+
+    def write_stream(chunks):
+        with qualitative_section:
+            st.subheader("Qualitative Analysis")
+            return st.write_stream(chunks)
+
+    return generate_report(workbook, max_workers, sections=sections, on_result=show, write_stream=write_stream)
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@st.cache_resource(show_spinner=False)
+def upload_leases() -> UploadLeases:
+    """Uploads held by the open sessions of this server process"""
+    return UploadLeases()
+
+
+@st.cache_resource(show_spinner=False)
+def upload_cache() -> UploadCache:
+    cache = UploadCache(ROOT)
+    leases = upload_leases()
+    queue = default_queue() if REPORT_JOBS else None
+
+    def protected():
+        hashes = leases()
+        if queue is not None:
+            hashes |= queue.active_hashes()
+        return hashes
+
+    # Bound uploads/ in the background, never touching the uploads of open
+    # sessions or with a job in flight
+    UploadCollector(cache, protected).start()
+    return cache
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def load_workbook(file_hash: str, _uploaded_file) -> FinancialWorkbook:
+    """
+    Workbook of an upload, shared by every session in the process, its
+    sheets parsed as the selected sections first use them. Keyed by the
+    upload hash only, the file itself is not hashed again; cleared by
+    upload_hash if the upload is collected meanwhile.
+    """
+    cache = upload_cache()
+    upload_dir = file_utils.save_file(_uploaded_file, ROOT)
+    # Same workbook as an earlier upload: the sheets processed then are reused
+    workbook = FinancialWorkbook.from_upload(upload_dir)
+
+    if cache.lookup(file_hash) is None:
+        cache.add(file_hash, _uploaded_file.name)
+        record_history(workbook, _uploaded_file.name, file_hash)
+    return workbook
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def load_report(file_hash: str, sections: str = ""):
+    """Saved report of an upload and selection_key, read from disk once per process"""
+    return load_report_artifacts(upload_cache(), file_hash, sections)
+
+
+@st.cache_resource(show_spinner=False)
+def job_queue() -> JobQueue:
+    """Shared job queue, its workers started once per server process"""
+    queue = default_queue()
+    JobWorkers(queue, ROOT, processes=JOB_WORKERS).start()
+    return queue
+
+
+@st.fragment(run_every=1)
+def job_progress(job_id: str):
+    """Live progress of a running job, rerunning the page once it ends"""
+    job = job_queue().get(job_id)
+    if job["status"] not in ACTIVE:
+        st.rerun()
+
+    done = sum(info["status"] in ("done", "skipped") for info in job["stages"].values())
+    st.progress(done / len(STAGES), text=f"Generating report (job {job_id}): {job['status']}")
+    for stage in STAGES:
+        info = job["stages"].get(stage)
+        if info is not None:
+            seconds = f" in {info['seconds']:.1f}s" if "seconds" in info else ""
+            st.caption(f"{stage}: {info['status']}{seconds}")
+
+
+def follow_job(job_id: str):
+    """Progress of a report job, or its report once it has finished"""
+    job = job_queue().get(job_id)
+    if job is None:
+        st.warning(f"Job {job_id} not found")
+        return None
+
+    if job["status"] == "failed":
+        st.error(f"Report generation failed: {job['error']}")
+        return None
+    if job["status"] in ACTIVE:
+        job_progress(job_id)
+        return None
+
+    cache = upload_cache()
+    if not has_report_artifacts(cache, job["file_hash"], job["sections"]):
+        st.warning("The report of this job is no longer available, please generate it again")
+        return None
+    cache.touch(job["file_hash"])
+
+    trace_path = cache.folder(job["file_hash"]) / "trace.json"
+    if trace_path.exists():
+        st.session_state.setdefault("traces", {})["report"] = json.loads(trace_path.read_text())
+    return load_report(job["file_hash"], job["sections"])
+
+
+def download_report(report):
+    st.download_button(
+        label="Download PDF Report",
+        data=report[-1],
+        file_name="financial_report.pdf",
+        mime="application/pdf",
+    )
 
 
-# TODO: To be more robust
-def generate_pdf(text, dollar_var_top, percent_var_top, sankey_fig, fig_stack_line, fig_expense_stack_line):
-    # Create PDF in memory
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
+def upload_hash(uploaded_file) -> str:
+    """
+    Hash of the uploaded file, computed once per upload rather than per
+    rerun. The session holds a lease on the upload while it is open, and
+    one collected anyway is saved again from the file in hand.
+    """
+    if st.session_state.get("upload_id") != uploaded_file.file_id:
+        st.session_state["upload_id"] = uploaded_file.file_id
+        st.session_state["file_hash"] = file_utils.file_hash(uploaded_file)
+        st.session_state["upload_lease"] = upload_leases().hold(st.session_state["file_hash"])
+        upload_cache().touch(st.session_state["file_hash"])
 
-    if "Heading1" in styles:
-        styles["Heading1"].alignment = 1
-    if "Heading2" in styles:
-        styles["Heading2"].alignment = 1
-    if "Heading3" in styles:
-        styles["Heading3"].alignment = 1
-    elements = []
+    file_hash = st.session_state["file_hash"]
+    if not upload_cache().has_upload(file_hash):
+        # The cached workbook would read from a folder that is gone
+        load_workbook.clear(file_hash, uploaded_file)
+    return file_hash
 
-    # Add H1 for Qualitative Analysis
-    elements.append(Paragraph("Qualitative Analysis", styles["Heading1"]))
-    elements.append(Spacer(1, 12))
 
-    # Parse the text
-    elements.extend(markdown2text(text, styles))
+def keep_trace(trace, path: Path):
+    """Save a trace next to the upload and keep it for the timings panel"""
+    trace.save(path)
+    st.session_state.setdefault("traces", {})[trace.name] = trace.to_dict()
 
-    # Create a small italic style
-    small_italic_style = styles["Normal"].clone("SmallItalic")
-    small_italic_style.fontSize = 8
-    small_italic_style.fontName = "Helvetica"
-    small_italic_style.italic = True
 
-    # Add H1 for Quantitative Analysis
-    elements.append(Paragraph("Quantitative Analysis", styles["Heading1"]))
-    elements.append(Spacer(1, 12))
+def show_timings():
+    """Sidebar panel with the spans of the last ingestion and report and model latencies, if enabled"""
+    traces = st.session_state.get("traces")
+    if not st.sidebar.checkbox("Show timings") or not traces:
+        return
 
-    elements.append(df2table(dollar_var_top, col_widths=[200, 150]))
-    elements.append(
-        Paragraph(
-            "Ranked Expense Category Dollar Variance",
-            small_italic_style,
+    latencies = get_router().stats.summary()
+    if latencies:
+        st.sidebar.subheader("Model latency (s)")
+        st.sidebar.dataframe(pd.DataFrame(latencies).T)
+
+    for name, trace in traces.items():
+        st.sidebar.subheader(f"{name.capitalize()}: {trace['wall']:.2f}s")
+        spans = pd.DataFrame(trace["spans"])
+        for column in ("rss", "peak_rss", "peak_growth"):
+            spans[column] = spans[column] / 2**20
+        spans = spans.rename(columns={"rss": "rss MiB", "peak_rss": "peak MiB", "peak_growth": "growth MiB"})
+        st.sidebar.dataframe(spans.drop(columns=["parent", "thread"]), hide_index=True)
+        st.sidebar.download_button(
+            label=f"Download {name} trace",
+            data=json.dumps(trace, indent=2, default=str),
+            file_name=f"{name}_trace.json",
+            mime="application/json",
+            key=f"trace_{name}",
         )
-    )
-    elements.append(Spacer(1, 24))
 
-    elements.append(df2table(percent_var_top, col_widths=[200, 150]))
-    elements.append(
-        Paragraph(
-            "Ranked Expense Category Percent Variance",
-            small_italic_style,
-        )
-    )
-    elements.append(Spacer(1, 24))
-
-    def add_image_to_elements(fig, elements, title, small_italic_style, max_width=500, img_format='png', width=700, height=500):
-        # Convert Plotly figure to PIL Image
-        img_bytes = pio.to_image(fig, format=img_format, width=width, height=height)
-        img = Image.open(io.BytesIO(img_bytes))
-        
-        # Save the image to a temporary buffer
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='PNG')
-        img_buffer.seek(0)
-
-        # Calculate image dimensions while maintaining aspect ratio
-        img_width, img_height = img.size
-        aspect = img_height / float(img_width)
-        new_width = min(max_width, img_width)
-        new_height = new_width * aspect
-
-        # Create a flowable image
-        from reportlab.platypus import Image as RLImage
-        img_flowable = RLImage(img_buffer, width=new_width, height=new_height)
-        elements.append(img_flowable)
-        
-        elements.append(
-            Paragraph(
-                title,
-                small_italic_style,
-            )
-        )
-        elements.append(Spacer(1, 24))
 
-    add_image_to_elements(sankey_fig, elements, "Revenue and Expense Flow", small_italic_style)
-    add_image_to_elements(fig_stack_line, elements, "Revenue Breakdown Over Time", small_italic_style)
-    add_image_to_elements(fig_expense_stack_line, elements, "Expense Breakdown Over Time", small_italic_style)
-    # Build the document
-    doc.build(elements)
-    buffer.seek(0)
-    return buffer
+def show_report(report):
+    (qual_analysis, dollar_var_top, percent_var_top, sankey_fig_display, _, fig_stack_line, fig_expense_stack_line, _) = report
+
+    if qual_analysis is not None:
+        st.subheader("Qualitative Analysis")
+        st.markdown(qual_analysis)
+    show_quantitative(dollar_var_top, percent_var_top, sankey_fig_display, fig_stack_line, fig_expense_stack_line)
 
 
 def main():
@@ -171,74 +264,105 @@ def main():
         help="Upload the financial data Excel file",
     )
 
+    # Start the chart export workers while the user picks a file
+    get_rasterizer()
+
     if uploaded_file is not None:
-        # Create unique folder for this upload
-        ROOT = Path(__file__).resolve().parent.parent
-        upload_dir = file_utils.save_file(uploaded_file, ROOT)
+        cache = upload_cache()
+        file_hash = upload_hash(uploaded_file)
 
-        # Process the uploaded file
+        # Process the uploaded file, once per distinct workbook
         with st.spinner("Processing uploaded file..."):
             try:
-                processed_dir = process_uploaded_file(uploaded_file, upload_dir)
-                st.success(f"File processed successfully! Stored in: {processed_dir}")
-
-                # Store the processed directory path in session state
-                st.session_state["processed_dir"] = processed_dir
+                with tracing("ingest", file=uploaded_file.name, file_hash=file_hash) as trace:
+                    workbook = load_workbook(file_hash, uploaded_file)
+                if trace.spans:
+                    # Only an upload that was actually parsed has anything to show
+                    keep_trace(trace, cache.folder(file_hash) / "ingest_trace.json")
+                st.success(f"File processed successfully! Stored in: {cache.folder(file_hash)}")
+
+                # Keep the parsed workbook in session state between reruns
+                st.session_state["workbook"] = workbook
+
+                # Only the sheets of the selected sections get parsed
+                selected = st.multiselect(
+                    "Report sections",
+                    list(SECTIONS),
+                    default=list(SECTIONS),
+                    format_func=lambda name: SECTIONS[name].label,
+                )
+                sections = select_sections(selected)
+                key = selection_key(sections)
 
                 # Enable the generate report button
-                generate_report = st.button("Generate Report")
+                generate_clicked = st.button("Generate Report", disabled=not selected)
             except Exception as e:
                 st.error(f"Error processing file: {str(e)}")
                 return
     else:
+        job_id = st.query_params.get("job")
+        if REPORT_JOBS and job_id:
+            # Back after a refresh, pick up the job started before it
+            report = follow_job(job_id)
+            if report is not None:
+                show_report(report)
+                download_report(report)
+            return
+
         st.info("Please upload a financial statement file to continue")
         return
 
-    if "processed_dir" in st.session_state and generate_report:
-        with st.spinner("Generating report..."):
-            try:
-                # Generate qualitative analysis
-                qual_analysis = qualitative(processed_dir)
-                st.subheader("Qualitative Analysis")
-                st.markdown(qual_analysis)
-
-                # Generate quantitative analysis
-                (dollar_var_top, percent_var_top, sankey_fig_display, sankey_fig_pdf, fig_stack_line, fig_expense_stack_line) = quantitative(
-                    processed_dir / "processed"
-                )
-
-                st.subheader("Revenue and Expense Flow")
-                st.plotly_chart(sankey_fig_display, use_container_width=True)
-
-                st.subheader("Revenue Breakdown Over Time")
-                st.plotly_chart(fig_stack_line, use_container_width=True)
-
-                st.subheader("Expense Breakdown Over Time")
-                st.plotly_chart(fig_expense_stack_line, use_container_width=True)
-
-                st.subheader("Top 10 Categories with Highest Dollar Variance")
-                st.dataframe(dollar_var_top)
-
-                st.subheader("Top 10 Categories with Highest Percent Variance")
-                st.dataframe(percent_var_top)
-
-                # Generate PDF
-                pdf_buffer = generate_pdf(
-                    qual_analysis, dollar_var_top, percent_var_top, sankey_fig_pdf, fig_stack_line, fig_expense_stack_line
-                )
-                st.download_button(
-                    label="Download PDF Report",
-                    data=pdf_buffer,
-                    file_name="financial_report.pdf",
-                    mime="application/pdf",
-                )
+    # A report generated earlier in this session survives reruns, e.g. the
+    # one triggered by the download button, without being rebuilt
+    reports = st.session_state.setdefault("reports", {})
+    report = reports.get((file_hash, key))
+    jobs = st.session_state.setdefault("jobs", {})
+    shown = False
+
+    if REPORT_JOBS and report is None and (file_hash, key) not in jobs:
+        # Another session may already be generating this upload's report
+        latest = job_queue().latest(file_hash, key)
+        if latest is not None and latest["status"] in ACTIVE:
+            jobs[file_hash, key] = latest["id"]
+            # So a refresh follows the job it joined, as with one it started
+            st.query_params["job"] = latest["id"]
+
+    if report is None and "workbook" in st.session_state and generate_clicked:
+        # Every report use counts, not only the upload
+        cache.touch(file_hash)
+        try:
+            if has_report_artifacts(cache, file_hash, key):
+                report = load_report(file_hash, key)
+            elif REPORT_JOBS:
+                # No artifacts, so a finished job of this upload is of no use
+                jobs[file_hash, key] = job_queue().submit(file_hash, uploaded_file.name, force=True, sections=key)
+                st.query_params["job"] = jobs[file_hash, key]
+            else:
+                with st.spinner("Generating report..."):
+                    with tracing("report", file_hash=file_hash, sections=key) as trace:
+                        report = render_report(workbook, sections=sections)
+                save_report_artifacts(cache, file_hash, report, sections)
+                keep_trace(trace, cache.folder(file_hash) / "trace.json")
+                shown = True
+
+        except Exception as e:
+            st.error(f"An error occurred: {str(e)}")
+            logger.exception(
+                "An error occurred during report generation"
+            )  # Print the trace as well
+            return
+
+    if report is None and (file_hash, key) in jobs:
+        report = follow_job(jobs[file_hash, key])
+    if report is None:
+        return
 
-            except Exception as e:
-                st.error(f"An error occurred: {str(e)}")
-                logger.exception(
-                    "An error occurred during report generation"
-                )  # Print the trace as well
+    reports[file_hash, key] = report
+    if not shown:
+        show_report(report)
+    download_report(report)
 
 
 if __name__ == "__main__":
     main()
+    show_timings()
@@ -0,0 +1,228 @@
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from data import LINE_ITEM, FinancialWorkbook, sheets
+from history import facility_name, statement_month
+
+FACILITY = "Facility"
+# Position of a line item among rows sharing its name, e.g. the "Census"
+# header and the "Census" row under it
+OCCURRENCE = "Occurrence"
+
+# Expense rows ranked by is_month_comparative, first and last
+EXPENSE_RANGE = ("Nursing Expenses", "Total Real Estate Taxes")
+
+
+def column_kind(column: str) -> str:
+    """"ppd" per patient day, "variance" ratio of change to prior, otherwise "amount" """
+    if column.startswith("PPD"):
+        return "ppd"
+    if "Variance" in column:
+        return "variance"
+    return "amount"
+
+
+def stack_frames(frames: dict) -> pd.DataFrame:
+    """
+    One sheet of many facilities in a single frame indexed by facility,
+    line item and occurrence. Columns are aligned by name (months, periods),
+    missing ones are NaN.
+    """
+    stacked = pd.concat(frames, names=[FACILITY, LINE_ITEM], sort=False)
+    occurrence = stacked.groupby(level=[0, 1], sort=False).cumcount()
+    stacked.index = pd.MultiIndex.from_arrays(
+        [
+            stacked.index.get_level_values(0),
+            stacked.index.get_level_values(1),
+            occurrence.to_numpy(),
+        ],
+        names=[FACILITY, LINE_ITEM, OCCURRENCE],
+    )
+    return stacked
+
+
+def consolidate(stacked: pd.DataFrame) -> pd.DataFrame:
+    """
+    Portfolio totals of a stacked sheet, laid out like a single facility's
+    sheet. Amounts are summed; PPD columns are recomputed from the summed
+    amounts and patient days, and variances from the summed changes and
+    prior values, since neither can be added up.
+    """
+    columns = list(stacked.columns)
+    kinds = [column_kind(column) for column in columns]
+    grouped = stacked.groupby(level=[LINE_ITEM, OCCURRENCE], sort=False)
+
+    amounts = [column for column, kind in zip(columns, kinds) if kind == "amount"]
+    totals = grouped[amounts].sum(min_count=1)
+
+    for i, (column, kind) in enumerate(zip(columns, kinds)):
+        if kind == "amount":
+            continue
+
+        # The amount columns this one is derived from, nearest first
+        preceding = [c for c, k in zip(columns[:i], kinds[:i]) if k == "amount"][::-1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Zero denominators follow the workbook: no amount is 0 PPD, and
+            # any change from a zero prior is a 100% variance
+            if kind == "ppd":
+                amount = preceding[0]
+                days = (stacked[amount] / stacked[column]).replace([np.inf, -np.inf], np.nan)
+                days = days.groupby(level=[LINE_ITEM, OCCURRENCE], sort=False).sum(min_count=1)
+                # Tiny amounts have a PPD rounded to 0, which gives no patient days
+                ppd = (totals[amount] / days).fillna(grouped[column].mean())
+                totals[column] = ppd.mask(totals[amount] == 0, 0)
+            else:
+                change, prior = preceding[0], preceding[1]
+                zero_prior = totals[prior] == 0
+                totals[column] = (totals[change] / totals[prior]).mask(
+                    zero_prior, (totals[change] != 0).astype(float)
+                )
+
+    totals = totals[columns].replace([np.inf, -np.inf], np.nan)
+    return totals.droplevel(OCCURRENCE)
+
+
+class Portfolio:
+    """
+    Processed workbooks of many facilities, consolidated line item by line
+    item and period. Consolidated sheets keep the single facility layout,
+    so `workbook()` feeds the existing analyses, prompts and charts as is.
+    """
+
+    def __init__(self, workbooks: dict):
+        self.workbooks = workbooks
+        self._stacked = {}
+        self._consolidated = {}
+
+    @classmethod
+    def from_dirs(cls, processed_dirs: dict, sheet_map: dict = sheets):
+        """Load facilities from their processed sheets, given as {facility: directory}"""
+        return cls(
+            {
+                facility: FinancialWorkbook.from_dir(processed_dir, sheet_map)
+                for facility, processed_dir in processed_dirs.items()
+            }
+        )
+
+    @classmethod
+    def from_uploads(cls, upload_cache, file_hashes=None, sheet_map: dict = sheets):
+        """
+        Load uploads as facilities named by facility_name. Of every upload,
+        only the latest statement of each facility is kept, by the month in
+        its file name and then by upload time. `file_hashes` must each be a
+        different facility.
+        """
+        index = upload_cache.read_index()
+        uploads = {}
+        if file_hashes:
+            for file_hash in file_hashes:
+                facility = facility_name(index[file_hash]["name"])
+                if facility in uploads:
+                    raise ValueError(f"Uploads {uploads[facility]} and {file_hash} are both statements of {facility}")
+                uploads[facility] = file_hash
+        else:
+            # Oldest first, so a later statement of a facility replaces an earlier one
+            for file_hash, entry in sorted(
+                index.items(), key=lambda item: (statement_month(item[1]["name"]) or "", item[1]["created"])
+            ):
+                uploads[facility_name(entry["name"])] = file_hash
+
+        # Sheets not processed yet are parsed from the upload as they are used
+        return cls(
+            {
+                facility: FinancialWorkbook.from_upload(upload_cache.folder(file_hash), sheet_map)
+                for facility, file_hash in uploads.items()
+            }
+        )
+
+    @property
+    def facilities(self) -> list:
+        return list(self.workbooks)
+
+    def stacked(self, sheet_name: str) -> pd.DataFrame:
+        """`sheet_name` of every facility that has it, see stack_frames"""
+        if sheet_name not in self._stacked:
+            frames = {
+                facility: workbook[sheet_name]
+                for facility, workbook in self.workbooks.items()
+                if sheet_name in workbook
+            }
+            if len(frames) < len(self.workbooks):
+                logger.warning(
+                    f"Sheet {sheet_name} missing for {len(self.workbooks) - len(frames)} facilities"
+                )
+            self._stacked[sheet_name] = stack_frames(frames)
+        return self._stacked[sheet_name]
+
+    def consolidated(self, sheet_name: str) -> pd.DataFrame:
+        if sheet_name not in self._consolidated:
+            self._consolidated[sheet_name] = consolidate(self.stacked(sheet_name))
+        return self._consolidated[sheet_name]
+
+    def t12(self) -> pd.DataFrame:
+        return self.consolidated("Income Statement T-12")
+
+    def variance(self) -> pd.DataFrame:
+        return self.consolidated("IS Month Comparative Detailed")
+
+    def labor(self) -> pd.DataFrame:
+        return self.consolidated("Labor")
+
+    def workbook(self) -> FinancialWorkbook:
+        """Consolidated sheets as a workbook, for analyse(), get_data() and quantitative()"""
+        sheet_names = dict.fromkeys(
+            sheet_name for workbook in self.workbooks.values() for sheet_name in workbook.sheet_names
+        )
+        return FinancialWorkbook({sheet_name: self.consolidated(sheet_name) for sheet_name in sheet_names})
+
+    def rankings(self, n: int = 10):
+        """
+        Top `n` year-to-date expense variances across every facility, by
+        dollars and by percent, laid out like is_month_comparative.get_data
+        plus each line item's rank within its own facility.
+        """
+        data = self.stacked("IS Month Comparative Detailed").droplevel(OCCURRENCE)
+        line_items = data.index.get_level_values(LINE_ITEM)
+
+        # Rows from the first to the last expense line of each facility
+        first, last = (pd.Series(line_items == name, index=data.index) for name in EXPENSE_RANGE)
+        started = first.groupby(level=FACILITY, sort=False).cumsum() > 0
+        ended = (last.groupby(level=FACILITY, sort=False).cumsum() - last) > 0
+        expenses = started & ~ended & ~line_items.str.contains("total", case=False)
+
+        data = data.loc[expenses.to_numpy()].iloc[:, [-2, -1]]
+        data.columns = ["$ Value", "% Value"]
+        data["% Value"] = data["% Value"] * 100
+
+        tops = []
+        for column in ("$ Value", "% Value"):
+            ranked = data.assign(
+                **{"Facility Rank": data.groupby(level=FACILITY, sort=False)[column].rank(method="first", ascending=False)}
+            )
+            top = ranked.nlargest(n, column)
+            top.insert(0, "Rank", range(1, 1 + len(top)))
+            tops.append(top[["Rank", "% Value", "$ Value", "Facility Rank"]].round().astype("Int64"))
+
+        dollar_var_top, percent_var_top = tops
+        return dollar_var_top, percent_var_top
+
+    def facility_ranking(self, line_item: str = "Operating Income", sheet_name: str = "Income Statement T-12", column: int = -1) -> pd.Series:
+        """Facilities ordered by one line item, by default year-to-date operating income"""
+        stacked = self.stacked(sheet_name)
+        values = stacked.xs(line_item, level=LINE_ITEM).iloc[:, column]
+        # Use the last row of a repeated line item, the header comes first
+        values = values.groupby(level=FACILITY, sort=False).last()
+        return values.sort_values(ascending=False).rename(line_item)
+
+
+if __name__ == "__main__":
+    from cache import UploadCache
+    from data import ROOT
+
+    portfolio = Portfolio.from_uploads(UploadCache(ROOT))
+    dollar_var_top, percent_var_top = portfolio.rankings()
+    print(portfolio.t12().loc[["Total Revenue", "Operating Income"]])
+    print(dollar_var_top)
+    print(percent_var_top)
+    print(portfolio.facility_ranking())
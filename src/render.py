@@ -0,0 +1,146 @@
+import atexit
+import hashlib
+import multiprocessing as mp
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import plotly.graph_objects as go
+import plotly.io as pio
+
+from analysis.store import BlobCache
+
+# Worker processes kept warm for chart export, 0 renders in-process
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", 3))
+
+
+class Rendered(NamedTuple):
+    image: bytes
+    seconds: float
+
+
+def export_figure(fig):
+    """
+    Copy of `fig` safe for static export. Under Streamlit the default
+    template is "streamlit", whose colorway holds placeholder colours
+    (rgb(0, 0, 1), ...) that only its frontend resolves; exported images
+    would come out black and grey, so swap in the stock plotly template.
+    """
+    fig = go.Figure(fig)
+    if "streamlit" in pio.templates and fig.layout.template == pio.templates["streamlit"]:
+        fig.update_layout(template="plotly")
+    return fig
+
+
+class FigureCache(BlobCache):
+    """
+    Disk cache of exported chart images, keyed by the figure's JSON spec and
+    the export format and size, so an unchanged chart is never rendered
+    twice. Images are evicted least recently used first once the cache
+    grows past `max_bytes`.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 200 * 2**20, max_age: float = None):
+        super().__init__(path, "images", max_bytes, max_age)
+
+    @staticmethod
+    def key(spec: str, img_format: str, width: int, height: int) -> str:
+        payload = f"{img_format}:{width}x{height}:{spec}"
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str):
+        """Cached image bytes for `key`, or None on a miss"""
+        image = super().get(key)
+        return None if image is None else bytes(image)
+
+
+def default_figure_cache():
+    """The shared chart image cache, or None when disabled with FIGURE_CACHE=0"""
+    return FigureCache.from_env("FIGURE_CACHE", "figures.sqlite", max_bytes=200 * 2**20)
+
+
+def _warm_up():
+    # The first export starts kaleido's browser process, pay for it up front
+    pio.to_image(go.Figure(), format="png", width=10, height=10)
+
+
+def _render(spec: str, img_format: str, width: int, height: int) -> Rendered:
+    start = time.perf_counter()
+    image = pio.to_image(pio.from_json(spec), format=img_format, width=width, height=height)
+    return Rendered(image, time.perf_counter() - start)
+
+
+class Rasterizer:
+    """
+    Pool of warm kaleido processes that export a batch of figures
+    concurrently. Each worker keeps its kaleido subprocess alive between
+    batches, so only the first export in a worker pays the startup cost.
+    Figures already in the `cache` are served from it without rendering.
+    """
+
+    def __init__(self, workers: int = RENDER_WORKERS, cache: FigureCache = None):
+        self.workers = workers
+        self.cache = cache
+        self.pool = None
+        if workers > 0:
+            # Spawn rather than fork, the app process is multi-threaded
+            self.pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=mp.get_context("spawn"),
+                initializer=_warm_up,
+            )
+            # Start every worker now instead of on the first batch
+            for _ in range(workers):
+                self.pool.submit(os.getpid)
+
+    def render(self, figures, img_format: str = "png", width: int = 700, height: int = 500):
+        """
+        Export every figure, returning a Rendered (bytes, seconds) per figure
+        in order. Cache hits come back with 0 seconds.
+        """
+        specs = [pio.to_json(export_figure(fig)) for fig in figures]
+        args = (img_format, width, height)
+
+        keys = [FigureCache.key(spec, *args) for spec in specs]
+        rendered = [None] * len(specs)
+        if self.cache is not None:
+            for i, key in enumerate(keys):
+                image = self.cache.get(key)
+                if image is not None:
+                    rendered[i] = Rendered(image, 0.0)
+
+        misses = [i for i, result in enumerate(rendered) if result is None]
+        if self.pool is None:
+            for i in misses:
+                rendered[i] = _render(specs[i], *args)
+        else:
+            futures = {i: self.pool.submit(_render, specs[i], *args) for i in misses}
+            for i, future in futures.items():
+                rendered[i] = future.result()
+
+        if self.cache is not None:
+            for i in misses:
+                self.cache.put(keys[i], rendered[i].image)
+
+        return rendered
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+
+_rasterizer = None
+_rasterizer_lock = threading.Lock()
+
+
+def get_rasterizer() -> Rasterizer:
+    """Process-wide rasterizer, created on first use and kept for the app's lifetime"""
+    global _rasterizer
+    with _rasterizer_lock:
+        if _rasterizer is None:
+            _rasterizer = Rasterizer(cache=default_figure_cache())
+            atexit.register(_rasterizer.shutdown)
+    return _rasterizer
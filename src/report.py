@@ -0,0 +1,523 @@
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Callable, NamedTuple
+
+from loguru import logger
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+
+from analysis import (
+    balance_sheet,
+    income_statement,
+    is_month_comparative,
+    labor,
+    revenue,
+    utils,
+)
+from analysis.instrument import annotate, in_context, span
+from analysis.prompt import Prompt
+from render import get_rasterizer
+from data import FinancialWorkbook
+from utils import markdown2text, df2table, chart_flowable, chart_format
+from chart import sankey_data, sankey_figure, total_revenue_stack_line, total_expense_stack_line
+
+# Cached per upload hash, in the order qualitative/quantitative/PDF produce them
+REPORT_ARTIFACTS = (
+    "qualitative.md",
+    "dollar_var_top.pkl",
+    "percent_var_top.pkl",
+    "sankey_display.json",
+    "sankey_pdf.json",
+    "revenue_stack_line.json",
+    "expense_stack_line.json",
+    "report.pdf",
+)
+
+# "png", or "svg" to embed charts in the PDF as vector graphics
+PDF_CHART_FORMAT = os.getenv("PDF_CHART_FORMAT", "png")
+
+T12_SHEET = "Income Statement T-12"
+
+
+class Section(NamedTuple):
+    # Heading in the master prompt, or in the report for tables and charts
+    label: str
+    # Sheets the section reads, the only ones parsed for it
+    sheets: tuple
+    # Analysis fed to the master prompt, None for tables and charts
+    analyse: Callable = None
+
+
+# Selectable parts of a report, in report order. The analyses (named after
+# their module and route) make up the narrative, in prompt order
+SECTIONS = {
+    "balance_sheet": Section("Balance sheet analysis", (balance_sheet.sheet_name,), balance_sheet.analyse),
+    "income_statement": Section("Income Statement analysis", (income_statement.sheet_name,), income_statement.analyse),
+    "is_month_comparative": Section("Variance analysis", (is_month_comparative.sheet_name,), is_month_comparative.analyse),
+    "labor": Section("Labor Data analysis", (labor.sheet_name,), labor.analyse),
+    "revenue": Section("Revenue Data analysis", (revenue.sheet_name,), revenue.analyse),
+    "variance_tables": Section("Top Expense Variances", (is_month_comparative.sheet_name,)),
+    "sankey": Section("Revenue and Expense Flow", (T12_SHEET,)),
+    "revenue_stack_line": Section("Revenue Breakdown Over Time", (T12_SHEET,)),
+    "expense_stack_line": Section("Expense Breakdown Over Time", (T12_SHEET,)),
+}
+
+CHART_SECTIONS = ("sankey", "revenue_stack_line", "expense_stack_line")
+
+# Section each artifact comes from, the narrative and the PDF aside
+ARTIFACT_SECTIONS = {
+    "dollar_var_top.pkl": "variance_tables",
+    "percent_var_top.pkl": "variance_tables",
+    "sankey_display.json": "sankey",
+    "sankey_pdf.json": "sankey",
+    "revenue_stack_line.json": "revenue_stack_line",
+    "expense_stack_line.json": "expense_stack_line",
+}
+
+# Maximum number of section prompts in flight at once
+MAX_CONCURRENCY = int(
+    os.getenv("ANALYSIS_CONCURRENCY", sum(section.analyse is not None for section in SECTIONS.values()))
+)
+
+# Progress stages of generate_report, the first two and the next two run side by side
+REPORT_STAGES = ("analyses", "narrative", "charts", "export", "pdf")
+
+
+def select_sections(sections=None) -> tuple:
+    """
+    Section names in report order, every section if none are given. Takes
+    names or a selection_key, "+" or "," separated.
+    """
+    if isinstance(sections, str):
+        sections = [name for name in sections.replace(",", "+").split("+") if name]
+    if not sections:
+        return tuple(SECTIONS)
+
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        raise ValueError(f"Unknown report sections {sorted(unknown)}, expected some of {list(SECTIONS)}")
+    return tuple(name for name in SECTIONS if name in sections)
+
+
+def selection_key(sections=None) -> str:
+    """"" for the full report, else the section names joined by "+" """
+    sections = select_sections(sections)
+    return "" if len(sections) == len(SECTIONS) else "+".join(sections)
+
+
+def section_sheets(sections=None) -> tuple:
+    """Sheets a report of `sections` reads"""
+    return tuple(dict.fromkeys(sheet for name in select_sections(sections) for sheet in SECTIONS[name].sheets))
+
+
+def narrated(sections=None) -> bool:
+    """Whether a report of `sections` has a narrative, i.e. any analysis"""
+    return any(SECTIONS[name].analyse is not None for name in select_sections(sections))
+
+
+def report_artifacts(sections=None) -> tuple:
+    """
+    Cached artifact names of a report of `sections` in REPORT_ARTIFACTS
+    order, None for what the selection leaves out. The full report is kept
+    at the top of the artifacts folder, other selections in sections/<key>/.
+    """
+    sections = select_sections(sections)
+    key = selection_key(sections)
+
+    names = []
+    for name in REPORT_ARTIFACTS:
+        if name == "qualitative.md":
+            produced = narrated(sections)
+        elif name in ARTIFACT_SECTIONS:
+            produced = ARTIFACT_SECTIONS[name] in sections
+        else:
+            # The PDF, whatever is in it
+            produced = True
+        names.append((f"sections/{key}/{name}" if key else name) if produced else None)
+    return tuple(names)
+
+
+def save_report_artifacts(cache, file_hash: str, report, sections=None):
+    """Store a report of `sections`, as returned by generate_report, in an UploadCache"""
+    names = report_artifacts(sections)
+    cache.save_artifacts(file_hash, {name: value for name, value in zip(names, report) if name is not None})
+
+
+def has_report_artifacts(cache, file_hash: str, sections=None) -> bool:
+    return cache.has_artifacts(file_hash, *filter(None, report_artifacts(sections)))
+
+
+def load_report_artifacts(cache, file_hash: str, sections=None):
+    """Cached report of `sections` laid out like generate_report's, or None if it is not cached"""
+    names = report_artifacts(sections)
+    artifacts = cache.load_artifacts(file_hash, *filter(None, names))
+    if artifacts is None:
+        return None
+
+    artifacts = iter(artifacts)
+    return [None if name is None else next(artifacts) for name in names]
+
+
+def analyse_sections(workbook: FinancialWorkbook, max_workers: int = MAX_CONCURRENCY, sections=None, pool=None):
+    """
+    Run the selected section analyses, every one by default, concurrently:
+    on `pool` if given, an executor shared to bound the LLM calls of many
+    reports, else on `max_workers` threads of their own.
+
+    Returns (label, analysis, error) per analysis in SECTIONS order, so one
+    failing section does not take the others down with it.
+    """
+    analyses = [(name, SECTIONS[name]) for name in select_sections(sections) if SECTIONS[name].analyse is not None]
+
+    def timed(name, analyse):
+        with span(f"analyse.{name}"):
+            return analyse(workbook)
+
+    if pool is not None:
+        futures = [pool.submit(in_context(timed), name, section.analyse) for name, section in analyses]
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as own_pool:
+            futures = [own_pool.submit(in_context(timed), name, section.analyse) for name, section in analyses]
+
+    results = []
+    for (_, section), future in zip(analyses, futures):
+        label = section.label
+        try:
+            analysis = future.result()
+            if analysis is None:
+                raise ValueError("no analysis returned")
+            results.append((label, analysis, None))
+        except Exception as e:
+            logger.exception(f"{label} failed")
+            results.append((label, None, e))
+
+    return results
+
+
+def master_prompt(workbook: FinancialWorkbook, max_workers: int = MAX_CONCURRENCY, sections=None, pool=None):
+    prompt = Prompt.master
+
+    # Collecting analyses in a list for better readability
+    analyses = [
+        f"{label}: {analysis}" if error is None else f"{label}: unavailable ({error})"
+        for label, analysis, error in analyse_sections(workbook, max_workers, sections, pool)
+    ]
+
+    # Joining the analyses into a single prompt
+    return "\n".join(analyses) + prompt
+
+
+def qualitative(
+    workbook: FinancialWorkbook, max_workers: int = MAX_CONCURRENCY, stream: bool = False, sections=None
+):
+    """
+    Master narrative built from the selected section analyses, None if no
+    analysis is selected. With `stream` it is returned as a generator of
+    text chunks rather than a string.
+    """
+    if not narrated(sections):
+        return None
+
+    prompt = master_prompt(workbook, max_workers, sections)
+
+    if stream:
+        # Timed by whoever consumes the stream
+        return utils.send_prompt(prompt, stream=True, route="master")
+
+    with span("llm.master"):
+        response = utils.send_prompt(prompt, route="master")
+
+    return response
+
+
+def quantitative(workbook: FinancialWorkbook, sections=None):
+    """Variance tables and figures of the selected sections, None for the rest"""
+    sections = select_sections(sections)
+    dollar_var_top = percent_var_top = fig_display = fig_pdf = fig_stack_line = fig_expense_stack_line = None
+
+    if "variance_tables" in sections:
+        with span("quantitative.variance"):
+            dollar_var_top, percent_var_top = is_month_comparative.get_data(workbook)
+
+    if set(CHART_SECTIONS) & set(sections):
+        df = workbook[T12_SHEET]
+
+    # Add Sankey diagram generation
+    if "sankey" in sections:
+        # Compute the flow once, the display and PDF figures only differ in font size
+        with span("chart.sankey"):
+            flow = sankey_data(df)
+            fig_display = sankey_figure(flow, font_size=16)
+            fig_pdf = sankey_figure(flow, font_size=10)
+    if "revenue_stack_line" in sections:
+        with span("chart.revenue_stack_line"):
+            fig_stack_line = total_revenue_stack_line(df)
+    if "expense_stack_line" in sections:
+        with span("chart.expense_stack_line"):
+            fig_expense_stack_line = total_expense_stack_line(df)
+    return dollar_var_top, percent_var_top, fig_display, fig_pdf, fig_stack_line, fig_expense_stack_line
+
+
+def pdf_styles():
+    styles = getSampleStyleSheet()
+
+    if "Heading1" in styles:
+        styles["Heading1"].alignment = 1
+    if "Heading2" in styles:
+        styles["Heading2"].alignment = 1
+    if "Heading3" in styles:
+        styles["Heading3"].alignment = 1
+
+    # Create a small italic style
+    small_italic_style = styles["Normal"].clone("SmallItalic")
+    small_italic_style.fontSize = 8
+    small_italic_style.fontName = "Helvetica"
+    small_italic_style.italic = True
+    styles.add(small_italic_style)
+
+    return styles
+
+
+def export_charts(sankey_fig, fig_stack_line, fig_expense_stack_line, img_format=PDF_CHART_FORMAT, rasterizer=None):
+    """
+    Export the PDF charts in one concurrent batch, on the warm kaleido pool
+    unless another `rasterizer` is given. Returns the format actually used
+    and the image bytes by chart caption, skipping charts that are None.
+    """
+    figures = (sankey_fig, fig_stack_line, fig_expense_stack_line)
+    charts = {
+        SECTIONS[name].label: figure for name, figure in zip(CHART_SECTIONS, figures) if figure is not None
+    }
+    img_format = chart_format(img_format)
+    if not charts:
+        return img_format, {}
+    rasterizer = rasterizer or get_rasterizer()
+    with span("chart.export", format=img_format):
+        rendered = rasterizer.render(charts.values(), img_format=img_format, width=700, height=500)
+
+        images = {}
+        for title, (chart_bytes, seconds) in zip(charts, rendered):
+            logger.debug(f"{title} chart exported in {seconds:.2f}s")
+            # Render time in the worker, 0 for cached images
+            annotate(**{f"render.{title}": round(seconds, 6)}, bytes=len(chart_bytes))
+            images[title] = chart_bytes
+    return img_format, images
+
+
+def quantitative_flowables(dollar_var_top, percent_var_top, img_format, images):
+    """PDF flowables for the variance tables and already exported charts, either may be left out"""
+    styles = pdf_styles()
+    small_italic_style = styles["SmallItalic"]
+    elements = []
+    if dollar_var_top is None and not images:
+        return elements
+
+    # Add H1 for Quantitative Analysis
+    elements.append(Paragraph("Quantitative Analysis", styles["Heading1"]))
+    elements.append(Spacer(1, 12))
+
+    if dollar_var_top is not None:
+        elements.append(df2table(dollar_var_top, col_widths=[200, 150]))
+        elements.append(
+            Paragraph(
+                "Ranked Expense Category Dollar Variance",
+                small_italic_style,
+            )
+        )
+        elements.append(Spacer(1, 24))
+
+        elements.append(df2table(percent_var_top, col_widths=[200, 150]))
+        elements.append(
+            Paragraph(
+                "Ranked Expense Category Percent Variance",
+                small_italic_style,
+            )
+        )
+        elements.append(Spacer(1, 24))
+
+    def add_image_to_elements(chart_bytes, elements, title, small_italic_style, max_width=500):
+        # Embed the exported bytes directly, no decode and re-encode
+        elements.append(chart_flowable(chart_bytes, img_format, max_width=max_width))
+
+        elements.append(
+            Paragraph(
+                title,
+                small_italic_style,
+            )
+        )
+        elements.append(Spacer(1, 24))
+
+    for title, chart_bytes in images.items():
+        add_image_to_elements(chart_bytes, elements, title, small_italic_style)
+    return elements
+
+
+def quantitative_elements(dollar_var_top, percent_var_top, sankey_fig, fig_stack_line, fig_expense_stack_line, img_format=PDF_CHART_FORMAT):
+    """
+    PDF flowables for the quantitative half of the report. Rasterizing the
+    charts is the slow part, so this can run before the narrative exists.
+    Charts are embedded as PNG, or as vector drawings with img_format="svg".
+    """
+    img_format, images = export_charts(sankey_fig, fig_stack_line, fig_expense_stack_line, img_format)
+    return quantitative_flowables(dollar_var_top, percent_var_top, img_format, images)
+
+
+# TODO: To be more robust
+def build_pdf(text, quant_elements):
+    # Create PDF in memory
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    styles = pdf_styles()
+    elements = []
+
+    # No narrative in a report of tables and charts only
+    if text is not None:
+        # Add H1 for Qualitative Analysis
+        elements.append(Paragraph("Qualitative Analysis", styles["Heading1"]))
+        elements.append(Spacer(1, 12))
+
+        # Parse the text
+        elements.extend(markdown2text(text, styles))
+
+    elements.extend(quant_elements)
+
+    # Build the document
+    with span("pdf.build", flowables=len(elements)):
+        doc.build(elements)
+    buffer.seek(0)
+    return buffer
+
+
+def generate_pdf(text, dollar_var_top, percent_var_top, sankey_fig, fig_stack_line, fig_expense_stack_line):
+    quant_elements = quantitative_elements(
+        dollar_var_top, percent_var_top, sankey_fig, fig_stack_line, fig_expense_stack_line
+    )
+    return build_pdf(text, quant_elements)
+
+
+def generate_report(
+    workbook: FinancialWorkbook,
+    max_workers: int = MAX_CONCURRENCY,
+    progress=None,
+    rasterizer=None,
+    sections=None,
+    img_format: str = PDF_CHART_FORMAT,
+    on_result=None,
+    write_stream=None,
+    llm_pool=None,
+):
+    """
+    The report of a workbook in REPORT_ARTIFACTS order, limited to
+    `sections` if given, with None for the parts left out. The one pipeline
+    behind the app, the job workers and the batch CLI: the section prompts
+    run in the background while the variance tables and charts are built
+    and rasterized for the PDF, so only the LLM calls are on the critical
+    path.
+
+    Hooks, all optional:
+    - `progress(stage, status, seconds)` as each of REPORT_STAGES starts
+      ("running") and ends ("done" or "failed"), or is "skipped"; called
+      from the pool threads
+    - `on_result(part, value)` with each part as soon as it is ready:
+      "quantitative" with the output of quantitative(), then "narrative"
+      with the text
+    - `write_stream(chunks)` to stream the narrative while it is generated,
+      given its text chunks and returning the full text (st.write_stream)
+    on_result and write_stream are called from the calling thread, so they
+    may draw on a Streamlit page.
+
+    With `llm_pool`, an executor shared by many reports, every LLM call of
+    the report runs on it (the streamed narrative aside), so its size bounds
+    the calls in flight across them.
+    """
+    sections = select_sections(sections)
+    # Parse the sheets the selection needs up front, in one pass over the workbook
+    workbook.load(*section_sheets(sections))
+
+    def skip(*names):
+        if progress is not None:
+            for name in names:
+                progress(name, "skipped")
+
+    @contextmanager
+    def stage(name):
+        if progress is not None:
+            progress(name, "running")
+        start = time.perf_counter()
+        try:
+            with span(f"stage.{name}"):
+                yield
+        except Exception:
+            if progress is not None:
+                progress(name, "failed", time.perf_counter() - start)
+            raise
+        if progress is not None:
+            progress(name, "done", time.perf_counter() - start)
+
+    def analyses():
+        with stage("analyses"):
+            return master_prompt(workbook, max_workers, sections, llm_pool)
+
+    def narrative(prompt):
+        with stage("narrative"):
+            if write_stream is None:
+                with span("llm.master"):
+                    if llm_pool is None:
+                        return utils.send_prompt(prompt, route="master")
+                    return llm_pool.submit(in_context(utils.send_prompt), prompt, route="master").result()
+            with span("llm.master", stream=True):
+                return write_stream(utils.send_prompt(prompt, stream=True, route="master"))
+
+    def tables_and_charts():
+        with stage("charts"):
+            return quantitative(workbook, sections)
+
+    def export(quant_future):
+        quant = quant_future.result()
+        if not set(sections) & set(CHART_SECTIONS):
+            skip("export")
+            return quantitative_flowables(*quant[:2], None, {})
+        with stage("export"):
+            chart_format, images = export_charts(*quant[3:], img_format, rasterizer)
+        return quantitative_flowables(*quant[:2], chart_format, images)
+
+    text = None
+    quant = (None,) * 6
+    elements = []
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        # Pool threads carry the trace along so their spans are recorded
+        futures = []
+        if set(sections) & {"variance_tables", *CHART_SECTIONS}:
+            quant_future = pool.submit(in_context(tables_and_charts))
+            # Rasterize for the PDF as soon as the charts exist, whatever the caller is doing
+            elements_future = pool.submit(in_context(export), quant_future)
+            futures.append(quant_future)
+        else:
+            skip("charts", "export")
+            quant_future = elements_future = None
+        if narrated(sections):
+            futures.append(pool.submit(in_context(analyses)))
+        else:
+            skip("analyses", "narrative")
+
+        for future in as_completed(futures):
+            if future is quant_future:
+                quant = future.result()
+                if on_result is not None:
+                    on_result("quantitative", quant)
+            else:
+                text = narrative(future.result())
+                if on_result is not None:
+                    on_result("narrative", text)
+
+        if elements_future is not None:
+            elements = elements_future.result()
+
+    with stage("pdf"):
+        pdf_bytes = build_pdf(text, elements).getvalue()
+
+    return [text, *quant, pdf_bytes]
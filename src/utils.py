@@ -1,24 +1,29 @@
 import hashlib
+import io
 import re
 import shutil
-from datetime import datetime
+import struct
 from pathlib import Path
+from loguru import logger
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+from reportlab.platypus import Image as RLImage
 
+try:
+    from svglib.svglib import svg2rlg
+except ImportError:  # Optional, only needed for vector charts
+    svg2rlg = None
 
-def save_file(uploaded_file, root_dir: Path) -> Path:
-    """Create a unique folder based on file hash and timestamp"""
-    # Create hash of file content
-    file_hash = hashlib.md5(uploaded_file.getvalue()).hexdigest()[:8]
 
-    # Create timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+def file_hash(uploaded_file) -> str:
+    """Full md5 of the uploaded file content, used as its cache key"""
+    return hashlib.md5(uploaded_file.getvalue()).hexdigest()
+
 
-    # Create unique folder name
-    folder_name = f"{timestamp}_{file_hash}"
-    unique_folder = root_dir / "uploads" / folder_name
+def save_file(uploaded_file, root_dir: Path) -> Path:
+    """Create a folder addressed by the file hash, reused on repeat uploads"""
+    unique_folder = root_dir / "uploads" / file_hash(uploaded_file)
 
     # Create folders if they don't exist
     unique_folder.mkdir(parents=True, exist_ok=True)
@@ -26,8 +31,10 @@ def save_file(uploaded_file, root_dir: Path) -> Path:
     (unique_folder / "processed").mkdir(exist_ok=True)
 
     # Save the uploaded file to the "raw" directory
-    with open(unique_folder / "raw" / uploaded_file.name, "wb") as f:
-        f.write(uploaded_file.getbuffer())
+    raw_path = unique_folder / "raw" / uploaded_file.name
+    if not raw_path.exists():
+        with open(raw_path, "wb") as f:
+            f.write(uploaded_file.getbuffer())
 
     return unique_folder
 
@@ -78,3 +85,37 @@ def df2table(df, col_widths=None):
         )
     )
     return table
+
+
+def png_size(png_bytes: bytes):
+    """Width and height of a PNG, read from its IHDR header without decoding"""
+    if png_bytes[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("Not a PNG image")
+    return struct.unpack(">II", png_bytes[16:24])
+
+
+def chart_flowable(chart_bytes: bytes, img_format: str = "png", max_width=500):
+    """
+    Embed exported chart bytes as-is: PNGs go straight into an Image
+    flowable, SVGs become vector ReportLab drawings. Either is scaled to
+    `max_width` keeping the aspect ratio.
+    """
+    if img_format == "svg":
+        drawing = svg2rlg(io.BytesIO(chart_bytes))
+        scale = min(1, max_width / drawing.width)
+        drawing.scale(scale, scale)
+        drawing.width, drawing.height = drawing.width * scale, drawing.height * scale
+        return drawing
+
+    img_width, img_height = png_size(chart_bytes)
+    new_width = min(max_width, img_width)
+    new_height = new_width * img_height / float(img_width)
+    return RLImage(io.BytesIO(chart_bytes), width=new_width, height=new_height)
+
+
+def chart_format(requested: str) -> str:
+    """Chart format to export for the PDF, falling back to PNG without svglib"""
+    if requested == "svg" and svg2rlg is None:
+        logger.warning("svglib is not installed, embedding charts as PNG")
+        return "png"
+    return requested
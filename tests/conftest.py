@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The app modules import each other as top-level modules from src/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+
+@pytest.fixture
+def llm(monkeypatch, tmp_path):
+    """A fast MockLLM behind send_prompt, with a fresh router and response cache"""
+    from analysis import router, utils
+    from analysis.llm_cache import ResponseCache
+    from analysis.mock_llm import MockLLM
+
+    mock = MockLLM(latency=0.01, latency_sigma=0, tokens_per_second=1e6, answer_tokens=20)
+    monkeypatch.setattr(router, "_router", router.Router())
+    monkeypatch.setattr(utils, "_response_cache", ResponseCache(tmp_path / "responses.sqlite"))
+    # Retries wait for Retry-After only, not the exponential backoff
+    monkeypatch.setattr(utils, "_backoff", lambda retry_state: 0)
+    monkeypatch.setattr(utils.LLM, "backend", "mock")
+    monkeypatch.setitem(utils._clients, "mock", mock)
+    return mock
@@ -0,0 +1,119 @@
+import gc
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cache import UploadCache, UploadCollector, UploadLeases
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return UploadCache(tmp_path)
+
+
+def store(cache, file_hash, artifacts=("qualitative.md", "dollar_var_top.pkl")):
+    """An upload folder with a raw workbook, a processed sheet and some artifacts"""
+    folder = cache.folder(file_hash)
+    for path in (folder / "raw" / "book.xlsx", folder / "processed" / "Labor.arrow"):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * 100)
+    for name in artifacts:
+        (folder / "artifacts").mkdir(exist_ok=True)
+        (folder / "artifacts" / name).write_bytes(b"x" * 100)
+    return folder
+
+
+def test_lookup_returns_added_uploads(cache):
+    assert cache.lookup("a") is None
+    cache.add("a", "book.xlsx")
+    assert cache.lookup("a")["name"] == "book.xlsx"
+
+
+def test_lookup_drops_uploads_of_another_layout(cache):
+    folder = store(cache, "a")
+    cache.add("a", "book.xlsx")
+    with cache.update_index() as index:
+        index["a"]["layout"] = "old"
+
+    assert cache.lookup("a") is None
+    assert "a" not in cache.read_index()
+    assert not (folder / "processed" / "Labor.arrow").exists()
+    assert not (folder / "artifacts").exists()
+    # The workbook itself stays, to be processed again
+    assert cache.has_upload("a")
+
+
+def test_lookup_drops_only_llm_artifacts_of_other_prompts(cache):
+    folder = store(cache, "a", artifacts=("qualitative.md", "report.pdf", "dollar_var_top.pkl"))
+    (folder / "artifacts" / "sections" / "labor").mkdir(parents=True)
+    (folder / "artifacts" / "sections" / "labor" / "qualitative.md").write_text("old")
+    cache.add("a", "book.xlsx")
+    with cache.update_index() as index:
+        index["a"]["prompts"] = "old"
+
+    assert cache.lookup("a") is not None
+    assert sorted(path.name for path in (folder / "artifacts").rglob("*") if path.is_file()) == ["dollar_var_top.pkl"]
+
+
+def test_concurrent_updates_keep_every_entry(cache):
+    def add(worker):
+        for i in range(25):
+            cache.add(f"{worker}-{i}", "book.xlsx")
+            cache.touch(f"{worker}-{i}")
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(add, range(8)))
+
+    assert len(cache.read_index()) == 8 * 25
+
+
+def used(cache, file_hash, seconds_ago):
+    """A stored upload last used `seconds_ago`, 400 bytes on disk"""
+    store(cache, file_hash)
+    cache.add(file_hash, "book.xlsx")
+    with cache.update_index() as index:
+        index[file_hash]["last_used"] = time.time() - seconds_ago
+
+
+def test_collects_expired_then_least_recently_used_uploads(cache):
+    used(cache, "expired", 100)
+    used(cache, "old", 50)
+    used(cache, "new", 10)
+
+    result = cache.collect_garbage(max_bytes=500, max_age=60, grace=0)
+    assert result == {"evicted": ["expired", "old"], "reclaimed": 800, "kept": 400}
+    assert set(cache.read_index()) == {"new"}
+    assert sorted(path.name for path in cache.root.iterdir()) == ["index.json", "index.lock", "new"]
+
+
+def test_keeps_protected_and_recently_used_uploads(cache):
+    used(cache, "protected", 100)
+    used(cache, "recent", 100)
+    with cache.update_index() as index:
+        index["recent"]["last_used"] = time.time()
+
+    assert cache.collect_garbage(max_bytes=1, max_age=60, protected={"protected"}, grace=60)["evicted"] == []
+
+
+def test_ages_folders_missing_from_the_index_by_modification_time(cache):
+    store(cache, "unindexed")
+    assert cache.collect_garbage(max_bytes=0, max_age=60, grace=0)["evicted"] == []
+    assert cache.collect_garbage(max_bytes=1, max_age=0, grace=0)["evicted"] == ["unindexed"]
+
+
+def test_leases_last_as_long_as_their_holder(cache):
+    leases = UploadLeases()
+    lease = leases.hold("a")
+    leases.hold("b")
+    gc.collect()
+    assert leases() == {"a"}
+
+    used(cache, "a", 100)
+    collector = UploadCollector(cache, leases, max_bytes=0, max_age=60, grace=0)
+    assert collector.collect()["evicted"] == []
+
+    del lease
+    gc.collect()
+    assert collector.collect()["evicted"] == ["a"]
+    assert collector.reclaimed == 400
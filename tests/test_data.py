@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data import (
+    FinancialWorkbook,
+    clean_frame,
+    format_sheet,
+    read_workbook,
+    sheet_layout,
+    sheets,
+    stored_layout,
+    xlsx_path,
+)
+
+pytestmark = pytest.mark.skipif(not xlsx_path.exists(), reason="sample workbook not available")
+
+
+def baseline_xlsx2df(rows, columns, sheet_name, xlsx_path=xlsx_path):
+    """xlsx2df as it was before ingestion was rewritten, kept as the reference"""
+    df = pd.read_excel(
+        xlsx_path,
+        sheet_name=sheet_name,
+        header=None,
+        skiprows=rows[0] - 1,
+        nrows=rows[1] - rows[0] + 1,
+        usecols=f"{columns[0]}:{columns[1]}",
+    )
+
+    df = df.astype(str)
+    df = df.map(lambda x: x.strip() if isinstance(x, str) else x)
+    df = df[~df.apply(lambda row: row.str.strip().eq("").all(), axis=1)]
+    df = df[~df.apply(lambda row: row.nunique() <= 1, axis=1)]
+    df = df.replace("nan", np.nan)
+    return df.dropna(axis=0, thresh=2)
+
+
+@pytest.fixture(scope="module")
+def raw_frames():
+    return read_workbook(xlsx_path, sheets)
+
+
+@pytest.mark.parametrize("sheet_name", list(sheets))
+def test_matches_baseline_xlsx2df(raw_frames, sheet_name):
+    rows, columns = sheets[sheet_name]
+    expected = format_sheet(sheet_name, baseline_xlsx2df(rows, columns, sheet_name))
+
+    # The baseline turned every cell into text, the new path keeps native types
+    cleaned = format_sheet(sheet_name, clean_frame(raw_frames[sheet_name]))
+    actual = cleaned.astype(str).replace("nan", np.nan)
+
+    pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_reparses_sheets_stored_with_another_layout(tmp_path):
+    sheet_name = "Labor"
+    rows, columns = sheets[sheet_name]
+    # Processed while the map cut the sheet short
+    short_map = {sheet_name: [[rows[0], rows[0] + 20], columns]}
+    FinancialWorkbook.from_dir(tmp_path, short_map, xlsx_path).load(sheet_name)
+    assert stored_layout(tmp_path / f"{sheet_name}.arrow") == sheet_layout(short_map[sheet_name])
+
+    workbook = FinancialWorkbook.from_dir(tmp_path, sheets, xlsx_path)
+    expected = FinancialWorkbook.from_xlsx(xlsx_path, {sheet_name: sheets[sheet_name]})[sheet_name]
+    pd.testing.assert_frame_equal(workbook[sheet_name], expected)
+    assert stored_layout(tmp_path / f"{sheet_name}.arrow") == sheet_layout(sheets[sheet_name])
+
+    # Read back from the store once it matches, without the raw workbook
+    pd.testing.assert_frame_equal(FinancialWorkbook.from_dir(tmp_path, sheets)[sheet_name], expected)
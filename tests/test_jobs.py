@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+import jobs
+from jobs import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(tmp_path / "jobs.sqlite")
+
+
+def test_submitting_an_active_upload_returns_its_job(queue):
+    job_id = queue.submit("abc", "book.xlsx")
+    assert queue.submit("abc", "book.xlsx") == job_id
+    # Even when forced, one job per upload and selection at a time
+    assert queue.submit("abc", "book.xlsx", force=True) == job_id
+    assert queue.active_hashes() == {"abc"}
+
+
+def test_only_forced_submissions_rerun_finished_jobs(queue):
+    job_id = queue.submit("abc")
+    queue.claim(os.getpid())
+    queue.finish(job_id)
+
+    assert queue.submit("abc") == job_id
+    rerun = queue.submit("abc", force=True)
+    assert rerun != job_id
+    assert queue.latest("abc")["id"] == rerun
+
+
+def test_selections_of_sections_are_separate_jobs(queue):
+    full = queue.submit("abc")
+    labor = queue.submit("abc", sections=["labor"])
+
+    assert labor != full
+    assert queue.get(labor)["sections"] == "labor"
+    assert queue.latest("abc")["id"] == full
+    assert queue.latest("abc", ["labor"])["id"] == labor
+
+
+def test_claims_the_oldest_queued_job_once(queue):
+    first = queue.submit("a")
+    queue.submit("b")
+
+    job = queue.claim(os.getpid())
+    assert (job["id"], job["status"], job["attempts"]) == (first, "running", 1)
+    assert queue.claim(os.getpid())["file_hash"] == "b"
+    assert queue.claim(os.getpid()) is None
+
+
+def test_records_stage_progress(queue):
+    job_id = queue.submit("abc")
+    queue.update(job_id, "ingest", "done", 1.23456)
+    queue.finish(job_id, error="ValueError: bad sheet")
+
+    job = queue.get(job_id)
+    assert job["stages"] == {"ingest": {"status": "done", "seconds": 1.235}}
+    assert (job["status"], job["error"]) == ("failed", "ValueError: bad sheet")
+
+
+def test_requeues_jobs_of_dead_workers_until_max_attempts(queue, monkeypatch):
+    monkeypatch.setattr(jobs.psutil, "pid_exists", lambda pid: pid == os.getpid())
+    alive = queue.submit("alive")
+    queue.claim(os.getpid())
+    lost = queue.submit("lost")
+
+    for attempt in range(1, jobs.MAX_ATTEMPTS + 1):
+        assert queue.claim(-1)["attempts"] == attempt
+        assert queue.recover() == 1
+
+    assert queue.get(alive)["status"] == "running"
+    job = queue.get(lost)
+    assert (job["status"], job["error"]) == ("failed", f"Worker lost {jobs.MAX_ATTEMPTS} times")
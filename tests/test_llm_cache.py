@@ -0,0 +1,46 @@
+from analysis import utils
+from analysis.llm_cache import ResponseCache
+from analysis.prompt import prompt_version
+
+
+def test_answers_repeat_prompts_from_the_cache(llm):
+    first = utils.send_prompt("Summarise the census", route="master")
+    assert utils.send_prompt("Summarise the census", route="master") == first
+    assert llm.calls == 1
+    assert utils.get_response_cache().stats()["hits"] == 1
+
+
+def test_refresh_replaces_the_cached_answer(llm):
+    llm.answers = {"census": "old"}
+    utils.send_prompt("Summarise the census", route="master")
+    llm.answers = {"census": "new"}
+
+    assert utils.send_prompt("Summarise the census", route="master", refresh=True) == "new"
+    assert utils.send_prompt("Summarise the census", route="master") == "new"
+    assert llm.calls == 2
+
+
+def test_caches_streamed_answers_once_consumed(llm):
+    streamed = "".join(utils.send_prompt("Summarise the census", route="master", stream=True))
+    assert "".join(utils.send_prompt("Summarise the census", route="master", stream=True)) == streamed
+    assert utils.send_prompt("Summarise the census", route="master") == streamed
+    assert llm.calls == 1
+
+
+def test_keys_tell_models_temperatures_and_backends_apart(llm, monkeypatch):
+    key = ResponseCache.key("gpt-4o", 0.3, "prompt")
+    assert key != ResponseCache.key("gpt-4o-mini", 0.3, "prompt")
+    assert key != ResponseCache.key("gpt-4o", 0.0, "prompt")
+    assert utils.cache_model("gpt-4o") == "mock:gpt-4o"
+
+    monkeypatch.setattr(utils.LLM, "backend", "openai")
+    assert utils.cache_model("gpt-4o") == "gpt-4o"
+    assert utils.cache_model("llama", "local") == "local:llama"
+
+
+def test_keys_change_with_the_prompt_templates(monkeypatch):
+    from analysis import llm_cache
+
+    key = ResponseCache.key("gpt-4o", 0.3, "prompt")
+    monkeypatch.setattr(llm_cache, "prompt_version", lambda: prompt_version() + "-edited")
+    assert ResponseCache.key("gpt-4o", 0.3, "prompt") != key
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cache import UploadCache
+from data import LINE_ITEM, FinancialWorkbook
+from portfolio import Portfolio, consolidate, stack_frames
+
+
+def sheet(rows: dict, columns: list) -> pd.DataFrame:
+    frame = pd.DataFrame([values for _, values in rows], columns=columns, dtype=float)
+    frame.index = pd.Index([name for name, _ in rows], dtype=object, name=LINE_ITEM)
+    return frame
+
+
+def test_sums_amounts_keeping_repeated_line_items_apart():
+    columns = ["Jan", "Feb"]
+    a = sheet([("Census", [np.nan, np.nan]), ("Census", [10, 20]), ("Revenue", [100, 200])], columns)
+    b = sheet([("Census", [np.nan, np.nan]), ("Census", [1, 2]), ("Revenue", [np.nan, 5])], columns)
+
+    totals = consolidate(stack_frames({"A": a, "B": b}))
+
+    expected = sheet([("Census", [np.nan, np.nan]), ("Census", [11, 22]), ("Revenue", [100, 205])], columns)
+    pd.testing.assert_frame_equal(totals, expected, check_names=False)
+
+
+def test_recomputes_ppd_from_summed_amounts_and_patient_days():
+    columns = ["Revenue", "PPD Revenue"]
+    # 100 and 20 patient days
+    a = sheet([("Medicare", [3000, 30]), ("Empty", [0, 0])], columns)
+    b = sheet([("Medicare", [1000, 50]), ("Empty", [0, 0])], columns)
+
+    totals = consolidate(stack_frames({"A": a, "B": b}))
+
+    assert totals.loc["Medicare", "PPD Revenue"] == pytest.approx(4000 / 120)
+    assert totals.loc["Empty", "PPD Revenue"] == 0
+
+
+def test_recomputes_variances_from_summed_changes_and_priors():
+    columns = ["Current", "Prior", "Diff", "% Variance"]
+    a = sheet([("Nursing", [110, 100, 10, 0.1]), ("New", [5, 0, 5, 1.0]), ("Flat", [0, 0, 0, 0.0])], columns)
+    b = sheet([("Nursing", [270, 300, -30, -0.1]), ("New", [5, 0, 5, 1.0]), ("Flat", [0, 0, 0, 0.0])], columns)
+
+    totals = consolidate(stack_frames({"A": a, "B": b}))
+
+    assert totals.loc["Nursing", "% Variance"] == pytest.approx(-20 / 400)
+    # Any change from a zero prior is 100%, no change 0%
+    assert totals.loc["New", "% Variance"] == 1.0
+    assert totals.loc["Flat", "% Variance"] == 0.0
+
+
+def test_workbook_consolidates_every_sheet_a_facility_has():
+    a = sheet([("Revenue", [1, 2])], ["Jan", "Feb"])
+    b = sheet([("Revenue", [3, 4])], ["Jan", "Feb"])
+    portfolio = Portfolio({"A": FinancialWorkbook({"Labor": a}), "B": FinancialWorkbook({"Labor": b})})
+
+    assert portfolio.workbook()["Labor"].loc["Revenue"].tolist() == [4, 6]
+
+
+@pytest.fixture
+def uploads(tmp_path):
+    cache = UploadCache(tmp_path)
+    for file_hash, name in {
+        "old": "2024 08 Harrisburg Opco Financial Statements.xlsx",
+        "new": "2024 09 Harrisburg Opco Financial Statements.xlsx",
+        "other": "2024 08 Lancaster Opco Financial Statements.xlsx",
+    }.items():
+        cache.add(file_hash, name)
+    return cache
+
+
+def test_from_uploads_keeps_each_facilitys_latest_statement(uploads):
+    # Uploaded last, but an older month
+    with uploads.update_index() as index:
+        index["old"]["created"] = index["new"]["created"] + 1
+
+    portfolio = Portfolio.from_uploads(uploads)
+    assert len(portfolio.facilities) == 2
+    assert {workbook.path.parent.name for workbook in portfolio.workbooks.values()} == {"new", "other"}
+
+
+def test_from_uploads_rejects_two_statements_of_a_facility(uploads):
+    with pytest.raises(ValueError):
+        Portfolio.from_uploads(uploads, ["old", "new"])
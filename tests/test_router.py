@@ -0,0 +1,126 @@
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from analysis import utils
+from analysis.router import LatencyStats, Model, Route, Router, get_router
+
+
+@pytest.fixture
+def router(llm):
+    router = get_router()
+    router.routes["section"] = Route(("gpt-4o-mini", "gpt-4o"), budget=0.05)
+    return router
+
+
+def test_falls_back_when_the_preferred_model_times_out(llm, router):
+    llm.model_latency = {"gpt-4o-mini": 1.0}
+
+    assert utils.send_prompt("Summarise labor", route="section") is not None
+    assert router.stats.summary()["gpt-4o-mini"]["errors"] == 1
+    assert router.stats.summary()["gpt-4o"]["calls"] == 1
+
+
+def test_fallback_answers_are_not_served_in_place_of_the_preferred_model(llm, router):
+    llm.model_latency = {"gpt-4o-mini": 1.0}
+    utils.send_prompt("Summarise labor", route="section")
+    llm.model_latency = {}
+
+    utils.send_prompt("Summarise labor", route="section")
+    assert router.stats.summary()["gpt-4o-mini"]["calls"] == 2
+    # Still the answer of the model asked for by name
+    utils.send_prompt("Summarise labor", model="gpt-4o")
+    assert router.stats.summary()["gpt-4o"]["calls"] == 1
+
+
+def test_demotes_repeatedly_failing_and_slow_models():
+    router = Router(routes={"default": Route(("a", "b"), budget=1.0)}, models={"a": Model("mock", "a"), "b": Model("mock", "b")})
+    assert [name for name, _, _ in router.candidates()] == ["a", "b"]
+
+    for _ in range(router.max_failures):
+        router.stats.record("a", 0.1, ok=False)
+    assert [name for name, _, _ in router.candidates()] == ["b", "a"]
+
+    router.stats.record("a", 0.1)
+    for _ in range(router.min_samples):
+        router.stats.record("b", 2.0)
+    assert [name for name, _, _ in router.candidates()] == ["a", "b"]
+
+
+def test_waits_the_budget_only_while_a_fallback_remains():
+    router = Router(routes={"default": Route(("a", "b"), budget=5)}, models={"a": Model("mock", "a", 60), "b": Model("mock", "b", 60)})
+    assert [timeout for _, _, timeout in router.candidates()] == [5, 60]
+
+
+def test_latency_percentiles_need_enough_recent_samples(monkeypatch):
+    stats = LatencyStats(max_age=10)
+    for seconds in range(1, 101):
+        stats.record("a", float(seconds))
+
+    assert stats.percentile("a", 95, min_samples=101) is None
+    assert stats.percentile("a", 50) == pytest.approx(50.5)
+    assert stats.percentile("a", 95) == pytest.approx(95.05)
+
+    # Samples age out
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert stats.percentile("a", 50) is None
+
+
+def test_failures_cool_down(monkeypatch):
+    stats = LatencyStats(cooldown=60)
+    stats.record("a", 0.1, ok=False)
+    assert stats.failures("a") == 1
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert stats.failures("a") == 0
+
+
+def test_routes_without_registered_models_raise(llm, router):
+    router.routes["broken"] = Route(("unknown",))
+    with pytest.raises(ValueError):
+        utils.send_prompt("Summarise labor", route="broken")
+
+
+def test_route_timeouts_never_exceed_llm_timeout(llm, router, monkeypatch):
+    monkeypatch.setattr(utils.LLM, "timeout", 0.05)
+    router.routes["slow"] = Route(("gpt-4o",))
+    llm.model_latency = {"gpt-4o": 1.0}
+
+    start = time.perf_counter()
+    with pytest.raises(utils.APITimeoutError):
+        utils.send_prompt("Summarise labor", route="slow")
+    # Every attempt gave up after LLM_TIMEOUT rather than the model's 120s
+    assert llm.calls == utils.LLM.max_attempts
+    assert time.perf_counter() - start < 1.0
+
+
+def rate_limit(headers):
+    return utils.MockLLM()._error(429, "Rate limit reached", headers)
+
+
+def test_reads_retry_after_headers():
+    assert utils.retry_after(rate_limit({"retry-after-ms": "1500"})) == 1.5
+    assert utils.retry_after(rate_limit({"retry-after": "2"})) == 2
+    at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 25 < utils.retry_after(rate_limit({"retry-after": format_datetime(at, usegmt=True)})) <= 30
+    assert utils.retry_after(rate_limit({"retry-after": "soon"})) == 0
+    assert utils.retry_after(rate_limit({})) == 0
+
+
+def test_retries_rate_limits_no_sooner_than_retry_after(llm, monkeypatch):
+    create = llm.create
+    rejected = []
+
+    def reject_once(**kwargs):
+        if not rejected:
+            rejected.append(time.perf_counter())
+            raise rate_limit({"retry-after-ms": "300"})
+        return create(**kwargs)
+
+    monkeypatch.setattr(llm.chat.completions, "create", reject_once)
+    assert utils.send_prompt("Summarise labor", model="gpt-4o") is not None
+    assert time.perf_counter() - rejected[0] >= 0.3
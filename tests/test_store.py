@@ -0,0 +1,87 @@
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from analysis import store
+from analysis.llm_cache import ResponseCache
+from analysis.store import BlobCache
+from render import FigureCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time as seen by the stores, moved forward by hand"""
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(store, "time", SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def test_evicts_least_recently_used_past_max_bytes(tmp_path, clock):
+    cache = BlobCache(tmp_path / "blobs.sqlite", "blobs", max_bytes=250)
+    for key in ("a", "b"):
+        cache.put(key, "x" * 100)
+        clock.value += 1
+    # Reading "a" makes "b" the least recently used
+    assert cache.get("a") == "x" * 100
+    clock.value += 1
+
+    cache.put("c", "x" * 100)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["bytes"] == 200
+
+
+def test_expires_entries_older_than_max_age(tmp_path, clock):
+    cache = BlobCache(tmp_path / "blobs.sqlite", "blobs", max_bytes=2**20, max_age=60)
+    cache.put("old", "value")
+    clock.value += 61
+
+    assert cache.get("old") is None
+    cache.put("new", "value")
+    assert cache.stats()["entries"] == 1
+
+
+def test_counts_hits_and_misses(tmp_path):
+    cache = BlobCache(tmp_path / "blobs.sqlite", "blobs", max_bytes=2**20)
+    cache.put("a", b"\x00\x01")
+    cache.get("a")
+    cache.get("b")
+
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1, "bytes": 2}
+    cache.clear()
+    assert cache.stats() == {"hits": 0, "misses": 0, "entries": 0, "bytes": 0}
+
+
+def test_drops_a_table_of_an_older_layout(tmp_path):
+    path = tmp_path / "blobs.sqlite"
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE blobs (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("INSERT INTO blobs VALUES ('a', 'old')")
+
+    cache = BlobCache(path, "blobs", max_bytes=2**20)
+    assert cache.get("a") is None
+    cache.put("a", "new")
+    assert cache.get("a") == "new"
+
+
+def test_caches_share_a_file_in_separate_tables(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    responses = ResponseCache(path)
+    images = FigureCache(path)
+    responses.put("k", "text")
+    images.put("k", b"\x89PNG")
+
+    assert responses.get("k") == "text"
+    assert images.get("k") == b"\x89PNG"
+
+
+def test_from_env(tmp_path, monkeypatch):
+    monkeypatch.setenv("TEST_CACHE_PATH", str(tmp_path / "env.sqlite"))
+    monkeypatch.setenv("TEST_CACHE_MAX_BYTES", "1000")
+    monkeypatch.setenv("TEST_CACHE_MAX_AGE", "5")
+    cache = ResponseCache.from_env("TEST_CACHE", "unused.sqlite", max_bytes=10)
+    assert (cache.path, cache.max_bytes, cache.max_age) == (tmp_path / "env.sqlite", 1000, 5)
+
+    monkeypatch.setenv("TEST_CACHE", "0")
+    assert ResponseCache.from_env("TEST_CACHE", "unused.sqlite", max_bytes=10) is None